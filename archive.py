@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import time
+from hashlib import sha256
+import zstandard
+import config
+
+
+class PageArchive:
+    """Content-addressed, zstd-compressed store of every fetched page
+
+    Page bodies are stored once per distinct content under objects/ab/<sha256>.zst,
+    and an SQLite index maps (tid, kind, page, fetched_at) to the content hash.
+    kind is 'thread' for showthread.php pages and 'print' for printthread.php pages.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config.ARCHIVE_DIR
+        os.makedirs(os.path.join(self.path, 'objects'), exist_ok=True)
+        self.compressor = zstandard.ZstdCompressor(level=config.ARCHIVE_ZSTD_LEVEL)
+        self.index = sqlite3.connect(os.path.join(self.path, 'index.sqlite'))
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                tid INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                url TEXT,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (tid, kind, page, fetched_at)
+            )
+        """)
+        self.index.commit()
+
+    def object_path(self, digest):
+        """Return the file path of the object with the given content hash"""
+        return object_path(self.path, digest)
+
+    def store(self, tid, page, url, content, kind='thread'):
+        """Store a fetched page body and record it in the index, returning its content hash"""
+        digest = sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self.compressor.compress(content))
+            os.replace(tmp_path, path)
+        self.index.execute(
+            "INSERT OR REPLACE INTO pages (tid, kind, page, fetched_at, url, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+            (tid, kind, page, time.time(), url, digest)
+        )
+        self.index.commit()
+        return digest
+
+    def load(self, digest):
+        """Return the decompressed body of an archived page"""
+        return load_object(self.path, digest)
+
+    def latest_threads(self):
+        """Yield (tid, {kind: [(page, sha256), ...]}) with the latest snapshot of each page, by tid"""
+        cursor = self.index.execute("""
+            SELECT tid, kind, page, sha256 FROM pages AS p
+            WHERE fetched_at = (SELECT MAX(fetched_at) FROM pages
+                                WHERE tid = p.tid AND kind = p.kind AND page = p.page)
+            ORDER BY tid, kind, page
+        """)
+        current_tid = None
+        pages = {}
+        for tid, kind, page, digest in cursor:
+            if tid != current_tid:
+                if current_tid is not None:
+                    yield current_tid, pages
+                current_tid = tid
+                pages = {}
+            pages.setdefault(kind, []).append((page, digest))
+        if current_tid is not None:
+            yield current_tid, pages
+
+    def close(self):
+        """Close the archive index"""
+        self.index.close()
+
+
+def object_path(archive_path, digest):
+    """Return the file path of an archived object, usable without opening the index"""
+    return os.path.join(archive_path, 'objects', digest[:2], f"{digest}.zst")
+
+
+_decompressor = None
+
+
+def load_object(archive_path, digest):
+    """Read and decompress an archived object"""
+    global _decompressor
+    if _decompressor is None:
+        _decompressor = zstandard.ZstdDecompressor()
+    with open(object_path(archive_path, digest), 'rb') as f:
+        return _decompressor.decompress(f.read())
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from page_parser import make_parser
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, 'corpus')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+
+def load_corpus(path=CORPUS_DIR):
+    """Return [(name, thread_id, page_num, content)] for the pages listed in the corpus manifest"""
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    corpus = []
+    for name, info in manifest.items():
+        with open(os.path.join(path, name), 'rb') as f:
+            corpus.append((name, info['thread_id'], info['page'], f.read()))
+    return corpus
+
+
+def time_calls(fn, repeat):
+    """Call fn repeat times and return the median duration in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def peak_memory(fn):
+    """Return the peak memory allocated by Python while fn runs, in MB"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def bench_parsing(engine, corpus, repeat):
+    """Time document parsing, page count extraction and post extraction for every corpus page"""
+    parser = make_parser(engine)
+    pages = {}
+    total_seconds = 0
+    total_posts = 0
+    for name, thread_id, page_num, content in corpus:
+        soup = parser.parse_document(content)
+        posts = len(parser.parse_thread_page(thread_id, page_num, soup)[2])
+
+        def parse_page():
+            parsed = parser.parse_document(content)
+            parser.extract_number_of_pages(parsed, thread_id)
+            parser.parse_thread_page(thread_id, page_num, parsed)
+
+        document = time_calls(lambda: parser.parse_document(content), repeat)
+        extract = time_calls(lambda: parser.extract_number_of_pages(soup, thread_id), repeat)
+        rows = time_calls(lambda: parser.parse_thread_page(thread_id, page_num, soup), repeat)
+        page = time_calls(parse_page, repeat)
+        pages[name] = {
+            'posts': posts,
+            'bytes': len(content),
+            'parse_document_ms': document * 1e3,
+            'extract_number_of_pages_us': extract * 1e6,
+            'parse_thread_page_ms': rows * 1e3,
+            'page_ms': page * 1e3,
+            'us_per_post': page * 1e6 / max(posts, 1),
+            'peak_memory_mb': peak_memory(parse_page),
+        }
+        total_seconds += page
+        total_posts += posts
+    return {
+        'pages_per_sec': len(corpus) / total_seconds,
+        'us_per_post': total_seconds * 1e6 / max(total_posts, 1),
+        'peak_memory_mb': max(page['peak_memory_mb'] for page in pages.values()),
+        'pages': pages,
+    }
+
+
+def bench_database(corpus, post_target):
+    """Time the buffered writer storing copies of the corpus rows in a throwaway schema
+
+    Needs the Postgres server from config. Returns None if it can't be reached.
+    """
+    from database import Database
+    parser = make_parser()
+    parsed = [parser.parse_thread_page(thread_id, page_num, parser.parse_document(content))
+              for _, thread_id, page_num, content in corpus]
+    schema = f"bench_{os.getpid()}"
+    try:
+        admin = Database()
+    except Exception as e:
+        print(f"Skipping database benchmark, no database: {e}", file=sys.stderr)
+        return None
+    db = None
+    conn, cursor = admin.checkout()
+    try:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        # Every connection of the benchmark's pool uses the scratch schema
+        db = Database(options=f"-c search_path={schema}")
+        db.create_tables()
+
+        # Copies of the corpus pages under new thread and post ids, each copy on its own thread
+        pages = []
+        copy = 0
+        while sum(len(rows[2]) for rows in pages) < post_target:
+            copy += 1
+            offset = copy * 10 ** 7
+            for thread_row, user_rows, post_rows in parsed:
+                thread_id = post_rows[0][4] + offset
+                pages.append((
+                    (thread_id,) + thread_row[1:] if thread_row else (thread_id, 'benchmark', None, None),
+                    user_rows,
+                    [(post_row[0] + offset,) + post_row[1:4] + (thread_id,) + post_row[5:] for post_row in post_rows],
+                ))
+
+        def write_pages():
+            for thread_row, user_rows, post_rows in pages:
+                db.insert_page(thread_row, user_rows, post_rows, (thread_row[0], 1, post_rows[-1][0], len(post_rows), True))
+            db.flush()
+
+        rows = sum(1 + 2 * len(post_rows) + 1 for _, _, post_rows in pages)
+        posts = sum(len(post_rows) for _, _, post_rows in pages)
+        first_write = time_calls(write_pages, 1)
+        # Writing the same rows again is what a recrawl of unchanged threads does
+        rewrite = time_calls(write_pages, 1)
+        return {
+            'posts': posts,
+            'rows': rows,
+            'insert_rows_per_sec': rows / first_write,
+            'insert_posts_per_sec': posts / first_write,
+            'rewrite_rows_per_sec': rows / rewrite,
+            'rewrite_posts_per_sec': posts / rewrite,
+        }
+    finally:
+        if db is not None:
+            db.close()
+            db.pool.close()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        admin.release(conn, cursor)
+
+
+def git_commit():
+    """Return the current git commit, if the benchmark runs from a checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    """Flatten nested results into {'a.b.c': number}"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results, baseline, threshold):
+    """Print how each timing changed against a baseline run, returning the number of regressions"""
+    current = flatten(results)
+    previous = flatten(baseline)
+    regressions = 0
+    for key in sorted(current.keys() & previous.keys()):
+        if key.endswith(('_per_sec', '_ms', '_us', '_mb', 'us_per_post')) and previous[key]:
+            change = (current[key] - previous[key]) / previous[key] * 100
+            # Throughput should go up, everything else (time, memory) down
+            worse = -change if key.endswith('_per_sec') else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f"{key:<70} {previous[key]:>12.2f} -> {current[key]:>12.2f} ({change:+.1f}%){flag}")
+    return regressions
+
+
+def print_summary(results):
+    """Print the headline numbers of a run"""
+    for engine, parsing in results['parsing'].items():
+        print(f"{engine}: {parsing['pages_per_sec']:.0f} pages/sec, {parsing['us_per_post']:.0f} µs/post, "
+              f"peak {parsing['peak_memory_mb']:.1f} MB")
+        for name, page in parsing['pages'].items():
+            print(f"  {name:<28} {page['page_ms']:8.2f} ms/page  {page['us_per_post']:8.0f} µs/post  "
+                  f"extract_number_of_pages {page['extract_number_of_pages_us']:8.0f} µs")
+    if results['database']:
+        database = results['database']
+        print(f"database: {database['insert_rows_per_sec']:.0f} rows/sec inserting, "
+              f"{database['rewrite_rows_per_sec']:.0f} rows/sec rewriting unchanged rows "
+              f"({database['posts']} posts)")
+    print(f"max RSS: {results['max_rss_mb']:.1f} MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark parsing and database writes on the checked-in page corpus")
+    parser.add_argument('--engines', nargs='+', default=['lxml', 'bs4'], choices=['lxml', 'bs4'],
+                        help="parser engines to benchmark")
+    parser.add_argument('--repeat', type=int, default=20, help="timed runs per measurement, the median is kept")
+    parser.add_argument('--db-posts', type=int, default=20000, help="posts written by the database benchmark")
+    parser.add_argument('--no-db', action='store_true', help="skip the database benchmark")
+    parser.add_argument('--output', help="where to save the results (default benchmarks/results/<time>.json)")
+    parser.add_argument('--compare', metavar='BASELINE', help="results file of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="percentage by which a number must get worse to count as a regression")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    corpus = load_corpus()
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'parsing': {engine: bench_parsing(engine, corpus, args.repeat) for engine in args.engines},
+        'database': None if args.no_db else bench_database(corpus, args.db_posts),
+    }
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['max_rss_mb'] = max_rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    print_summary(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        print(f"{regressions} regressions over {args.threshold:g}%")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,19 +9,170 @@ DB_PORT = os.getenv('DB_PORT', '5432')
 DB_NAME = os.getenv('DB_NAME', 'forum_scraper')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
+# Rows are buffered and written in one transaction per batch
+DB_BATCH_SIZE = 500  # flush after this many rows
+DB_FLUSH_INTERVAL = 5  # or after this many seconds
+# Users whose statistics haven't changed since they were last written are not written again
+USER_CACHE_SIZE = 100000  # most recently seen users remembered, 0 to write every user row
+# Connections are shared by all threads of a process through a pool, checked out per batch or query
+DB_POOL_SIZE = 8  # at most this many connections per process
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection before giving up
+DB_POOL_CHECK_SECONDS = 30  # connections idle longer than this are checked before they are reused
 
 # Scraper configuration
 BASE_URL = "https://gendercriticalresources.com/Support"
 THREAD_URL_TEMPLATE = BASE_URL + "/showthread.php?tid={tid}&page={page}"
+PRINT_THREAD_URL_TEMPLATE = BASE_URL + "/printthread.php?tid={tid}&page={page}"
+INDEX_URL = BASE_URL + "/index.php"
+FORUM_URL_TEMPLATE = BASE_URL + "/forumdisplay.php?fid={fid}&page={page}"
 # Starting thread ID and ending thread ID
+# (not used with --discover, which finds the thread IDs from the board listings)
 START_TID = 1
 END_TID = 1000  # Adjust as needed
 
+# Shared crawl queue ("enqueue" adds jobs, any number of "worker" processes claim them).
+# Leases are extended every JOB_HEARTBEAT_SECONDS; jobs of a worker that stops heart-beating
+# are claimed again once their lease expires, and threads that failed or were only partly
+# scraped are retried, up to JOB_MAX_ATTEMPTS attempts in all.
+JOB_BATCH_SIZE = 25
+JOB_LEASE_SECONDS = 300
+JOB_HEARTBEAT_SECONDS = 30
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_SECONDS = 30  # how often an idle worker checks for expired leases of other workers
+
 # Rate limiting
 DELAY_BETWEEN_REQUESTS = 1  # seconds
 MAX_RETRIES = 3
 TIMEOUT = 30
 
+# Negative cache: threads whose page 1 was missing or failed are skipped on later runs
+# until the TTL for the outcome expires (hours)
+MISS_TTL_HOURS = {
+    'not_found': 24 * 30,  # "not found" error page, HTTP 404 or 410
+    'no_posts': 24 * 7,  # page 1 had no thread title or no valid posts
+    'forbidden': 24,  # HTTP 401/403 or the forum's no-permission page
+    'http_error': 6,  # other HTTP errors and network failures
+}
+# Lower-cased text of the forum's no-permission error page
+NO_PERMISSION_TEXT = 'you do not have permission to access this page'
+
+# Print view mode: read posts from printthread.php (one request for the whole thread)
+# and only fetch the paginated pages needed for author statistics.
+# Falls back to the paginated pages when the print view has no parseable posts,
+# so PRINT_POST_SELECTOR must match post elements carrying post_N ids and post_body divs.
+PRINT_VIEW = False
+PRINT_POST_SELECTOR = 'div[id^="post_"]'
+
+# HTML extraction engine: 'lxml' (fast, single pass) or 'bs4' (the original BeautifulSoup code).
+# "python3 run_scraper.py parity" checks that both produce the same rows for the archived pages.
+PARSER_ENGINE = 'lxml'
+
+# Raw page archive: every fetched page is kept zstd-compressed so the database
+# can be rebuilt offline with "python3 run_scraper.py reparse"
+ARCHIVE_PAGES = True
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_ZSTD_LEVEL = 6
+REPARSE_WORKERS = os.cpu_count() or 1
+
+# Concurrent fetching (used by scrape_range instead of the fixed delays above)
+CONCURRENT_FETCH = True
+MAX_CONCURRENCY = 8  # requests in flight overall
+MAX_CONCURRENCY_PER_HOST = 4  # requests in flight per host
+REQUESTS_PER_SECOND = 2  # starting politeness budget shared by all requests
+
+# Adaptive rate limiting: the request rate grows by about RATE_INCREASE requests/sec per second
+# of healthy responses and is multiplied by RATE_DECREASE_FACTOR on 429/5xx responses or when
+# latency rises above LATENCY_BACKOFF_FACTOR times its baseline. Retry-After is always honoured.
+ADAPTIVE_RATE = True
+MIN_REQUESTS_PER_SECOND = 0.2
+MAX_REQUESTS_PER_SECOND = 10
+RATE_INCREASE = 0.05
+RATE_DECREASE_FACTOR = 0.5
+LATENCY_BACKOFF_FACTOR = 2.0
+RATE_REPORT_INTERVAL = 60  # seconds between logging the current rate, 0 to disable
+
+# Staged scraping pipeline (concurrent paginated scraping): fetched pages are parsed into rows
+# by PARSE_WORKERS processes and written by a single writer. At most PIPELINE_QUEUE_SIZE pages
+# are held from the time they are fetched until they are written.
+PIPELINE = True
+PARSE_WORKERS = os.cpu_count() or 1
+PIPELINE_QUEUE_SIZE = 64
+
+# Activity-weighted recrawl scheduling ("python3 run_scraper.py refresh --scheduled").
+# A thread's expected posts per day is its post rate over the activity window plus a recency
+# term that halves every SCHEDULE_RECENCY_HALF_LIFE_DAYS since its last post. It is due again
+# once SCHEDULE_POSTS_PER_REFRESH new posts are expected, within the interval bounds.
+SCHEDULE_ACTIVITY_WINDOW_DAYS = 30
+SCHEDULE_RECENCY_HALF_LIFE_DAYS = 7
+SCHEDULE_POSTS_PER_REFRESH = 5
+SCHEDULE_MIN_INTERVAL_HOURS = 1
+SCHEDULE_MAX_INTERVAL_HOURS = 24 * 60
+# Budget of a scheduled refresh run, None for no limit
+SCHEDULE_MAX_REQUESTS = 1000
+SCHEDULE_MAX_MINUTES = None
+
+# Logging: LOG_FORMAT 'text' or 'json' (one JSON object per line), to stdout unless LOG_FILE is set.
+# Per-page and per-post details are logged at DEBUG.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_FILE = os.getenv('LOG_FILE')
+
+# Metrics (latency histograms, HTTP statuses, bytes, retries, rows written, queue depths):
+# served in the Prometheus text format at http://localhost:METRICS_PORT/metrics (and as JSON
+# at /metrics.json) and/or written as JSON to METRICS_FILE every METRICS_INTERVAL seconds.
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) or None  # e.g. 9108
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_INTERVAL = 15
+
+# Profiling ("python3 run_scraper.py --profile"): for the first PROFILE_SECONDS of the run, stacks
+# are sampled every PROFILE_INTERVAL seconds and a tracemalloc snapshot is taken every
+# PROFILE_SNAPSHOT_INTERVAL seconds, in the main process and in each parse worker.
+# Collapsed stacks, a per-stage summary and the top allocations are written to PROFILE_DIR.
+PROFILE_DIR = 'profiles'
+PROFILE_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+PROFILE_SNAPSHOT_INTERVAL = 1
+PROFILE_TRACEMALLOC_FRAMES = 16
+
+# Bulk export ("python3 run_scraper.py export"): users, threads and posts are streamed from
+# server-side cursors EXPORT_CHUNK_ROWS rows at a time into EXPORT_DIR, as Parquet files or
+# gzip-compressed JSON lines, with threads and posts partitioned by 'board' or 'month'.
+# With --incremental only rows written since the last export to the same directory are exported.
+EXPORT_DIR = 'exports'
+EXPORT_FORMAT = 'parquet'  # or 'jsonl'
+EXPORT_PARTITION = 'board'  # 'month', or None for one file per table
+EXPORT_CHUNK_ROWS = 10000
+EXPORT_GZIP_LEVEL = 6
+
+# Full-text search ("python3 run_scraper.py search <words>"): posts get a tsvector of their text,
+# built with the SEARCH_CONFIG text search configuration when they are written. Posts stored
+# before that get theirs SEARCH_BACKFILL_BATCH at a time by a background thread during scraping
+# (SEARCH_BACKGROUND_INDEX) or by "python3 run_scraper.py search-index", which then create the
+# GIN index, and the trigram index for --substring searches if SEARCH_TRIGRAM_INDEX (needs pg_trgm).
+SEARCH_CONFIG = 'english'
+SEARCH_BACKGROUND_INDEX = True
+SEARCH_BACKFILL_BATCH = 2000
+SEARCH_TRIGRAM_INDEX = False
+SEARCH_LIMIT = 20
+
+# Thread IDs per partition when "python3 run_scraper.py partition-posts" moves the posts into a
+# table range-partitioned by thread ID. Fixed once the posts are partitioned.
+POSTS_PARTITION_SIZE = 10000
+
+# Attachments and inline images of posts: with MEDIA_DOWNLOAD the attachment.php links and <img>
+# tags (other than smilies) of every scraped post are recorded in post_media and downloaded by a
+# background thread under the same rate limit as pages, or later by "python3 run_scraper.py media".
+# Files are streamed to MEDIA_DIR/objects/ab/<sha256>, so identical files are stored once.
+MEDIA_DOWNLOAD = False
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MEDIA_CONCURRENCY = 2  # downloads in flight
+MEDIA_BATCH_SIZE = 100  # URLs taken from post_media at a time
+MEDIA_MAX_BYTES = 50 * 1024 * 1024  # larger files are recorded as too_large and not kept
+MEDIA_MAX_ATTEMPTS = 3  # fetches that fail after MAX_RETRIES before a URL is given up
+MEDIA_TIMEOUT = 300  # seconds for one download, body included
+MEDIA_CHUNK_BYTES = 64 * 1024
+MEDIA_POLL_SECONDS = 5  # how often the background thread looks for new URLs while scraping
+
 # User agent to mimic a browser
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
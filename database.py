@@ -1,38 +1,382 @@
+import atexit
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
 import psycopg2
+import psycopg2.pool
 from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
 import config
+import reply_graph
+from metrics import metrics, timed
+
+logger = logging.getLogger(__name__)
+
+def post_hash(post_row):
+    """Return the content hash of a post row (post_id, post_date, post_text, username, thread_id, replies_to)"""
+    return blake2b(repr(tuple(post_row[1:6])).encode('utf-8'), digest_size=16).digest()
+
+
+class UserCache:
+    """Bounded LRU of the (num_posts, num_threads, joined_date) last written for each username"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def needs_write(self, user_row):
+        """Return True if a user row differs from the one last written, remembering it if so"""
+        username, values = user_row[0], user_row[1:]
+        if self.entries.get(username) == values:
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return False
+        self.misses += 1
+        if self.max_size > 0:
+            self.entries[username] = values
+            self.entries.move_to_end(username)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return True
+
+    def forget(self, username):
+        """Drop a user whose write failed, so it is written again next time"""
+        self.entries.pop(username, None)
+
+    def stats(self):
+        """Return a one-line summary of the cache hit rate"""
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (f"User cache: {self.hits} hits, {self.misses} misses "
+                f"({rate:.0%} of user writes avoided), {len(self.entries)} users cached")
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """No pooled connection became free within DB_POOL_TIMEOUT"""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of autocommit connections to the configured database
+    
+    At most max_size connections are open at once; getconn() waits up to timeout seconds
+    for one to be returned when they are all checked out. Connections are opened on demand
+    and reused most recently returned first. One the server closed, or that sat idle longer
+    than check_after seconds, is checked with a trivial query before it is handed out, and
+    one found broken, then or when it is returned, is closed and replaced, so a server
+    restart or an idle timeout costs a reconnect instead of a failed query.
+    """
+    
+    def __init__(self, options=None, max_size=None, timeout=None, check_after=None):
+        self.options = options
+        self.max_size = max_size or config.DB_POOL_SIZE
+        self.timeout = timeout or config.DB_POOL_TIMEOUT
+        self.check_after = check_after if check_after is not None else config.DB_POOL_CHECK_SECONDS
+        self.slots = threading.BoundedSemaphore(self.max_size)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.idle = []
+        self.in_use = set()
+        # Names of the statements prepared on each connection, by id(connection)
+        self.prepared = {}
+    
+    def connect(self):
+        conn = psycopg2.connect(
+            host=config.DB_HOST,
+            port=config.DB_PORT,
+            database=config.DB_NAME,
+            user=config.DB_USER,
+            password=config.DB_PASSWORD,
+            options=self.options
+        )
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        logger.debug("Opened database connection %s", conn.info.backend_pid)
+        return conn
+    
+    def getconn(self):
+        """Check a connection out, opening one if none is idle"""
+        started = time.perf_counter()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"all {self.max_size} database connections stayed in use for {self.timeout}s")
+        try:
+            conn = self.take_idle() or self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.in_use.add(conn)
+        metrics.observe('scraper_db_pool_wait_seconds', time.perf_counter() - started)
+        self.report()
+        return conn
+    
+    def take_idle(self):
+        """Return the most recently returned idle connection that still works, or None"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                conn, returned_at = self.idle.pop()
+            # An idle connection has nothing to read unless the server closed it
+            if (not conn.closed and time.monotonic() - returned_at < self.check_after
+                    and not select.select([conn], [], [], 0)[0]):
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                return conn
+            except psycopg2.Error as e:
+                logger.info("Replacing broken database connection: %s", e)
+                metrics.inc('scraper_db_reconnects_total')
+                self.discard(conn)
+    
+    def putconn(self, conn):
+        """Return a checked out connection, closing it if it broke while in use"""
+        with self.lock:
+            self.in_use.discard(conn)
+        try:
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if not conn.closed and not conn.autocommit:
+                conn.autocommit = True
+        except psycopg2.Error as e:
+            logger.info("Closing database connection that failed to reset: %s", e)
+        if conn.closed:
+            metrics.inc('scraper_db_reconnects_total')
+            self.discard(conn)
+        elif self.closed:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+        self.slots.release()
+        self.report()
+    
+    def discard(self, conn):
+        with self.lock:
+            self.prepared.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    def prepared_statements(self, conn):
+        """Return the set of statement names prepared on a connection, to be added to"""
+        with self.lock:
+            return self.prepared.setdefault(id(conn), set())
+    
+    def backend_pids(self):
+        """Return the server process IDs of the pool's open connections"""
+        with self.lock:
+            conns = [conn for conn, _ in self.idle] + list(self.in_use)
+        return [conn.info.backend_pid for conn in conns if not conn.closed]
+    
+    def report(self):
+        with self.lock:
+            idle, in_use = len(self.idle), len(self.in_use)
+        metrics.set('scraper_db_pool_connections', idle, state='idle')
+        metrics.set('scraper_db_pool_connections', in_use, state='in_use')
+    
+    def close(self):
+        """Close the idle connections; checked out ones are closed when they are returned"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.closed = True
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+# One pool per process and connection options: a forked child must not use its parent's connections
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(options=None):
+    """Return this process's connection pool for options (libpq command-line options such as a search_path)"""
+    key = (os.getpid(), options)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(options)
+        return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = [pool for (pid, _), pool in _pools.items() if pid == os.getpid()]
+    for pool in pools:
+        pool.close()
+
 
 class Database:
-    def __init__(self):
-        self.conn = None
+    """Buffered writer and queries over the pooled connections of a process
+    
+    Safe to share between threads: rows are buffered under a lock, and every query or batch
+    checks a connection out of the pool for its own duration, so Database objects on several
+    threads write at once over at most DB_POOL_SIZE connections. options are libpq
+    command-line options for the connections, such as a search_path.
+    """
+    
+    def __init__(self, batch_size=None, flush_interval=None, options=None):
+        self.pool = get_pool(options)
+        self.batch_size = batch_size or config.DB_BATCH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else config.DB_FLUSH_INTERVAL
+        self.buffers = {'users': {}, 'threads': {}, 'posts': {}, 'thread_crawl_state': {}}
+        self.buffered_rows = 0
+        self.last_flush = time.monotonic()
+        self.user_cache = UserCache(config.USER_CACHE_SIZE)
+        self.post_counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        # Guards the buffers and counts; flushes of one object run one at a time
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        # Rows taken by the flush in progress, until they are committed
+        self.flushing = None
+        self.active = set()
+        self.export_conn = None
+        self.closed = False
+        # Started with the first buffered row, so rows are flushed on time even if no more arrive
+        self.flusher = None
+        self.stopped = threading.Event()
         self.connect()
         
     def connect(self):
-        """Establish a connection to the database"""
-        try:
-            self.conn = psycopg2.connect(
-                host=config.DB_HOST,
-                port=config.DB_PORT,
-                database=config.DB_NAME,
-                user=config.DB_USER,
-                password=config.DB_PASSWORD
-            )
-            self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            print("Connected to database successfully")
+        """Check that the database can be reached and read how its posts are stored"""
+        try:
+            self.read_posts_partitioning()
+            logger.info("Connected to database successfully")
         except Exception as e:
-            print(f"Error connecting to database: {e}")
+            logger.error("Error connecting to database: %s", e)
             raise
     
-    def create_tables(self):
-        """Create the necessary tables if they don't exist"""
+    def checkout(self):
+        """Check a connection out of the pool for one query or transaction, returning (connection, cursor)"""
+        conn = self.pool.getconn()
+        with self.lock:
+            self.active.add(conn)
+        return conn, conn.cursor()
+    
+    def release(self, conn, cursor=None):
+        """Close cursor and return conn to the pool"""
+        if cursor is not None and not conn.closed:
+            cursor.close()
+        with self.lock:
+            self.active.discard(conn)
+        self.pool.putconn(conn)
+    
+    def cancel(self):
+        """Cancel the queries running on the connections this object has checked out"""
+        with self.lock:
+            conns = list(self.active)
+        for conn in conns:
+            conn.cancel()
+    
+    # Schema steps in order; schema_version records how many of them were applied
+    SCHEMA_STEPS = ('create_base_tables', 'create_reply_graph', 'create_secondary_indexes', 'create_post_media')
+    # (name, table, definition) of the secondary indexes, built concurrently once the tables exist
+    SECONDARY_INDEXES = (
+        ('posts_thread_id_idx', 'posts', "(thread_id)"),
+        ('posts_username_idx', 'posts', "(username)"),
+        ('posts_replies_to_idx', 'posts', "(replies_to) WHERE replies_to IS NOT NULL"),
+        ('posts_post_date_idx', 'posts', "(post_date)"),
+        ('posts_updated_at_idx', 'posts', "(updated_at)"),
+        ('threads_updated_at_idx', 'threads', "(updated_at)"),
+        ('users_updated_at_idx', 'users', "(updated_at)"),
+    )
+    # Full-text search indexes, built by SearchIndexer once every post has its search vector
+    SEARCH_INDEXES = (
+        ('posts_search_idx', 'posts', "USING gin (search_vector)"),
+        ('posts_text_trgm_idx', 'posts', "USING gin (post_text gin_trgm_ops)"),
+    )
+    
+    def create_tables(self, defer_indexes=False):
+        """Bring the schema up to date, running only the steps schema_version doesn't record yet
+        
+        With defer_indexes the secondary indexes are left for a later call, so that a bulk
+        load into a new database doesn't maintain them row by row.
+        """
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                singleton BOOLEAN PRIMARY KEY DEFAULT true CHECK (singleton),
+                version INTEGER NOT NULL,
+                posts_partitioned_by VARCHAR(32),
+                posts_partition_size INTEGER,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """)
+            cursor.execute("SELECT version FROM schema_version")
+            row = cursor.fetchone()
+            version = row[0] if row else 0
+        finally:
+            self.release(conn, cursor)
+        
+        for number, step in enumerate(self.SCHEMA_STEPS, 1):
+            if number <= version:
+                continue
+            if defer_indexes and step == 'create_secondary_indexes':
+                logger.info("Secondary indexes deferred until after the bulk load")
+                break
+            logger.info("Updating the schema to version %s (%s)", number, step)
+            if not getattr(self, step)():
+                logger.error("Schema step %s failed, it is retried on the next start", step)
+                break
+            self.set_schema_version(number)
+        
+        if self.posts_partitioned_by:
+            self.create_post_partitions()
+    
+    def set_schema_version(self, version):
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            INSERT INTO schema_version (version) VALUES (%s)
+            ON CONFLICT (singleton) DO UPDATE SET
+                version = greatest(schema_version.version, EXCLUDED.version),
+                updated_at = now()
+            """, (version,))
+        finally:
+            self.release(conn, cursor)
+    
+    def read_posts_partitioning(self):
+        """Read how posts is partitioned from schema_version, and pick the post upsert to match"""
+        self.posts_partitioned_by = None
+        self.posts_partition_size = None
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if cursor.fetchone()[0]:
+                cursor.execute("SELECT posts_partitioned_by, posts_partition_size FROM schema_version")
+                self.posts_partitioned_by, self.posts_partition_size = cursor.fetchone() or (None, None)
+        finally:
+            self.release(conn, cursor)
+        if self.posts_partitioned_by:
+            # Unique keys of a partitioned table include its partition key, and its RETURNING can't
+            # read xmax; the statement's snapshot doesn't see the rows it inserts
+            posts_query = self.UPSERT_QUERIES['posts'].format(
+                conflict_key='post_id, thread_id',
+                inserted='NOT EXISTS (SELECT 1 FROM posts AS stored '
+                         'WHERE stored.post_id = posts.post_id AND stored.thread_id = posts.thread_id)')
+        else:
+            posts_query = self.UPSERT_QUERIES['posts'].format(conflict_key='post_id', inserted='(xmax = 0)')
+        self.upsert_queries = dict(self.UPSERT_QUERIES, posts=posts_query)
+    
+    def create_base_tables(self):
+        """Schema step 1: the tables and columns from before the schema was versioned"""
         create_tables_queries = [
             """
             CREATE TABLE IF NOT EXISTS users (
                 username VARCHAR(255) PRIMARY KEY,
                 num_posts INTEGER,
                 num_threads INTEGER,
-                joined_date TIMESTAMP
+                joined_date TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
             )
             """,
             """
@@ -40,7 +384,63 @@ class Database:
                 thread_id INTEGER PRIMARY KEY,
                 thread_title VARCHAR(500),
                 board_name VARCHAR(255),
-                date_posted TIMESTAMP
+                date_posted TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS thread_listing (
+                thread_id INTEGER PRIMARY KEY,
+                forum_id INTEGER,
+                replies INTEGER,
+                last_post_date TIMESTAMP,
+                discovered_at TIMESTAMP DEFAULT now()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS thread_crawl_state (
+                thread_id INTEGER PRIMARY KEY,
+                last_page INTEGER,
+                max_post_id INTEGER,
+                post_count INTEGER,
+                complete BOOLEAN NOT NULL DEFAULT true,
+                last_crawled TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS crawl_schedule (
+                thread_id INTEGER PRIMARY KEY,
+                priority DOUBLE PRECISION NOT NULL,
+                posts_per_day DOUBLE PRECISION NOT NULL,
+                interval_hours DOUBLE PRECISION NOT NULL,
+                next_crawl TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS crawl_schedule_priority_idx ON crawl_schedule (priority DESC)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS crawl_jobs (
+                thread_id INTEGER PRIMARY KEY,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                worker VARCHAR(255),
+                lease_expires TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS crawl_jobs_claim_idx ON crawl_jobs (status, thread_id)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS crawl_misses (
+                thread_id INTEGER PRIMARY KEY,
+                outcome VARCHAR(32) NOT NULL,
+                http_status INTEGER,
+                last_checked TIMESTAMP NOT NULL DEFAULT now(),
+                attempts INTEGER NOT NULL DEFAULT 1
             )
             """,
             """
@@ -50,137 +450,1316 @@ class Database:
                 post_text TEXT,
                 username VARCHAR(255) REFERENCES users(username),
                 thread_id INTEGER REFERENCES threads(thread_id),
-                replies_to INTEGER
+                replies_to INTEGER,
+                content_hash BYTEA,
+                updated_at TIMESTAMP NOT NULL DEFAULT now(),
+                search_vector TSVECTOR
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS export_watermarks (
+                table_name VARCHAR(64) NOT NULL,
+                destination TEXT NOT NULL,
+                exported_until TIMESTAMP NOT NULL,
+                exported_at TIMESTAMP NOT NULL DEFAULT now(),
+                PRIMARY KEY (table_name, destination)
             )
             """
         ]
         
-        cursor = self.conn.cursor()
-        for query in create_tables_queries:
+        conn, cursor = self.checkout()
+        try:
+            for query in create_tables_queries:
+                try:
+                    cursor.execute(query)
+                    logger.debug("Table created or already exists")
+                except Exception as e:
+                    logger.error("Error creating table: %s", e)
+                    conn.rollback()
+                    raise
+            
+            # Crawl state written before page checkpoints existed was only saved for finished threads
             try:
-                cursor.execute(query)
-                print("Table created or already exists")
+                cursor.execute("ALTER TABLE thread_crawl_state ADD COLUMN IF NOT EXISTS complete BOOLEAN NOT NULL DEFAULT true")
             except Exception as e:
-                print(f"Error creating table: {e}")
-                self.conn.rollback()
-                raise
+                logger.error("Error adding complete column to thread_crawl_state: %s", e)
+            
+            # Posts stored before content hashes existed get theirs the next time they are written
+            try:
+                cursor.execute("ALTER TABLE posts ADD COLUMN IF NOT EXISTS content_hash BYTEA")
+            except Exception as e:
+                logger.error("Error adding content_hash column to posts: %s", e)
+            
+            # Posts stored before full-text search existed get their vectors from SearchIndexer
+            try:
+                cursor.execute("ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector TSVECTOR")
+            except Exception as e:
+                logger.error("Error adding search_vector column to posts: %s", e)
+            
+            # Rows stored before exports existed count as written when the column is added
+            for table in ('users', 'threads', 'posts'):
+                try:
+                    cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()")
+                                   .format(sql.Identifier(table)))
+                except Exception as e:
+                    logger.error("Error adding updated_at column to %s: %s", table, e)
+            
+            # Add the replies_to column if it doesn't exist (for existing tables)
+            try:
+                cursor.execute("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name='posts' and column_name='replies_to'
+                """)
+                if not cursor.fetchone():
+                    cursor.execute("ALTER TABLE posts ADD COLUMN replies_to INTEGER")
+                    logger.info("Added replies_to column to posts table")
+            except Exception as e:
+                logger.error("Error checking/adding replies_to column: %s", e)
+                conn.rollback()
+            
+            # Try to drop any existing foreign key constraint on replies_to
+            try:
+                # Find the constraint name for foreign key on replies_to column
+                cursor.execute("""
+                    SELECT tc.constraint_name
+                    FROM information_schema.table_constraints AS tc
+                    JOIN information_schema.key_column_usage AS kcu
+                      ON tc.constraint_name = kcu.constraint_name
+                    WHERE tc.table_name = 'posts'
+                      AND tc.constraint_type = 'FOREIGN KEY'
+                      AND kcu.column_name = 'replies_to'
+                """)
+                constraint = cursor.fetchone()
+                if constraint:
+                    constraint_name = constraint[0]
+                    # Use the constraint name to drop it
+                    drop_query = sql.SQL("ALTER TABLE posts DROP CONSTRAINT {}").format(
+                        sql.Identifier(constraint_name)
+                    )
+                    cursor.execute(drop_query)
+                    logger.info("Dropped foreign key constraint %s on replies_to", constraint_name)
+            except Exception as e:
+                logger.error("Error dropping foreign key constraint on replies_to (may not exist): %s", e)
+                conn.rollback()
+            return True
+        finally:
+            self.release(conn, cursor)
+    
+    def create_reply_graph(self):
+        """Schema step 2: the reply graph and thread statistics tables and the triggers maintaining them
         
-        # Add the replies_to column if it doesn't exist (for existing tables)
+        When the triggers don't exist yet, the tables are built from the stored posts first,
+        with writes to posts held off until the triggers are in place.
+        """
+        conn, cursor = self.checkout()
+        try:
+            for query in reply_graph.TABLES + reply_graph.FUNCTIONS:
+                cursor.execute(query)
+            if self.count_reply_graph_triggers(cursor) == len(reply_graph.TRIGGER_NAMES):
+                return True
+            started = time.monotonic()
+            conn.autocommit = False
+            cursor.execute("LOCK TABLE posts IN SHARE ROW EXCLUSIVE MODE")
+            # Another process may have built them while this one waited for the lock
+            if self.count_reply_graph_triggers(cursor) < len(reply_graph.TRIGGER_NAMES):
+                for name in reply_graph.TRIGGER_NAMES:
+                    cursor.execute(sql.SQL("DROP TRIGGER IF EXISTS {} ON posts").format(sql.Identifier(name)))
+                for query in reply_graph.REBUILD + reply_graph.TRIGGERS:
+                    cursor.execute(query)
+                logger.info("Built the reply graph and thread statistics in %.1fs", time.monotonic() - started)
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error("Error creating the reply graph: %s", e)
+            conn.rollback()
+            return False
+        finally:
+            self.release(conn, cursor)
+    
+    def count_reply_graph_triggers(self, cursor):
+        cursor.execute("SELECT count(*) FROM pg_trigger WHERE tgrelid = 'posts'::regclass AND tgname = ANY(%s)",
+                       (list(reply_graph.TRIGGER_NAMES),))
+        return cursor.fetchone()[0]
+    
+    def create_secondary_indexes(self):
+        """Schema step 3: index posts by thread, author, quoted post and date, and the exported tables by update time"""
+        created = [self.create_index_concurrently(name, table, definition)
+                   for name, table, definition in self.SECONDARY_INDEXES]
+        return all(created)
+    
+    def create_post_media(self):
+        """Schema step 4: the attachments and images linked from posts, and how their download went"""
+        conn, cursor = self.checkout()
         try:
             cursor.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='posts' and column_name='replies_to'
+            CREATE TABLE IF NOT EXISTS post_media (
+                post_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                http_status INTEGER,
+                sha256 CHAR(64),
+                content_type VARCHAR(255),
+                size BIGINT,
+                fetched_at TIMESTAMP,
+                PRIMARY KEY (post_id, url)
+            )
             """)
-            if not cursor.fetchone():
-                cursor.execute("ALTER TABLE posts ADD COLUMN replies_to INTEGER")
-                print("Added replies_to column to posts table")
+            cursor.execute("CREATE INDEX IF NOT EXISTS post_media_url_idx ON post_media (url)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS post_media_pending_idx ON post_media (attempts, url) "
+                           "WHERE status = 'pending'")
+            return True
         except Exception as e:
-            print(f"Error checking/adding replies_to column: {e}")
-            self.conn.rollback()
+            logger.error("Error creating the post_media table: %s", e)
+            return False
+        finally:
+            self.release(conn, cursor)
+    
+    # Posts partitioned by thread ID: the primary key includes the partition key
+    PARTITIONED_POSTS_TABLE = """
+    CREATE TABLE posts_partitioned (
+        post_id INTEGER NOT NULL,
+        post_date TIMESTAMP,
+        post_text TEXT,
+        username VARCHAR(255) REFERENCES users(username),
+        thread_id INTEGER NOT NULL REFERENCES threads(thread_id),
+        replies_to INTEGER,
+        content_hash BYTEA,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        search_vector TSVECTOR,
+        PRIMARY KEY (post_id, thread_id)
+    ) PARTITION BY RANGE (thread_id)
+    """
+    POST_COLUMNS = "post_id, post_date, post_text, username, thread_id, replies_to, content_hash, updated_at, search_vector"
+    
+    def partition_posts(self, partition_size):
+        """Move posts into a table range-partitioned by thread_id, partition_size thread IDs per partition
         
-        # Try to drop any existing foreign key constraint on replies_to
+        Runs in one transaction holding an exclusive lock on posts, so it refuses to start while
+        other sessions are connected. The old table is kept as posts_unpartitioned. Returns True
+        if posts is partitioned afterwards.
+        """
+        if self.posts_partitioned_by:
+            logger.info("Posts are already partitioned by %s", self.posts_partitioned_by)
+            return True
+        conn, cursor = self.checkout()
         try:
-            # Find the constraint name for foreign key on replies_to column
+            # This process's own idle pooled connections don't count
             cursor.execute("""
-                SELECT tc.constraint_name
-                FROM information_schema.table_constraints AS tc
-                JOIN information_schema.key_column_usage AS kcu
-                  ON tc.constraint_name = kcu.constraint_name
-                WHERE tc.table_name = 'posts'
-                  AND tc.constraint_type = 'FOREIGN KEY'
-                  AND kcu.column_name = 'replies_to'
-            """)
-            constraint = cursor.fetchone()
-            if constraint:
-                constraint_name = constraint[0]
-                # Use the constraint name to drop it
-                drop_query = sql.SQL("ALTER TABLE posts DROP CONSTRAINT {}").format(
-                    sql.Identifier(constraint_name)
-                )
-                cursor.execute(drop_query)
-                print(f"Dropped foreign key constraint {constraint_name} on replies_to")
+            SELECT count(*) FROM pg_stat_activity
+            WHERE datname = current_database() AND pid <> ALL(%s) AND backend_type = 'client backend'
+            """, (self.pool.backend_pids(),))
+            sessions = cursor.fetchone()[0]
+            if sessions:
+                logger.error("%s other sessions are connected to the database; stop the scrapers before partitioning posts",
+                             sessions)
+                return False
+            cursor.execute("SELECT to_regclass('posts_unpartitioned') IS NOT NULL")
+            if cursor.fetchone()[0]:
+                logger.error("posts_unpartitioned exists from an earlier migration; drop it before partitioning posts")
+                return False
+            
+            started = time.monotonic()
+            conn.autocommit = False
+            cursor.execute("LOCK TABLE posts IN ACCESS EXCLUSIVE MODE")
+            cursor.execute("SELECT count(*) FROM posts WHERE thread_id IS NULL")
+            if cursor.fetchone()[0]:
+                raise ValueError("posts without a thread ID can't be partitioned by thread ID")
+            cursor.execute(self.PARTITIONED_POSTS_TABLE)
+            cursor.execute("CREATE TABLE posts_tid_default PARTITION OF posts_partitioned DEFAULT")
+            self.create_post_partitions(cursor, 'posts_partitioned', partition_size)
+            cursor.execute(f"INSERT INTO posts_partitioned ({self.POST_COLUMNS}) SELECT {self.POST_COLUMNS} FROM posts")
+            moved = cursor.rowcount
+            
+            # The old table and its indexes make way for the new ones, keeping their names
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'posts'")
+            existing_indexes = [name for name, in cursor.fetchall()]
+            for name in existing_indexes:
+                cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    sql.Identifier(name), sql.Identifier(f"{name}_unpartitioned")))
+            for name in reply_graph.TRIGGER_NAMES:
+                cursor.execute(sql.SQL("DROP TRIGGER IF EXISTS {} ON posts").format(sql.Identifier(name)))
+            cursor.execute("ALTER TABLE posts RENAME TO posts_unpartitioned")
+            cursor.execute("ALTER TABLE posts_partitioned RENAME TO posts")
+            cursor.execute("ALTER INDEX posts_partitioned_pkey RENAME TO posts_pkey")
+            
+            # Inside the transaction nobody is writing, so the indexes are built directly
+            for name, table, definition in self.SECONDARY_INDEXES + self.SEARCH_INDEXES:
+                if table == 'posts' and name in existing_indexes:
+                    cursor.execute(sql.SQL("CREATE INDEX {} ON posts ").format(sql.Identifier(name)) + sql.SQL(definition))
+            for query in reply_graph.TRIGGERS:
+                cursor.execute(query)
+            cursor.execute("UPDATE schema_version SET posts_partitioned_by = 'thread_id', posts_partition_size = %s, "
+                           "updated_at = now()", (partition_size,))
+            conn.commit()
+            logger.info("Moved %s posts into partitions of %s threads in %.1fs; the old table is kept as posts_unpartitioned",
+                        moved, partition_size, time.monotonic() - started)
         except Exception as e:
-            print(f"Error dropping foreign key constraint on replies_to (may not exist): {e}")
-            self.conn.rollback()
+            logger.error("Error partitioning posts: %s", e)
+            conn.rollback()
+            return False
+        finally:
+            self.release(conn, cursor)
+        self.read_posts_partitioning()
+        return True
+    
+    def create_post_partitions(self, cursor=None, table='posts', partition_size=None):
+        """Create the missing thread ID partitions of posts up to the one after the highest thread ID
         
-        cursor.close()
+        Posts of threads past the last partition land in posts_tid_default; they are moved into
+        their partition when it is created. With a cursor, runs in the caller's transaction;
+        otherwise each partition is created in its own.
+        """
+        partition_size = partition_size or self.posts_partition_size
+        own_cursor = cursor is None
+        if own_cursor:
+            conn, cursor = self.checkout()
+        else:
+            conn = cursor.connection
+        try:
+            cursor.execute("SELECT coalesce(max(thread_id), 0) FROM threads")
+            last_start = (cursor.fetchone()[0] // partition_size + 1) * partition_size
+            cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(%s)", (table,))
+            existing = {name for name, in cursor.fetchall()}
+            for start in range(0, last_start + 1, partition_size):
+                name = f"posts_tid_{start}"
+                if name in existing:
+                    continue
+                if own_cursor:
+                    conn.autocommit = False
+                try:
+                    cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+                        sql.Identifier(name), sql.Identifier(table)))
+                    cursor.execute(sql.SQL("""
+                    WITH moved AS (
+                        DELETE FROM posts_tid_default WHERE thread_id >= %s AND thread_id < %s RETURNING *
+                    )
+                    INSERT INTO {} SELECT * FROM moved
+                    """).format(sql.Identifier(name)), (start, start + partition_size))
+                    cursor.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+                        sql.Identifier(table), sql.Identifier(name)), (start, start + partition_size))
+                    if own_cursor:
+                        conn.commit()
+                    logger.info("Created posts partition %s", name)
+                except Exception as e:
+                    if not own_cursor:
+                        raise
+                    # Another process starting at the same time may have created it
+                    logger.error("Error creating posts partition %s: %s", name, e)
+                    conn.rollback()
+                finally:
+                    if own_cursor:
+                        conn.autocommit = True
+        finally:
+            if own_cursor:
+                self.release(conn, cursor)
     
-    def insert_user(self, username, num_posts, num_threads, joined_date):
-        """Insert or update a user"""
-        cursor = self.conn.cursor()
-        query = """
+    # Upsert statements for each buffered table, in the order they must be flushed
+    # so that posts never reference a user or thread that isn't written yet. Each takes
+    # one array per column, so a batch of any size runs the same prepared statement.
+    UPSERT_QUERIES = {
+        'users': """
         INSERT INTO users (username, num_posts, num_threads, joined_date)
-        VALUES (%s, %s, %s, %s)
+        SELECT * FROM unnest($1, $2, $3, $4)
         ON CONFLICT (username) DO UPDATE SET
             num_posts = EXCLUDED.num_posts,
             num_threads = EXCLUDED.num_threads,
-            joined_date = EXCLUDED.joined_date
+            joined_date = EXCLUDED.joined_date,
+            updated_at = now()
+        WHERE (users.num_posts, users.num_threads, users.joined_date)
+            IS DISTINCT FROM (EXCLUDED.num_posts, EXCLUDED.num_threads, EXCLUDED.joined_date)
+        """,
+        'threads': """
+        INSERT INTO threads (thread_id, thread_title, board_name, date_posted)
+        SELECT * FROM unnest($1, $2, $3, $4)
+        ON CONFLICT (thread_id) DO UPDATE SET
+            thread_title = EXCLUDED.thread_title,
+            board_name = EXCLUDED.board_name,
+            date_posted = EXCLUDED.date_posted,
+            updated_at = now()
+        WHERE (threads.thread_title, threads.board_name, threads.date_posted)
+            IS DISTINCT FROM (EXCLUDED.thread_title, EXCLUDED.board_name, EXCLUDED.date_posted)
+        """,
+        'posts': """
+        INSERT INTO posts (post_id, post_date, post_text, username, thread_id, replies_to, content_hash, search_vector)
+        SELECT v.*, to_tsvector($8, coalesce(v.post_text, ''))
+        FROM unnest($1, $2, $3, $4, $5, $6, $7) AS v (post_id, post_date, post_text, username, thread_id, replies_to, content_hash)
+        ON CONFLICT ({conflict_key}) DO UPDATE SET
+            post_date = EXCLUDED.post_date,
+            post_text = EXCLUDED.post_text,
+            username = EXCLUDED.username,
+            thread_id = EXCLUDED.thread_id,
+            replies_to = EXCLUDED.replies_to,
+            content_hash = EXCLUDED.content_hash,
+            search_vector = EXCLUDED.search_vector,
+            updated_at = now()
+        WHERE posts.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+        RETURNING {inserted}
+        """,
+        'thread_crawl_state': """
+        INSERT INTO thread_crawl_state (thread_id, last_page, max_post_id, post_count, complete)
+        SELECT * FROM unnest($1, $2, $3, $4, $5)
+        ON CONFLICT (thread_id) DO UPDATE SET
+            last_page = EXCLUDED.last_page,
+            max_post_id = EXCLUDED.max_post_id,
+            post_count = EXCLUDED.post_count,
+            complete = EXCLUDED.complete,
+            last_crawled = now()
+        """,
+    }
+    # Parameter types of the upsert statements. The posts upsert also takes the text search
+    # configuration its search vectors are built with, the same one searches use
+    UPSERT_TYPES = {
+        'users': ('varchar[]', 'integer[]', 'integer[]', 'timestamp[]'),
+        'threads': ('integer[]', 'varchar[]', 'varchar[]', 'timestamp[]'),
+        'posts': ('integer[]', 'timestamp[]', 'text[]', 'varchar[]', 'integer[]', 'integer[]', 'bytea[]', 'regconfig'),
+        'thread_crawl_state': ('integer[]', 'integer[]', 'integer[]', 'integer[]', 'boolean[]'),
+    }
+    
+    def buffer_row(self, table, row, flush=True):
+        """Add a row to the write buffer, flushing on batch size or flush interval unless flush is False"""
+        with self.lock:
+            # Keyed by primary key: a later row for the same key replaces the earlier one,
+            # which is what the upsert would have done and keeps ON CONFLICT from
+            # touching the same row twice in one statement
+            self.buffers[table][row[0]] = row
+            self.buffered_rows += 1
+            metrics.set('scraper_db_buffered_rows', self.buffered_rows)
+            if self.flusher is None and self.flush_interval > 0:
+                self.flusher = threading.Thread(target=self.flush_periodically, name='db-flusher', daemon=True)
+                self.flusher.start()
+        if flush:
+            self.flush_if_due()
+    
+    def flush_if_due(self):
+        """Flush if the batch size or the flush interval was reached, unless another thread is flushing"""
+        if (self.buffered_rows >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush(wait=False)
+    
+    def flush_periodically(self):
+        """Background thread: flush the buffered rows every flush_interval until the object is closed
+        
+        last_flush only moves once a flush starts, so while a slow one holds the flush lock
+        the thread still waits a little between checks rather than spinning.
+        """
+        min_wait = min(self.flush_interval, 0.5)
+        while not self.stopped.wait(max(self.last_flush + self.flush_interval - time.monotonic(), min_wait)):
+            try:
+                self.flush_if_due()
+            except Exception as e:
+                logger.error("Error flushing buffered rows: %s", e)
+    
+    def flush(self, wait=True):
+        """Write all buffered rows in one transaction
+        
+        Flushes run one at a time, so rows are written in the order they were buffered.
+        Unless wait, a flush already running in another thread leaves the rows buffered
+        meanwhile to the next one.
+        """
+        if not self.flush_lock.acquire(blocking=wait):
+            return
+        try:
+            with self.lock:
+                self.last_flush = time.monotonic()
+                if not self.buffered_rows:
+                    return
+                self.flushing = self.buffers
+                self.buffers = {table: {} for table in self.flushing}
+                self.buffered_rows = 0
+                metrics.set('scraper_db_buffered_rows', 0)
+            self.write_buffers({table: list(rows.values()) for table, rows in self.flushing.items()})
+        finally:
+            with self.lock:
+                self.flushing = None
+            self.flush_lock.release()
+    
+    def pending_rows(self, table, keys):
+        """Return {key: row} of the rows of table for keys that are buffered or being flushed
+        
+        Call it before querying the table: a row only stops being pending once it is committed.
+        """
+        pending = {}
+        with self.lock:
+            for buffers in (self.flushing, self.buffers):
+                if buffers is not None:
+                    rows = buffers[table]
+                    pending.update((key, rows[key]) for key in keys if key in rows)
+        return pending
+    
+    def write_buffers(self, buffers):
+        """Upsert the rows of each table in one transaction, falling back to one row at a time
+        
+        A batch that failed because its connection broke is written again once, on a new one.
+        If that fails too, the rows go back into the buffers for the next flush and the error
+        is raised, so nothing that follows them, such as a thread's completion, is taken as written.
+        """
+        for attempt in (1, 2):
+            conn, cursor = self.checkout()
+            try:
+                conn.autocommit = False
+                post_counts = (0, 0)
+                with metrics.timer('scraper_db_flush_seconds'):
+                    for table, rows in buffers.items():
+                        if rows:
+                            counts = self.upsert_rows(cursor, table, rows)
+                            if table == 'posts':
+                                post_counts = counts
+                    conn.commit()
+                self.count_posts(len(buffers['posts']), *post_counts)
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if not conn.closed:
+                    raise
+                if attempt == 2:
+                    logger.error("Database connection lost twice while flushing, %s rows put back in the buffers: %s",
+                                 sum(len(rows) for rows in buffers.values()), e)
+                    self.requeue(buffers)
+                    raise
+                logger.warning("Database connection lost while flushing, writing the batch again: %s", e)
+            except Exception as e:
+                logger.error("Error flushing batch, retrying row by row: %s", e)
+                conn.rollback()
+                conn.autocommit = True
+                self.write_rows_individually(cursor, buffers)
+                return
+            finally:
+                self.release(conn, cursor)
+    
+    def requeue(self, buffers):
+        """Put rows that could not be written back ahead of the rows buffered since, which replace them"""
+        with self.lock:
+            for username in (row[0] for row in buffers['users']):
+                self.user_cache.forget(username)
+            for table, rows in buffers.items():
+                newer = self.buffers[table]
+                self.buffers[table] = {row[0]: row for row in rows}
+                self.buffers[table].update(newer)
+            self.buffered_rows = sum(len(rows) for rows in self.buffers.values())
+            metrics.set('scraper_db_buffered_rows', self.buffered_rows)
+    
+    def upsert_rows(self, cursor, table, rows):
+        """Run the upsert of a table for rows, returning (inserted, updated) for posts
+        
+        Rows whose values are unchanged are left alone by the upsert's WHERE clause,
+        so they count as neither.
+        """
+        metrics.inc('scraper_db_rows_written_total', len(rows), table=table)
+        with metrics.timer('scraper_db_write_seconds', table=table):
+            columns = [list(column) for column in zip(*rows)]
+            if table == 'posts':
+                columns.append(config.SEARCH_CONFIG)
+            self.execute_prepared(cursor, f"upsert_{table}", self.upsert_queries[table], self.UPSERT_TYPES[table], columns)
+            if table != 'posts':
+                return 0, 0
+            written = cursor.fetchall()
+        inserted = sum(1 for (was_inserted,) in written if was_inserted)
+        return inserted, len(written) - inserted
+    
+    def execute_prepared(self, cursor, name, query, types, params):
+        """Execute query, which takes parameters $1, $2... of types, as a statement prepared on the cursor's connection
+        
+        The statement is prepared the first time a connection runs it. Its name ends in a hash
+        of the query, so each variant of a query is prepared under a name of its own.
         """
+        name = f"{name}_{blake2b(query.encode('utf-8'), digest_size=4).hexdigest()}"
+        prepared = self.pool.prepared_statements(cursor.connection)
+        if name not in prepared:
+            cursor.execute(f"PREPARE {name} ({', '.join(types)}) AS {query}")
+            prepared.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(f'%s::{kind}' for kind in types)})", params)
+    
+    def count_posts(self, sent, inserted, updated, skipped=0):
+        """Add to the per-run counts of new, changed and unchanged posts"""
+        with self.lock:
+            self.post_counts['new'] += inserted
+            self.post_counts['changed'] += updated
+            self.post_counts['unchanged'] += sent - inserted - updated + skipped
+    
+    def write_rows_individually(self, cursor, buffers):
+        """Write rows one at a time so a single bad row doesn't lose the whole batch
+        
+        The crawl state of a thread whose thread or post row failed is not written, so the
+        next run resumes from its last checkpoint instead of past the posts that are missing.
+        """
+        failed_threads = set()
+        # Crawl states come after the threads and posts in the buffers
+        for table, rows in buffers.items():
+            for row in rows:
+                if table == 'thread_crawl_state' and row[0] in failed_threads:
+                    logger.error("Not saving the crawl state of thread %s, some of its rows failed", row[0])
+                    continue
+                try:
+                    counts = self.upsert_rows(cursor, table, [row])
+                    if table == 'posts':
+                        self.count_posts(1, *counts)
+                except Exception as e:
+                    logger.error("Error inserting %s row %s: %s", table, row[0], e)
+                    if table == 'users':
+                        with self.lock:
+                            self.user_cache.forget(row[0])
+                    elif table == 'threads':
+                        failed_threads.add(row[0])
+                    elif table == 'posts':
+                        failed_threads.add(row[4])
+    
+    def insert_user(self, username, num_posts, num_threads, joined_date):
+        """Insert or update a user, unless the same row was already written"""
+        user_row = (username, num_posts, num_threads, joined_date)
+        with self.lock:
+            needs_write = self.user_cache.needs_write(user_row)
+        if needs_write:
+            self.buffer_row('users', user_row)
+    
+    @timed('scraper_db_write_seconds', table='users')
+    def insert_missing_users(self, usernames):
+        """Store users known only by name, without statistics, leaving users already stored alone
+        
+        Written right away rather than buffered, so the posts buffered after them never fail the
+        users foreign key; a row with statistics buffered for the same user replaces it when flushed.
+        """
+        if not usernames:
+            return
+        conn, cursor = self.checkout()
+        query = "INSERT INTO users (username) VALUES %s ON CONFLICT (username) DO NOTHING"
         try:
-            cursor.execute(query, (username, num_posts, num_threads, joined_date))
+            execute_values(cursor, query, [(username,) for username in usernames])
         except Exception as e:
-            print(f"Error inserting user {username}: {e}")
-            self.conn.rollback()
+            logger.error("Error inserting users without statistics: %s", e)
         finally:
-            cursor.close()
+            self.release(conn, cursor)
     
     def insert_thread(self, thread_id, thread_title, board_name, date_posted):
         """Insert or update a thread"""
-        cursor = self.conn.cursor()
+        self.buffer_row('threads', (thread_id, thread_title, board_name, date_posted))
+    
+    def insert_post(self, post_id, post_date, post_text, username, thread_id, replies_to=None):
+        """Insert or update a post, unless its content hash is unchanged"""
+        post_row = (post_id, post_date, post_text, username, thread_id, replies_to)
+        self.buffer_row('posts', post_row + (post_hash(post_row),))
+    
+    def get_post_hashes(self, thread_id):
+        """Return {post_id: content_hash} of the stored posts of a thread"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("SELECT post_id, content_hash FROM posts WHERE thread_id = %s", (thread_id,))
+            return {post_id: bytes(digest) if digest is not None else None
+                    for post_id, digest in cursor.fetchall()}
+        except Exception as e:
+            logger.error("Error reading post hashes of thread %s: %s", thread_id, e)
+            return {}
+        finally:
+            self.release(conn, cursor)
+    
+    def skip_unchanged_posts(self, user_rows, post_rows, known_hashes):
+        """Drop the posts whose content hash matches known_hashes, counting them as unchanged
+        
+        Returns the remaining (user_rows, post_rows).
+        """
+        kept = [(user_row, post_row) for user_row, post_row in zip(user_rows, post_rows)
+                if known_hashes.get(post_row[0]) != post_hash(post_row)]
+        self.count_posts(0, 0, 0, skipped=len(post_rows) - len(kept))
+        return [row[0] for row in kept], [row[1] for row in kept]
+    
+    def post_stats(self):
+        """Return a one-line summary of the posts written in this run"""
+        return "Posts: {new} new, {changed} changed, {unchanged} unchanged".format(**self.post_counts)
+    
+    @timed('scraper_db_write_seconds', table='thread_listing')
+    def insert_thread_listings(self, rows):
+        """Insert or update threads found on the board listings: (thread_id, forum_id, replies, last_post_date)"""
+        conn, cursor = self.checkout()
         query = """
-        INSERT INTO threads (thread_id, thread_title, board_name, date_posted)
-        VALUES (%s, %s, %s, %s)
+        INSERT INTO thread_listing (thread_id, forum_id, replies, last_post_date)
+        VALUES %s
         ON CONFLICT (thread_id) DO UPDATE SET
-            thread_title = EXCLUDED.thread_title,
-            board_name = EXCLUDED.board_name,
-            date_posted = EXCLUDED.date_posted
+            forum_id = EXCLUDED.forum_id,
+            replies = EXCLUDED.replies,
+            last_post_date = EXCLUDED.last_post_date,
+            discovered_at = now()
         """
         try:
-            cursor.execute(query, (thread_id, thread_title, board_name, date_posted))
+            execute_values(cursor, query, rows)
         except Exception as e:
-            print(f"Error inserting thread {thread_id}: {e}")
-            self.conn.rollback()
+            logger.error("Error inserting thread listings: %s", e)
         finally:
-            cursor.close()
+            self.release(conn, cursor)
     
-    def insert_post(self, post_id, post_date, post_text, username, thread_id, replies_to=None):
-        """Insert or update a post"""
-        cursor = self.conn.cursor()
+    def insert_crawl_state(self, thread_id, last_page, max_post_id, post_count, complete=True):
+        """Insert or update how far a thread has been crawled"""
+        self.buffer_row('thread_crawl_state', (thread_id, last_page, max_post_id, post_count, complete))
+    
+    def insert_page(self, thread_row, user_rows, post_rows, crawl_state=None):
+        """Buffer the rows of one thread page together with the thread's crawl state after it
+        
+        The batch is only flushed once the whole page is buffered, so the page's posts and
+        the checkpoint saying it was scraped always commit in the same transaction; if the
+        batch falls back to row by row, the checkpoint is dropped when any of its rows fail.
+        crawl_state is (thread_id, last_page, max_post_id, post_count, complete).
+        """
+        # The thread row goes in last: if buffering is interrupted part way, the thread is
+        # either not stored at all or stored with a checkpoint that doesn't claim this page.
+        # Holding the lock keeps a flush from another thread from taking half a page.
+        with self.lock:
+            for user_row, post_row in zip(user_rows, post_rows):
+                if self.user_cache.needs_write(user_row):
+                    self.buffer_row('users', user_row, flush=False)
+                self.buffer_row('posts', post_row + (post_hash(post_row),), flush=False)
+            if crawl_state:
+                self.buffer_row('thread_crawl_state', crawl_state, flush=False)
+            if thread_row:
+                self.buffer_row('threads', thread_row, flush=False)
+        self.flush_if_due()
+    
+    def get_thread_progress(self, thread_ids):
+        """Return {thread_id: (last_page, max_post_id, post_count, complete)} for the stored threads among thread_ids
+        
+        Threads stored before crawl state was recorded count as complete.
+        """
+        progress = {}
+        buffered_states = self.pending_rows('thread_crawl_state', thread_ids)
+        buffered_threads = self.pending_rows('threads', thread_ids)
+        conn, cursor = self.checkout()
         query = """
-        INSERT INTO posts (post_id, post_date, post_text, username, thread_id, replies_to)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (post_id) DO UPDATE SET
-            post_date = EXCLUDED.post_date,
-            post_text = EXCLUDED.post_text,
-            username = EXCLUDED.username,
-            thread_id = EXCLUDED.thread_id,
-            replies_to = EXCLUDED.replies_to
+        SELECT t.thread_id, s.last_page, s.max_post_id, s.post_count, COALESCE(s.complete, true)
+        FROM threads AS t
+        LEFT JOIN thread_crawl_state AS s USING (thread_id)
+        WHERE t.thread_id = ANY(%s)
         """
         try:
-            cursor.execute(query, (post_id, post_date, post_text, username, thread_id, replies_to))
+            cursor.execute(query, (list(thread_ids),))
+            progress = {row[0]: row[1:] for row in cursor.fetchall()}
         except Exception as e:
-            print(f"Error inserting post {post_id}: {e}")
-            self.conn.rollback()
+            logger.error("Error reading crawl progress: %s", e)
         finally:
-            cursor.close()
+            self.release(conn, cursor)
+        for thread_id in thread_ids:
+            if thread_id in buffered_states:
+                progress[thread_id] = buffered_states[thread_id][1:]
+            elif thread_id in buffered_threads and thread_id not in progress:
+                progress[thread_id] = (None, None, None, True)
+        return progress
+    
+    def get_crawl_states(self):
+        """Return {thread_id: (last_page, max_post_id, post_count)} for every stored thread
+        
+        Threads scraped before crawl state was recorded get their post id and count from
+        the posts table and no last page.
+        """
+        self.flush()
+        conn, cursor = self.checkout()
+        query = """
+        SELECT t.thread_id, s.last_page,
+               COALESCE(s.max_post_id, p.max_post_id), COALESCE(s.post_count, p.post_count, 0)
+        FROM threads AS t
+        LEFT JOIN thread_crawl_state AS s USING (thread_id)
+        LEFT JOIN LATERAL (
+            SELECT max(post_id) AS max_post_id, count(*) AS post_count
+            FROM posts
+            WHERE posts.thread_id = t.thread_id AND s.thread_id IS NULL
+        ) AS p ON true
+        """
+        try:
+            cursor.execute(query)
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error("Error reading crawl state: %s", e)
+            return {}
+        finally:
+            self.release(conn, cursor)
+    
+    def get_thread_activity(self, window_days):
+        """Return (thread_id, posts in the last window_days, days since the last post,
+        hours since the thread was last crawled) for every stored thread
+        
+        The ages are None when there are no dated posts or the thread has no crawl state.
+        """
+        self.flush()
+        conn, cursor = self.checkout()
+        query = """
+        SELECT t.thread_id,
+               COALESCE(p.recent_posts, 0),
+               EXTRACT(EPOCH FROM now() - p.last_post_date) / 86400,
+               EXTRACT(EPOCH FROM now() - s.last_crawled) / 3600
+        FROM threads AS t
+        LEFT JOIN thread_crawl_state AS s USING (thread_id)
+        LEFT JOIN (
+            SELECT thread_id,
+                   count(*) FILTER (WHERE post_date > now() - make_interval(days => %s)) AS recent_posts,
+                   max(post_date) AS last_post_date
+            FROM posts
+            GROUP BY thread_id
+        ) AS p USING (thread_id)
+        """
+        try:
+            cursor.execute(query, (window_days,))
+            return [(thread_id, recent_posts, None if days is None else float(days),
+                     None if hours is None else float(hours))
+                    for thread_id, recent_posts, days, hours in cursor.fetchall()]
+        except Exception as e:
+            logger.error("Error reading thread activity: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    @timed('scraper_db_write_seconds', table='crawl_schedule')
+    def save_schedule(self, rows):
+        """Replace the persisted crawl schedule: (thread_id, priority, posts_per_day, interval_hours, hours_until_due)"""
+        conn, cursor = self.checkout()
+        try:
+            conn.autocommit = False
+            cursor.execute("DELETE FROM crawl_schedule")
+            execute_values(cursor, """
+            INSERT INTO crawl_schedule (thread_id, priority, posts_per_day, interval_hours, next_crawl)
+            SELECT thread_id, priority, posts_per_day, interval_hours, now() + due * interval '1 hour'
+            FROM (VALUES %s) AS v (thread_id, priority, posts_per_day, interval_hours, due)
+            """, rows, template="(%s, %s::float8, %s::float8, %s::float8, %s::float8)")
+            conn.commit()
+        except Exception as e:
+            logger.error("Error saving crawl schedule: %s", e)
+            conn.rollback()
+        finally:
+            self.release(conn, cursor)
+    
+    def get_schedule(self, limit=None):
+        """Return the persisted crawl schedule, highest priority first:
+        (thread_id, thread_title, priority, posts_per_day, interval_hours, next_crawl)"""
+        conn, cursor = self.checkout()
+        query = """
+        SELECT c.thread_id, t.thread_title, c.priority, c.posts_per_day, c.interval_hours, c.next_crawl
+        FROM crawl_schedule AS c
+        LEFT JOIN threads AS t USING (thread_id)
+        ORDER BY c.priority DESC, c.thread_id
+        LIMIT %s
+        """
+        try:
+            cursor.execute(query, (limit,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error("Error reading crawl schedule: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    @timed('scraper_db_write_seconds', table='crawl_misses')
+    def record_miss(self, thread_id, outcome, http_status=None):
+        """Record that a thread was missing, forbidden or failed to fetch"""
+        conn, cursor = self.checkout()
+        query = """
+        INSERT INTO crawl_misses (thread_id, outcome, http_status)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (thread_id) DO UPDATE SET
+            outcome = EXCLUDED.outcome,
+            http_status = EXCLUDED.http_status,
+            last_checked = now(),
+            attempts = crawl_misses.attempts + 1
+        """
+        try:
+            cursor.execute(query, (thread_id, outcome, http_status))
+        except Exception as e:
+            logger.error("Error recording miss for thread %s: %s", thread_id, e)
+        finally:
+            self.release(conn, cursor)
+    
+    def clear_miss(self, thread_id):
+        """Forget a recorded miss once the thread was scraped"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("DELETE FROM crawl_misses WHERE thread_id = %s", (thread_id,))
+        except Exception as e:
+            logger.error("Error clearing miss for thread %s: %s", thread_id, e)
+        finally:
+            self.release(conn, cursor)
+    
+    def get_misses(self, ttl_hours):
+        """Return {thread_id: is_active} for all recorded misses
+        
+        A miss is active while it was checked less than ttl_hours[outcome] hours ago.
+        """
+        conn, cursor = self.checkout()
+        query = """
+        SELECT m.thread_id, m.last_checked > now() - COALESCE(ttl.hours, 0) * interval '1 hour'
+        FROM crawl_misses AS m
+        LEFT JOIN (VALUES %s) AS ttl (outcome, hours) ON ttl.outcome = m.outcome
+        """
+        try:
+            rows = execute_values(cursor, query, list(ttl_hours.items()), fetch=True)
+            return dict(rows)
+        except Exception as e:
+            logger.error("Error reading recorded misses: %s", e)
+            return {}
+        finally:
+            self.release(conn, cursor)
+    
+    @timed('scraper_db_write_seconds', table='crawl_jobs')
+    def enqueue_jobs(self, thread_ids):
+        """Add crawl jobs for the given thread IDs, keeping jobs that already exist; returns the number added"""
+        conn, cursor = self.checkout()
+        query = """
+        INSERT INTO crawl_jobs (thread_id) VALUES %s
+        ON CONFLICT (thread_id) DO NOTHING
+        RETURNING thread_id
+        """
+        try:
+            return len(execute_values(cursor, query, [(thread_id,) for thread_id in thread_ids],
+                                      page_size=1000, fetch=True))
+        except Exception as e:
+            logger.error("Error enqueueing crawl jobs: %s", e)
+            return 0
+        finally:
+            self.release(conn, cursor)
+    
+    def claim_jobs(self, worker, limit, lease_seconds, max_attempts):
+        """Lease up to limit pending jobs, or running jobs whose lease expired, to worker
+        
+        Rows locked by another worker's claim are skipped, so concurrent workers never get
+        the same job. Jobs that were already claimed max_attempts times are marked failed.
+        Returns the claimed thread IDs in order.
+        """
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            UPDATE crawl_jobs SET status = 'failed', worker = NULL, updated_at = now()
+            WHERE attempts >= %s AND (status = 'pending' OR (status = 'running' AND lease_expires < now()))
+            """, (max_attempts,))
+            cursor.execute("""
+            UPDATE crawl_jobs SET
+                status = 'running',
+                worker = %s,
+                lease_expires = now() + %s * interval '1 second',
+                attempts = attempts + 1,
+                updated_at = now()
+            WHERE thread_id IN (
+                SELECT thread_id FROM crawl_jobs
+                WHERE (status = 'pending' OR (status = 'running' AND lease_expires < now()))
+                  AND attempts < %s
+                ORDER BY thread_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING thread_id
+            """, (worker, lease_seconds, max_attempts, limit))
+            return sorted(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            logger.error("Error claiming crawl jobs: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    def extend_leases(self, worker, lease_seconds):
+        """Heartbeat: extend the leases of all jobs held by worker"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            UPDATE crawl_jobs SET lease_expires = now() + %s * interval '1 second'
+            WHERE worker = %s AND status = 'running'
+            """, (lease_seconds, worker))
+        except Exception as e:
+            logger.error("Error extending crawl job leases: %s", e)
+        finally:
+            self.release(conn, cursor)
+    
+    def finish_jobs(self, worker, thread_ids, status='done'):
+        """Mark jobs held by worker as done, or put them back as 'pending'
+        
+        Buffered rows are flushed first, so a job is only marked done once its data is written.
+        """
+        self.flush()
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            UPDATE crawl_jobs SET status = %s, worker = NULL, lease_expires = NULL, updated_at = now()
+            WHERE thread_id = ANY(%s) AND worker = %s AND status = 'running'
+            """, (status, list(thread_ids), worker))
+        except Exception as e:
+            logger.error("Error finishing crawl jobs: %s", e)
+        finally:
+            self.release(conn, cursor)
+    
+    def retry_jobs(self, worker, thread_ids, max_attempts):
+        """Put jobs held by worker back as 'pending', or mark them 'failed' once claimed max_attempts times"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            UPDATE crawl_jobs SET
+                status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                worker = NULL, lease_expires = NULL, updated_at = now()
+            WHERE thread_id = ANY(%s) AND worker = %s AND status = 'running'
+            """, (max_attempts, list(thread_ids), worker))
+        except Exception as e:
+            logger.error("Error retrying crawl jobs: %s", e)
+        finally:
+            self.release(conn, cursor)
+    
+    def get_job_counts(self):
+        """Return {status: number of jobs}, counting running jobs with an expired lease as 'expired'"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            SELECT CASE WHEN status = 'running' AND lease_expires < now() THEN 'expired' ELSE status END,
+                   count(*)
+            FROM crawl_jobs GROUP BY 1
+            """)
+            return dict(cursor.fetchall())
+        except Exception as e:
+            logger.error("Error counting crawl jobs: %s", e)
+            return {}
+        finally:
+            self.release(conn, cursor)
+    
+    def get_users_with_stats(self, usernames):
+        """Return the subset of usernames already stored with author statistics"""
+        buffered = {username for username, row in self.pending_rows('users', usernames).items() if row[1] is not None}
+        conn, cursor = self.checkout()
+        query = "SELECT username FROM users WHERE username = ANY(%s) AND num_posts IS NOT NULL"
+        try:
+            cursor.execute(query, (list(usernames),))
+            return buffered | {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error("Error checking users: %s", e)
+            return set()
+        finally:
+            self.release(conn, cursor)
     
     def thread_exists(self, thread_id):
         """Check if a thread exists in the database"""
-        cursor = self.conn.cursor()
+        if self.pending_rows('threads', [thread_id]):
+            return True
+        conn, cursor = self.checkout()
         query = "SELECT 1 FROM threads WHERE thread_id = %s"
         try:
             cursor.execute(query, (thread_id,))
             exists = cursor.fetchone() is not None
             return exists
         except Exception as e:
-            print(f"Error checking thread existence: {e}")
+            logger.error("Error checking thread existence: %s", e)
+            return False
+        finally:
+            self.release(conn, cursor)
+    
+    def fill_search_vectors(self, after_post_id, limit):
+        """Compute the search vectors of up to limit posts without one, in post_id order after after_post_id
+        
+        Rows locked by a concurrent write are skipped; the write sets their vector itself.
+        Returns (posts updated, the last post_id looked at or None when there are no more).
+        """
+        conn, cursor = self.checkout()
+        query = """
+        WITH batch AS (
+            SELECT post_id, search_vector IS NULL AS missing FROM posts
+            WHERE post_id > %s
+            ORDER BY post_id
+            LIMIT %s
+        ), filled AS (
+            UPDATE posts SET search_vector = to_tsvector(%s::regconfig, coalesce(post_text, ''))
+            WHERE post_id IN (
+                SELECT post_id FROM posts
+                WHERE post_id IN (SELECT post_id FROM batch WHERE missing) AND search_vector IS NULL
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM filled), (SELECT max(post_id) FROM batch)
+        """
+        try:
+            cursor.execute(query, (after_post_id, limit, config.SEARCH_CONFIG))
+            return cursor.fetchone()
+        finally:
+            self.release(conn, cursor)
+    
+    def create_index_concurrently(self, name, table, definition):
+        """Create an index without blocking writes, unless a valid one with that name exists
+        
+        definition follows CREATE INDEX CONCURRENTLY <name> ON <table>. An index left invalid by
+        an interrupted build is dropped and built again. A partitioned table can't be indexed
+        concurrently, so its index is built with a plain CREATE INDEX. Returns True if the index
+        is usable.
+        """
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+            existing = cursor.fetchone()
+            if existing and existing[0]:
+                return True
+            cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = cursor.fetchone()
+            concurrently = sql.SQL("" if row and row[0] else "CONCURRENTLY")
+            if existing:
+                logger.info("Rebuilding invalid index %s", name)
+                cursor.execute(sql.SQL("DROP INDEX {} IF EXISTS {}").format(concurrently, sql.Identifier(name)))
+            started = time.monotonic()
+            cursor.execute(sql.SQL("CREATE INDEX {} {} ON {} ").format(concurrently, sql.Identifier(name), sql.Identifier(table))
+                           + sql.SQL(definition))
+            logger.info("Created index %s in %.1fs", name, time.monotonic() - started)
+            return True
+        except Exception as e:
+            logger.error("Error creating index %s: %s", name, e)
             return False
         finally:
+            self.release(conn, cursor)
+    
+    def create_trigram_support(self):
+        """Enable the pg_trgm extension, returning False if it isn't available"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            return True
+        except Exception as e:
+            logger.error("Error enabling pg_trgm, trigram index not created: %s", e)
+            return False
+        finally:
+            self.release(conn, cursor)
+    
+    def search_posts(self, query, limit, board=None):
+        """Return the posts matching a web-search style query, most relevant first:
+        (post_id, post_date, username, thread_id, thread_title, board_name, rank, excerpt)
+        
+        Only the top limit matches are excerpted, which is the expensive part.
+        """
+        conn, cursor = self.checkout()
+        search_query = """
+        SELECT r.post_id, r.post_date, r.username, r.thread_id, r.thread_title, r.board_name, r.rank,
+               ts_headline(%(config)s::regconfig, r.post_text, r.query,
+                           'StartSel=[, StopSel=], MaxFragments=2, MaxWords=15, MinWords=5')
+        FROM (
+            SELECT p.post_id, p.post_date, p.username, p.thread_id, t.thread_title, t.board_name, p.post_text,
+                   q.query, ts_rank_cd(p.search_vector, q.query) AS rank
+            FROM websearch_to_tsquery(%(config)s::regconfig, %(query)s) AS q (query)
+            JOIN posts AS p ON p.search_vector @@ q.query
+            LEFT JOIN threads AS t ON t.thread_id = p.thread_id
+            WHERE %(board)s::text IS NULL OR t.board_name = %(board)s
+            ORDER BY rank DESC, p.post_id DESC
+            LIMIT %(limit)s
+        ) AS r
+        ORDER BY r.rank DESC, r.post_id DESC
+        """
+        try:
+            cursor.execute(search_query, {'config': config.SEARCH_CONFIG, 'query': query, 'board': board, 'limit': limit})
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error("Error searching posts: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    def search_posts_substring(self, text, limit, board=None):
+        """Return the latest posts containing text, ignoring case, in the same form as search_posts()
+        
+        Uses the trigram index if it was created, a sequential scan otherwise.
+        """
+        conn, cursor = self.checkout()
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        search_query = """
+        SELECT p.post_id, p.post_date, p.username, p.thread_id, t.thread_title, t.board_name, NULL,
+               substr(p.post_text, greatest(strpos(lower(p.post_text), lower(%(text)s)) - 60, 1), 200)
+        FROM posts AS p
+        LEFT JOIN threads AS t ON t.thread_id = p.thread_id
+        WHERE p.post_text ILIKE %(pattern)s AND (%(board)s::text IS NULL OR t.board_name = %(board)s)
+        ORDER BY p.post_date DESC NULLS LAST, p.post_id DESC
+        LIMIT %(limit)s
+        """
+        try:
+            cursor.execute(search_query, {'text': text, 'pattern': pattern, 'board': board, 'limit': limit})
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error("Error searching posts: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    # Rows of the exported tables, after the value they are partitioned by, and the partition
+    # expressions; rows are selected as x, and posts join their thread as t
+    EXPORT_QUERIES = {
+        'users': """
+        SELECT {partition}, x.username, x.num_posts, x.num_threads, x.joined_date, x.updated_at
+        FROM users AS x
+        """,
+        'threads': """
+        SELECT {partition}, x.thread_id, x.thread_title, x.board_name, x.date_posted, x.updated_at
+        FROM threads AS x
+        """,
+        'posts': """
+        SELECT {partition}, x.post_id, x.post_date, x.post_text, x.username, x.thread_id, x.replies_to, x.updated_at
+        FROM posts AS x
+        LEFT JOIN threads AS t ON t.thread_id = x.thread_id
+        """,
+    }
+    EXPORT_PARTITIONS = {
+        'board': {'threads': "x.board_name", 'posts': "t.board_name"},
+        'month': {'threads': "to_char(x.date_posted, 'YYYY-MM')", 'posts': "to_char(x.post_date, 'YYYY-MM')"},
+    }
+    
+    def begin_export(self):
+        """Return the upper watermark of an export and start the read-only transaction reading it
+        
+        The watermark is the start of the oldest other transaction still open, or now: rows
+        stamped before it were all committed before the export's snapshot was taken, so
+        exporting up to it never misses a row that commits later with an earlier updated_at.
+        Sessions of other roles may be hidden from pg_stat_activity and are not waited for.
+        """
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("""
+            SELECT least(now(), min(xact_start))::timestamp
+            FROM pg_stat_activity
+            WHERE pid <> pg_backend_pid() AND state <> 'idle' AND xact_start IS NOT NULL
+            """)
+            until = cursor.fetchone()[0]
             cursor.close()
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True, autocommit=False)
+        except Exception:
+            self.release(conn, cursor)
+            raise
+        # The export's reads all go through this connection until end_export()
+        self.export_conn = conn
+        return until
+    
+    def end_export(self):
+        """End the export's transaction and return its connection to the pool"""
+        conn, self.export_conn = self.export_conn, None
+        try:
+            conn.rollback()
+            conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT', autocommit=True)
+        finally:
+            self.release(conn)
+    
+    def export_rows(self, table, partition, since, until, chunk_rows):
+        """Yield the rows of table updated in [since, until), in lists of at most chunk_rows
+        
+        Rows are (partition value, *columns) ordered by partition value, or with None as the
+        partition value if partition is None. They are read through a named (server-side)
+        cursor, so only one chunk is held in memory whatever the size of the table.
+        Must be called between begin_export() and end_export().
+        """
+        partition_sql = self.EXPORT_PARTITIONS[partition][table] if partition else "NULL::text"
+        query = self.EXPORT_QUERIES[table].format(partition=partition_sql) + """
+        WHERE (%(since)s::timestamp IS NULL OR x.updated_at >= %(since)s) AND x.updated_at < %(until)s
+        ORDER BY 1, 2
+        """
+        cursor = self.export_conn.cursor(name=f"export_{table}")
+        cursor.itersize = chunk_rows
+        try:
+            cursor.execute(query, {'since': since, 'until': until})
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    
+    def get_export_watermarks(self, destination):
+        """Return {table_name: exported_until} of the previous exports to destination"""
+        conn, cursor = self.checkout()
+        try:
+            cursor.execute("SELECT table_name, exported_until FROM export_watermarks WHERE destination = %s",
+                           (destination,))
+            return dict(cursor.fetchall())
+        finally:
+            self.release(conn, cursor)
+    
+    def save_export_watermarks(self, destination, watermarks):
+        """Record {table_name: exported_until} as exported to destination"""
+        conn, cursor = self.checkout()
+        query = """
+        INSERT INTO export_watermarks (table_name, destination, exported_until)
+        VALUES %s
+        ON CONFLICT (table_name, destination) DO UPDATE SET
+            exported_until = EXCLUDED.exported_until,
+            exported_at = now()
+        """
+        try:
+            execute_values(cursor, query, [(table, destination, until) for table, until in watermarks.items()])
+        except Exception as e:
+            logger.error("Error saving export watermarks: %s", e)
+        finally:
+            self.release(conn, cursor)
+    
+    @timed('scraper_db_write_seconds', table='post_media')
+    def insert_post_media(self, rows):
+        """Record the attachments and images of posts: (post_id, url, kind)
+        
+        A URL already downloaded for another post, or found too large, isn't fetched again.
+        """
+        conn, cursor = self.checkout()
+        query = """
+        INSERT INTO post_media (post_id, url, kind, status, attempts, http_status, sha256, content_type, size, fetched_at)
+        SELECT v.post_id, v.url, v.kind, COALESCE(known.status, 'pending'), COALESCE(known.attempts, 0),
+               known.http_status, known.sha256, known.content_type, known.size, known.fetched_at
+        FROM (VALUES %s) AS v (post_id, url, kind)
+        LEFT JOIN LATERAL (
+            SELECT status, attempts, http_status, sha256, content_type, size, fetched_at FROM post_media
+            WHERE post_media.url = v.url AND post_media.status IN ('done', 'too_large')
+            LIMIT 1
+        ) AS known ON true
+        ON CONFLICT (post_id, url) DO NOTHING
+        """
+        try:
+            execute_values(cursor, query, rows)
+        except Exception as e:
+            logger.error("Error recording post media: %s", e)
+        finally:
+            self.release(conn, cursor)
+    
+    def get_pending_media(self, limit):
+        """Return [(url, attempts)] of up to limit distinct URLs still to download, least attempted first"""
+        conn, cursor = self.checkout()
+        query = """
+        SELECT url, max(attempts) FROM post_media
+        WHERE status = 'pending'
+        GROUP BY url
+        ORDER BY min(attempts), url
+        LIMIT %s
+        """
+        try:
+            cursor.execute(query, (limit,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error("Error reading pending media: %s", e)
+            return []
+        finally:
+            self.release(conn, cursor)
+    
+    @timed('scraper_db_write_seconds', table='post_media')
+    def finish_media(self, url, status, http_status=None, digest=None, content_type=None, size=None):
+        """Record the outcome of a download of url for every post linking to it
+        
+        status is 'done', 'too_large', 'failed', or 'pending' to try again later.
+        """
+        conn, cursor = self.checkout()
+        query = """
+        UPDATE post_media SET
+            status = %s,
+            attempts = attempts + 1,
+            http_status = %s,
+            sha256 = %s,
+            content_type = %s,
+            size = %s,
+            fetched_at = now()
+        WHERE url = %s AND status = 'pending'
+        """
+        try:
+            cursor.execute(query, (status, http_status, digest, content_type, size, url))
+        except Exception as e:
+            logger.error("Error recording the download of %s: %s", url, e)
+        finally:
+            self.release(conn, cursor)
     
     def close(self):
-        """Close the database connection"""
-        if self.conn:
-            self.conn.close()
-            print("Database connection closed")
+        """Flush buffered rows; the connections stay in the pool for the rest of the process"""
+        if not self.closed:
+            self.closed = True
+            self.stopped.set()
+            if self.flusher is not None:
+                self.flusher.join()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error flushing buffered rows, %s rows not written: %s", self.buffered_rows, e)
+            if self.user_cache.hits or self.user_cache.misses:
+                logger.info("%s", self.user_cache.stats())
+            if any(self.post_counts.values()):
+                logger.info("%s", self.post_stats())
+            logger.info("Database connection closed")
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import re
+import config
+from fetcher import AsyncFetcher
+from lxml_parser import LxmlThreadParser, find_first, has_class, stripped_text
+from page_parser import parse_post_date
+
+logger = logging.getLogger(__name__)
+
+TID_RE = re.compile(r'showthread\.php\?(?:[^"#]*&)?tid=(\d+)')
+FID_RE = re.compile(r'forumdisplay\.php\?(?:[^"#]*&)?fid=(\d+)')
+
+
+class ThreadListing:
+    """A thread as listed on forumdisplay.php"""
+    __slots__ = ('thread_id', 'forum_id', 'replies', 'last_post_date')
+
+    def __init__(self, thread_id, forum_id, replies=None, last_post_date=None):
+        self.thread_id = thread_id
+        self.forum_id = forum_id
+        self.replies = replies
+        self.last_post_date = last_post_date
+
+    def row(self):
+        return (self.thread_id, self.forum_id, self.replies, self.last_post_date)
+
+
+class ForumDiscovery:
+    """Finds the real set of thread ids by crawling index.php and the forumdisplay.php listings"""
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.parser = LxmlThreadParser()
+
+    async def fetch_root(self, url):
+        """Fetch a listing page and return its lxml root, or None"""
+        content = await self.fetcher.fetch(url)
+        if content is None:
+            logger.warning("Failed to retrieve %s", url)
+            return None
+        return self.parser.parse_document(content)
+
+    def forum_ids(self, root):
+        """Return the ids of all boards linked from a page"""
+        fids = set()
+        for link in root.iter('a'):
+            match = FID_RE.search(link.get('href') or '')
+            if match:
+                fids.add(int(match.group(1)))
+        return fids
+
+    def number_of_pages(self, root, forum_id):
+        """Return the number of listing pages of a board"""
+        page_numbers = {1}
+        for link in root.iter('a'):
+            href = link.get('href') or ''
+            match = FID_RE.search(href)
+            if match and int(match.group(1)) == forum_id:
+                page_match = re.search(r'page=(\d+)', href)
+                if page_match:
+                    page_numbers.add(int(page_match.group(1)))
+        return max(page_numbers)
+
+    def thread_listings(self, root, forum_id):
+        """Return the threads listed on a forumdisplay.php page"""
+        listings = {}
+        # Thread subjects are rendered as <span id="tid_N"><a href="showthread.php?tid=N">
+        for span in root.iter('span'):
+            span_id = span.get('id') or ''
+            if not span_id.startswith('tid_') or not span_id[4:].isdigit():
+                continue
+            thread_id = int(span_id[4:])
+            row = next(span.iterancestors('tr'), None)
+            replies = last_post_date = None
+            if row is not None:
+                for link in row.iter('a'):
+                    if 'whoPosted' in (link.get('href') or ''):
+                        replies_text = stripped_text(link).replace(',', '')
+                        if replies_text.isdigit():
+                            replies = int(replies_text)
+                        break
+                lastpost = find_first(row, 'span', 'lastpost')
+                if lastpost is not None and lastpost.text:
+                    last_post_date = parse_post_date(lastpost.text.strip())
+            listings[thread_id] = ThreadListing(thread_id, forum_id, replies, last_post_date)
+
+        # Threads linked in other ways (e.g. a theme without tid_ spans) are still real threads
+        for link in root.iter('a'):
+            if has_class(link, 'pagination_page'):
+                continue
+            match = TID_RE.search(link.get('href') or '')
+            if match and int(match.group(1)) not in listings:
+                thread_id = int(match.group(1))
+                listings[thread_id] = ThreadListing(thread_id, forum_id)
+        return list(listings.values())
+
+    async def crawl_forum(self, forum_id):
+        """Crawl every listing page of a board, returning (thread listings, linked board ids)"""
+        first = await self.fetch_root(config.FORUM_URL_TEMPLATE.format(fid=forum_id, page=1))
+        if first is None:
+            return [], set()
+        total_pages = self.number_of_pages(first, forum_id)
+        logger.info("Board %s: %s listing pages", forum_id, total_pages)
+        rest = await asyncio.gather(*(self.fetch_root(config.FORUM_URL_TEMPLATE.format(fid=forum_id, page=page_num))
+                                      for page_num in range(2, total_pages + 1)))
+        listings = []
+        fids = set()
+        for root in [first] + [root for root in rest if root is not None]:
+            listings.extend(self.thread_listings(root, forum_id))
+            fids |= self.forum_ids(root)
+        return listings, fids
+
+    async def discover(self):
+        """Crawl all boards reachable from the index, returning {thread_id: ThreadListing}"""
+        index = await self.fetch_root(config.INDEX_URL)
+        if index is None:
+            return {}
+        pending = self.forum_ids(index)
+        seen = set()
+        threads = {}
+        while pending:
+            seen |= pending
+            results = await asyncio.gather(*(self.crawl_forum(fid) for fid in sorted(pending)))
+            pending = set()
+            for listings, fids in results:
+                for listing in listings:
+                    # Prefer the row from the thread's own board over a link found elsewhere,
+                    # e.g. in a parent board's "last post" column
+                    existing = threads.get(listing.thread_id)
+                    if existing is None or (existing.replies is None and listing.replies is not None):
+                        threads[listing.thread_id] = listing
+                pending |= fids - seen
+        logger.info("Discovered %s threads in %s boards", len(threads), len(seen))
+        return threads
+
+
+async def discover_threads_async():
+    """Discover all thread listings of the forum, fetching listing pages concurrently"""
+    async with AsyncFetcher() as fetcher:
+        return await ForumDiscovery(fetcher).discover()
+
+
+def discover_threads():
+    """Discover all thread listings of the forum"""
+    return asyncio.run(discover_threads_async())
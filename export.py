@@ -0,0 +1,172 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+from itertools import groupby
+from operator import itemgetter
+from urllib.parse import quote
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+EXPORT_TABLES = ('users', 'threads', 'posts')
+# Column names and types of each exported table, in the order Database.EXPORT_QUERIES selects them
+EXPORT_COLUMNS = {
+    'users': (('username', 'string'), ('num_posts', 'int32'), ('num_threads', 'int32'),
+              ('joined_date', 'timestamp'), ('updated_at', 'timestamp')),
+    'threads': (('thread_id', 'int32'), ('thread_title', 'string'), ('board_name', 'string'),
+                ('date_posted', 'timestamp'), ('updated_at', 'timestamp')),
+    'posts': (('post_id', 'int32'), ('post_date', 'timestamp'), ('post_text', 'string'), ('username', 'string'),
+              ('thread_id', 'int32'), ('replies_to', 'int32'), ('updated_at', 'timestamp')),
+}
+# Tables that have a board and a month to be partitioned by
+PARTITIONED_TABLES = ('threads', 'posts')
+# Directory name of rows whose partition value is NULL, as Hive and pyarrow name it
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class JsonLinesWriter:
+    """Writes rows as gzip-compressed JSON objects, one per line"""
+    extension = '.jsonl.gz'
+
+    def __init__(self, path, columns):
+        self.names = [name for name, _ in columns]
+        self.file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=config.EXPORT_GZIP_LEVEL)
+
+    def write(self, rows):
+        self.file.writelines(json.dumps(dict(zip(self.names, row)), default=json_default, ensure_ascii=False) + '\n'
+                             for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes rows to a zstd-compressed Parquet file, one row group per chunk"""
+    extension = '.parquet'
+
+    def __init__(self, path, columns):
+        # pyarrow is only needed for Parquet output
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        types = {'string': pyarrow.string(), 'int32': pyarrow.int32(), 'timestamp': pyarrow.timestamp('us')}
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write(self, rows):
+        columns = zip(*rows)
+        arrays = [self.pyarrow.array(values, type=field.type) for field, values in zip(self.schema, columns)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'parquet': ParquetWriter, 'jsonl': JsonLinesWriter}
+
+
+class Exporter:
+    """Streams the users, threads and posts tables to files for offline analysis
+
+    Rows are read EXPORT_CHUNK_ROWS at a time from server-side cursors and written as they
+    arrive, ordered by partition, so only one chunk and one open file are held in memory.
+    Files go to <output_dir>/<table>/[<partition>=<value>/]part-<time>.<ext>, so every export
+    adds new files next to those of earlier exports.
+
+    All tables are read in one snapshot, up to a watermark saved per table and output
+    directory once the export succeeded; an incremental export starts from the saved one.
+    """
+
+    def __init__(self, output_dir=None, file_format=None, partition=None, chunk_rows=None):
+        self.output_dir = output_dir or config.EXPORT_DIR
+        self.file_format = file_format or config.EXPORT_FORMAT
+        self.partition = partition if partition is not None else config.EXPORT_PARTITION
+        if self.partition == 'none':
+            self.partition = None
+        self.chunk_rows = chunk_rows or config.EXPORT_CHUNK_ROWS
+        self.writer_class = WRITERS[self.file_format]
+        self.file_name = f"part-{time.strftime('%Y%m%dT%H%M%S')}{self.writer_class.extension}"
+
+    def export(self, tables=EXPORT_TABLES, incremental=False):
+        """Export tables, only the rows written since the last export to output_dir if incremental
+
+        Returns True if every table was exported.
+        """
+        destination = os.path.abspath(self.output_dir)
+        db = Database()
+        written = []
+        try:
+            watermarks = db.get_export_watermarks(destination) if incremental else {}
+            until = db.begin_export()
+            try:
+                upper = {}
+                for table in tables:
+                    since = watermarks.get(table)
+                    # A transaction older than the last export holds the watermark back; don't move it backwards
+                    upper[table] = max(since, until) if since else until
+                    self.export_table(db, table, since, upper[table], written)
+            finally:
+                db.end_export()
+            # Files only appear under their final names once every table was written
+            for temp_path, path in written:
+                os.replace(temp_path, path)
+            db.save_export_watermarks(destination, upper)
+            return True
+        except Exception as e:
+            logger.error("Error exporting to %s: %s", destination, e)
+            for temp_path, _ in written:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            return False
+        finally:
+            db.close()
+
+    def export_table(self, db, table, since, until, written):
+        """Write the rows of table updated in [since, until), one file per partition
+
+        (temporary path, final path) of each file is appended to written as it is opened.
+        """
+        started = time.monotonic()
+        columns = EXPORT_COLUMNS[table]
+        partition = self.partition if table in PARTITIONED_TABLES else None
+        files = len(written)
+        writer = None
+        current = None
+        rows = 0
+        try:
+            for chunk in db.export_rows(table, partition, since, until, self.chunk_rows):
+                for value, group in groupby(chunk, key=itemgetter(0)):
+                    if writer is None or value != current:
+                        if writer is not None:
+                            writer.close()
+                        current = value
+                        temp_path, path = self.file_paths(table, partition, value)
+                        written.append((temp_path, path))
+                        writer = self.writer_class(temp_path, columns)
+                    group = [row[1:] for row in group]
+                    writer.write(group)
+                    rows += len(group)
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info("Exported %s %s rows%s to %s files in %.1fs", rows, table,
+                    f" since {since}" if since else "", len(written) - files, time.monotonic() - started)
+
+    def file_paths(self, table, partition, value):
+        """Return the (temporary, final) path of the file of a partition, creating its directory"""
+        directory = os.path.join(self.output_dir, table)
+        if partition:
+            directory = os.path.join(directory, f"{partition}={NULL_PARTITION if value is None else quote(value, safe=' ')}")
+        os.makedirs(directory, exist_ok=True)
+        # Dot files are skipped by Parquet dataset readers until they are renamed
+        return os.path.join(directory, '.' + self.file_name), os.path.join(directory, self.file_name)
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import aiohttp
+import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def build_headers():
+    """Build the request headers, including the Cookie header from config"""
+    headers = dict(config.HEADERS)
+    if hasattr(config, 'COOKIES') and config.COOKIES:
+        cookie_parts = []
+        for name, value in config.COOKIES.items():
+            cookie_parts.append(f"{name}={value}")
+        headers['Cookie'] = '; '.join(cookie_parts)
+    return headers
+
+
+def is_permanent_error(status):
+    """Check if an HTTP status is a client error that retrying won't fix"""
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def parse_retry_after(value):
+    """Return the number of seconds a Retry-After header asks to wait, or None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RateLimiter:
+    """Token bucket limiting how many requests per second are started
+
+    Each request reserves the next free start time under a lock, so one limiter can be shared
+    by the sync scraper, async workers and the event loops of other threads, such as the media
+    downloader's. Waiting happens outside the lock. With adaptive set, the rate
+    is tuned from responses (AIMD): it grows additively while responses are healthy and is cut
+    multiplicatively on 429/5xx responses or when latency rises well above its baseline.
+    A Retry-After header pauses all requests for as long as the server asks.
+    """
+
+    def __init__(self, rate, burst=1, adaptive=False, min_rate=None, max_rate=None):
+        self.min_rate = min_rate or config.MIN_REQUESTS_PER_SECOND
+        self.max_rate = max(max_rate or config.MAX_REQUESTS_PER_SECOND, rate)
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.next_start = time.monotonic()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.latency = None
+        self.baseline_latency = None
+        self.latency_samples = 0
+        self.requests = 0
+        self.throttled = 0
+        self.last_report = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Reserve a start time for one request, returning how many seconds to wait for it"""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start - (self.burst - 1) / self.rate, self.paused_until)
+            self.next_start = max(self.next_start, start) + 1 / self.rate
+            self.requests += 1
+            metrics.set('scraper_rate_limit', self.rate)
+            if config.RATE_REPORT_INTERVAL and now - self.last_report >= config.RATE_REPORT_INTERVAL:
+                self.last_report = now
+                logger.info("Rate limiter: %.2f requests/sec, %s requests, %s throttled responses",
+                            self.rate, self.requests, self.throttled)
+            return start - now
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        await asyncio.sleep(self.reserve())
+
+    def acquire_sync(self):
+        """Blocking version of acquire"""
+        time.sleep(self.reserve())
+
+    def decrease(self, reason):
+        """Cut the rate multiplicatively, at most once per cooldown so one burst of errors counts once
+
+        Called with the lock held.
+        """
+        now = time.monotonic()
+        if now - self.last_decrease < max(1.0, self.latency or 0):
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * config.RATE_DECREASE_FACTOR)
+        logger.warning("Rate limiter: %s, slowing down to %.2f requests/sec", reason, self.rate)
+
+    def record_response(self, status, latency, retry_after=None):
+        """Adjust the limiter to a response: status is None if no response was received"""
+        with self.lock:
+            throttled = status == 429 or status is None or status >= 500
+            if throttled:
+                self.throttled += 1
+            if retry_after is not None and (status == 429 or status == 503):
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                logger.warning("Rate limiter: server asked to retry after %.0fs, pausing requests", retry_after)
+            if not self.adaptive:
+                return
+            if throttled:
+                self.decrease(f"HTTP {status}" if status else "request failed")
+                return
+
+            # Fast and slow moving averages of the latency of healthy responses
+            self.latency_samples += 1
+            if self.latency is None:
+                self.latency = self.baseline_latency = latency
+            self.latency += 0.3 * (latency - self.latency)
+            self.baseline_latency += 0.05 * (latency - self.baseline_latency)
+            if self.latency_samples >= 10 and self.latency > config.LATENCY_BACKOFF_FACTOR * self.baseline_latency:
+                self.decrease(f"latency rose to {self.latency:.2f}s")
+            else:
+                # About RATE_INCREASE requests/sec more for every second of healthy responses
+                self.rate = min(self.max_rate, self.rate + config.RATE_INCREASE / self.rate)
+
+    def snapshot(self):
+        """Return the current state of the limiter"""
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'latency': self.latency,
+                'baseline_latency': self.baseline_latency,
+                'paused_for': max(self.paused_until - time.monotonic(), 0),
+                'requests': self.requests,
+                'throttled': self.throttled,
+            }
+
+
+_shared_limiter = None
+
+
+def shared_limiter():
+    """Return the process-wide rate limiter used by every fetcher unless one is given"""
+    global _shared_limiter
+    if _shared_limiter is None:
+        _shared_limiter = RateLimiter(config.REQUESTS_PER_SECOND, adaptive=config.ADAPTIVE_RATE)
+    return _shared_limiter
+
+
+class AsyncFetcher:
+    """Concurrent page fetcher with global and per-host limits and a politeness budget"""
+
+    def __init__(self, max_concurrency=None, max_per_host=None, requests_per_second=None, limiter=None,
+                 timeout=None):
+        self.max_concurrency = max_concurrency or config.MAX_CONCURRENCY
+        self.max_per_host = max_per_host or config.MAX_CONCURRENCY_PER_HOST
+        if limiter is None:
+            limiter = RateLimiter(requests_per_second) if requests_per_second else shared_limiter()
+        self.limiter = limiter
+        self.timeout = timeout or config.TIMEOUT
+        self.global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.host_semaphores = {}
+        self.session = None
+        self.request_count = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Create the underlying HTTP session"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers=build_headers(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency,
+                                               limit_per_host=self.max_per_host)
+            )
+
+    def host_semaphore(self, url):
+        """Return the semaphore limiting concurrent requests to the host of url"""
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host_semaphores[host]
+
+    async def fetch_response(self, url, read=None):
+        """Fetch a URL and return (status, body)
+
+        status is the last HTTP status, or None if no response was received.
+        body is None if the fetch failed after MAX_RETRIES or with a client error.
+        With read, the body isn't read into memory: read(response) is awaited instead, on
+        every attempt, and what it returns is the body.
+        """
+        status = None
+        for attempt in range(config.MAX_RETRIES):
+            status = None
+            started = time.monotonic()
+            try:
+                async with self.global_semaphore, self.host_semaphore(url):
+                    await self.limiter.acquire()
+                    self.request_count += 1
+                    started = time.monotonic()
+                    async with self.session.get(url) as response:
+                        status = response.status
+                        self.limiter.record_response(status, time.monotonic() - started,
+                                                     parse_retry_after(response.headers.get('Retry-After')))
+                        metrics.inc('scraper_http_responses_total', status=status)
+                        response.raise_for_status()
+                        if read is not None:
+                            body = await read(response)
+                        else:
+                            body = await response.read()
+                            metrics.inc('scraper_downloaded_bytes_total', len(body))
+                        metrics.observe('scraper_http_request_seconds', time.monotonic() - started, client='async')
+                        return status, body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Attempt %s failed for %s: %s", attempt + 1, url, e)
+                if status is None:
+                    self.limiter.record_response(None, time.monotonic() - started)
+                    metrics.inc('scraper_http_responses_total', status='error')
+                if is_permanent_error(status):
+                    metrics.inc('scraper_http_failures_total')
+                    return status, None
+                if attempt < config.MAX_RETRIES - 1:
+                    metrics.inc('scraper_http_retries_total')
+                    await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                else:
+                    metrics.inc('scraper_http_failures_total')
+                    logger.error("Max retries exceeded for %s", url)
+        return status, None
+
+    async def fetch(self, url):
+        """Fetch a URL and return the response body as bytes, or None if it failed"""
+        return (await self.fetch_response(url))[1]
+
+    async def close(self):
+        """Close the underlying HTTP session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
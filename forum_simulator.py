@@ -0,0 +1,428 @@
+import argparse
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WORDS = ("the of and to in that is was for it with as on be at by this had not are but from or have an they which "
+         "one you were all there would their we been has when who will more no if out so said what up about into "
+         "than them can only other new some could time these two may then do first any my now such like our over "
+         "made after also did many before must through back years where much your way well down should because each").split()
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+THREADS_PER_LISTING_PAGE = 20
+# Distinct attachment contents and uploaded images posts link to
+ATTACHMENT_CONTENTS = 20
+UPLOADED_IMAGES = 50
+
+
+def format_date(date):
+    """Format a date the way myBB shows it, e.g. 09-Dec-2021, 10:06 PM"""
+    return (f"{date.day:02d}-{MONTHS[date.month - 1]}-{date.year}, "
+            f"{(date.hour - 1) % 12 + 1}:{date.minute:02d} {'AM' if date.hour < 12 else 'PM'}")
+
+
+class SimulatedThread:
+    """A thread of the synthetic forum"""
+    __slots__ = ('thread_id', 'forum_id', 'title', 'posts', 'started', 'missing')
+
+    def __init__(self, thread_id, forum_id, title, posts, started, missing):
+        self.thread_id = thread_id
+        self.forum_id = forum_id
+        self.title = title
+        self.posts = posts
+        self.started = started
+        self.missing = missing
+
+
+class SimulatedForum:
+    """A deterministic synthetic myBB forum
+
+    Thread tids run from 1 to `threads`, spread over `boards` boards. Every thread, post and
+    user is derived from the seed and the tid, so pages look the same on every request and
+    the expected contents of the database can be computed without storing anything.
+    """
+
+    def __init__(self, threads=1000, boards=10, posts_per_page=10, max_pages=20, mean_posts=25,
+                 missing_rate=0.05, users=500, seed=0):
+        self.threads = threads
+        self.boards = boards
+        self.posts_per_page = posts_per_page
+        self.max_posts = posts_per_page * max_pages
+        self.mean_posts = mean_posts
+        self.missing_rate = missing_rate
+        self.users = users
+        self.seed = seed
+        self.board_threads = {forum_id: [] for forum_id in range(1, boards + 1)}
+        for thread_id in range(1, threads + 1):
+            thread = self.thread(thread_id)
+            if not thread.missing:
+                self.board_threads[thread.forum_id].append(thread_id)
+
+    def rng(self, *key):
+        return random.Random(f"{self.seed}:" + ':'.join(map(str, key)))
+
+    def thread(self, thread_id):
+        """Return the SimulatedThread of a tid, or None if it is out of range"""
+        if not 1 <= thread_id <= self.threads:
+            return None
+        rng = self.rng('thread', thread_id)
+        missing = rng.random() < self.missing_rate
+        # Most threads are short, a few run to many pages
+        posts = min(1 + int(rng.expovariate(1 / self.mean_posts)), self.max_posts)
+        started = datetime(2015, 1, 1) + timedelta(minutes=rng.randrange(9 * 365 * 24 * 60))
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8))).capitalize()
+        return SimulatedThread(thread_id, 1 + thread_id % self.boards, title, posts, started, missing)
+
+    def pages(self, thread):
+        return (thread.posts + self.posts_per_page - 1) // self.posts_per_page
+
+    def post_id(self, thread, n):
+        return thread.thread_id * self.max_posts + n
+
+    def expected_posts(self):
+        """Return {thread_id: number of posts} of the threads that exist"""
+        return {thread_id: self.thread(thread_id).posts
+                for thread_ids in self.board_threads.values() for thread_id in thread_ids}
+
+    def user(self, uid):
+        return f"member{uid}", 10 + uid * 7 % 5000, 1 + uid % 300, f"{MONTHS[uid % 12]} {2010 + uid % 12}"
+
+    def post_html(self, thread, n):
+        rng = self.rng('post', thread.thread_id, n)
+        post_id = self.post_id(thread, n)
+        uid = rng.randrange(1, self.users + 1)
+        username, posts, threads, joined = self.user(uid)
+        date = thread.started + timedelta(hours=n * 3, minutes=rng.randrange(60))
+        body = []
+        if n > 1 and rng.random() < 0.3:
+            quoted = rng.randint(1, n - 1)
+            quoted_id = self.post_id(thread, quoted)
+            body.append(f'<blockquote class="mycode_quote"><cite><span> ({format_date(date)})</span>member{quoted} Wrote: '
+                        f'<a href="showthread.php?pid={quoted_id}#pid{quoted_id}" class="quick_jump"></a></cite>'
+                        f'{self.sentences(rng, 1)}</blockquote>')
+        for _ in range(rng.randint(1, 4)):
+            body.append(self.sentences(rng, rng.randint(1, 4)))
+        if rng.random() < 0.2:
+            body.append(f'<a href="https://www.example.org/{rng.choice(WORDS)}/{rng.randrange(10000)}" '
+                        f'target="_blank" rel="noopener" class="mycode_url">{self.sentences(rng, 1)}</a>')
+        if rng.random() < 0.1:
+            image = rng.randrange(UPLOADED_IMAGES)
+            body.append(f'<img src="images/uploads/{image}.png" loading="lazy" alt="[Image: {image}.png]" class="mycode_img" />')
+        if rng.random() < 0.05:
+            body.append('<img src="images/smilies/smile.png" alt="Smile" title="Smile" class="smilie smilie_1" />')
+        attachments = ''
+        if rng.random() < 0.1:
+            aid = rng.randrange(1, 10 * ATTACHMENT_CONTENTS + 1)
+            attachments = (f'<fieldset><legend><strong>Attached Files</strong></legend>'
+                           f'<a href="attachment.php?aid={aid}" target="_blank" title="">file{aid}.pdf</a></fieldset>')
+        return f'''<a name="pid{post_id}" id="pid{post_id}"></a>
+<div class="post " style="" id="post_{post_id}">
+<div class="post_author">
+<div class="author_information"><strong><span class="largetext"><a href="member.php?action=profile&amp;uid={uid}">{username}</a></span></strong><br /></div>
+<div class="author_statistics">Posts: {posts:,}<br />Threads: {threads:,}<br />Joined: {joined}</div>
+</div>
+<div class="post_content">
+<div class="post_head"><span class="post_date">{format_date(date)}</span></div>
+<div class="post_body scaleimages" id="pid_{post_id}">
+{'<br />'.join(body)}
+</div>
+{attachments}
+</div>
+</div>'''
+
+    def attachment(self, aid):
+        """Return the content of an attachment, or None if there is no such aid
+
+        Attachments whose aids differ by a multiple of ATTACHMENT_CONTENTS have the same
+        content, like a file uploaded twice.
+        """
+        if not 1 <= aid <= 10 * ATTACHMENT_CONTENTS:
+            return None
+        rng = self.rng('attachment', aid % ATTACHMENT_CONTENTS)
+        return b'%PDF-1.4\n' + rng.randbytes(rng.randint(1000, 200000))
+
+    def uploaded_image(self, name):
+        """Return the content of an image under images/uploads/, or None if there is no such image"""
+        stem = name.removesuffix('.png')
+        if not stem.isdigit() or int(stem) >= UPLOADED_IMAGES:
+            return None
+        rng = self.rng('image', int(stem))
+        return b'\x89PNG\r\n\x1a\n' + rng.randbytes(rng.randint(500, 50000))
+
+    def sentences(self, rng, count):
+        return ' '.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 16))).capitalize() + '.'
+                        for _ in range(count))
+
+    def pagination(self, script, key, value, page_num, pages):
+        if pages <= 1:
+            return ''
+        items = [f'<span class="pages">Pages ({pages}):</span>']
+        for page in range(max(1, page_num - 2), min(pages, page_num + 2) + 1):
+            if page == page_num:
+                items.append(f'<span class="pagination_current">{page}</span>')
+            else:
+                items.append(f'<a href="{script}?{key}={value}&amp;page={page}" class="pagination_page">{page}</a>')
+        if page_num + 2 < pages:
+            items.append(f'... <a href="{script}?{key}={value}&amp;page={pages}" class="pagination_last">{pages}</a>')
+        if page_num < pages:
+            items.append(f'<a href="{script}?{key}={value}&amp;page={page_num + 1}" class="pagination_next">Next &raquo;</a>')
+        return '<div class="pagination">' + ' '.join(items) + '</div>'
+
+    def showthread(self, thread_id, page_num):
+        """Return the HTML of a thread page, or the error page for a missing thread"""
+        thread = self.thread(thread_id)
+        if thread is None or thread.missing:
+            return ('<html><head><title>Support Forum</title></head><body><div id="content">'
+                    '<div class="error"><strong>Error</strong><br />The specified thread was not found.</div>'
+                    '</div></body></html>')
+        pages = self.pages(thread)
+        if not 1 <= page_num <= pages:
+            page_num = 1  # what myBB's showthread.php does
+        pagination = self.pagination('showthread.php', 'tid', thread_id, page_num, pages)
+        first = (page_num - 1) * self.posts_per_page + 1
+        posts = '\n'.join(self.post_html(thread, n)
+                          for n in range(first, min(first + self.posts_per_page, thread.posts + 1)))
+        return f'''<html><head><title>{escape(thread.title)}</title></head><body>
+<div class="navigation"><a href="index.php">Support Forum</a> &rsaquo; <a href="forumdisplay.php?fid={thread.forum_id}">Board {thread.forum_id}</a>
+<br /><span class="active">{escape(thread.title)}</span></div>
+<div class="float_left">{pagination}</div>
+<div id="posts">
+{posts}
+</div>
+<div class="float_left">{pagination}</div>
+</body></html>'''
+
+    def forumdisplay(self, forum_id, page_num):
+        """Return the HTML of a board's thread listing page"""
+        thread_ids = sorted(self.board_threads.get(forum_id, ()), reverse=True)
+        pages = max((len(thread_ids) + THREADS_PER_LISTING_PAGE - 1) // THREADS_PER_LISTING_PAGE, 1)
+        page_num = min(max(page_num, 1), pages)
+        rows = []
+        for thread_id in thread_ids[(page_num - 1) * THREADS_PER_LISTING_PAGE:page_num * THREADS_PER_LISTING_PAGE]:
+            thread = self.thread(thread_id)
+            last_post = thread.started + timedelta(hours=thread.posts * 3)
+            rows.append(f'<tr class="inline_row"><td><span class=" subject_old" id="tid_{thread_id}">'
+                        f'<a href="showthread.php?tid={thread_id}">{escape(thread.title)}</a></span></td>'
+                        f'<td><a href="javascript:MyBB.whoPosted({thread_id});">{thread.posts - 1:,}</a></td>'
+                        f'<td><span class="lastpost smalltext">{format_date(last_post)}<br />'
+                        f'<a href="showthread.php?tid={thread_id}&amp;action=lastpost">Last Post</a></span></td></tr>')
+        pagination = self.pagination('forumdisplay.php', 'fid', forum_id, page_num, pages)
+        return f'''<html><head><title>Board {forum_id}</title></head><body>
+<div class="navigation"><a href="index.php">Support Forum</a> &rsaquo; <span class="active">Board {forum_id}</span></div>
+{pagination}
+<table class="tborder clear">{''.join(rows)}</table>
+{pagination}
+</body></html>'''
+
+    def index(self):
+        """Return the HTML of the board index"""
+        links = ''.join(f'<tr><td><strong><a href="forumdisplay.php?fid={forum_id}">Board {forum_id}</a></strong></td></tr>'
+                        for forum_id in self.board_threads)
+        return f'<html><head><title>Support Forum</title></head><body><table class="tborder">{links}</table></body></html>'
+
+
+class Faults:
+    """What fraction of responses go wrong, and how"""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, rate_429=0.0, retry_after=1, rate_5xx=0.0,
+                 truncate_rate=0.0, seed=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.truncate_rate = truncate_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def pick(self):
+        """Return (delay in seconds, fault or None) for the next response"""
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.latency_jitter)
+            roll = self.rng.random()
+        for fault, rate in (('429', self.rate_429), ('5xx', self.rate_5xx), ('truncated', self.truncate_rate)):
+            if roll < rate:
+                return delay, fault
+            roll -= rate
+        return delay, None
+
+    def error_status(self):
+        with self.lock:
+            return self.rng.choice((500, 502, 503))
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        script = url.path.rsplit('/', 1)[-1]
+        delay, fault = simulator.faults.pick()
+        if delay:
+            time.sleep(delay)
+
+        def number(name, default):
+            try:
+                return int(query.get(name, [default])[0])
+            except ValueError:
+                return default
+
+        content_type = 'text/html; charset=UTF-8'
+        body = None
+        if script == 'showthread.php':
+            body = simulator.forum.showthread(number('tid', 0), number('page', 1)).encode()
+        elif script == 'forumdisplay.php':
+            body = simulator.forum.forumdisplay(number('fid', 0), number('page', 1)).encode()
+        elif script in ('', 'index.php'):
+            body = simulator.forum.index().encode()
+        elif script == 'attachment.php':
+            body, content_type = simulator.forum.attachment(number('aid', 0)), 'application/pdf'
+        elif url.path.endswith(f'/images/uploads/{script}'):
+            body, content_type = simulator.forum.uploaded_image(script), 'image/png'
+        if body is None:
+            simulator.record(self.path, 404, None)
+            self.send_body(404, b'')
+            return
+
+        if fault == '429':
+            simulator.record(self.path, 429, fault)
+            self.send_body(429, b'', {'Retry-After': str(simulator.faults.retry_after)})
+        elif fault == '5xx':
+            status = simulator.faults.error_status()
+            simulator.record(self.path, status, fault)
+            self.send_body(status, b'<html><body>Internal Server Error</body></html>')
+        else:
+            simulator.record(self.path, 200, fault)
+            self.send_body(200, body, truncate=fault == 'truncated', content_type=content_type)
+
+    def send_body(self, status, body, headers=None, truncate=False, content_type='text/html; charset=UTF-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if truncate:
+            # Drop the connection half way through the promised body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up, e.g. after a truncated body, are part of the simulation
+        pass
+
+
+class ForumSimulator:
+    """Serves a SimulatedForum over HTTP from a background thread, injecting faults
+
+    Counts every response by status and fault, and how often each URL was requested, so a
+    harness can tell retries apart from first requests.
+    """
+
+    def __init__(self, forum, faults=None, host='127.0.0.1', port=0):
+        self.forum = forum
+        self.faults = faults or Faults()
+        self.server = SimulatorServer((host, port), SimulatorHandler)
+        self.server.simulator = self
+        self.thread = None
+        self.lock = threading.Lock()
+        self.statuses = Counter()
+        self.faults_injected = Counter()
+        self.requests_per_url = Counter()
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, path, status, fault):
+        with self.lock:
+            self.statuses[status] += 1
+            if fault:
+                self.faults_injected[fault] += 1
+            self.requests_per_url[path] += 1
+
+    def stats(self):
+        """Return a summary of the requests served so far"""
+        with self.lock:
+            requests = sum(self.requests_per_url.values())
+            return {
+                'requests': requests,
+                'urls': len(self.requests_per_url),
+                'retries': requests - len(self.requests_per_url),
+                'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+                'faults': dict(self.faults_injected),
+            }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='forum-simulator', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def add_simulator_arguments(parser):
+    """Add the options describing the simulated forum and its faults to an argument parser"""
+    parser.add_argument('--threads', type=int, default=1000, help="number of thread IDs in the forum")
+    parser.add_argument('--boards', type=int, default=10, help="number of boards")
+    parser.add_argument('--posts-per-page', type=int, default=10, help="posts on a full thread page")
+    parser.add_argument('--max-pages', type=int, default=20, help="most pages a thread can have")
+    parser.add_argument('--mean-posts', type=int, default=25, help="average posts per thread")
+    parser.add_argument('--missing-rate', type=float, default=0.05, help="fraction of thread IDs that don't exist")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated forum and faults")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+    parser.add_argument('--latency-jitter', type=float, default=0, help="up to this many more seconds, at random")
+    parser.add_argument('--rate-429', type=float, default=0, help="fraction of responses that are 429s")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After of the 429s, in seconds")
+    parser.add_argument('--rate-5xx', type=float, default=0, help="fraction of responses that are 500/502/503s")
+    parser.add_argument('--truncate-rate', type=float, default=0,
+                        help="fraction of responses whose connection drops half way through the body")
+
+
+def simulator_from_args(args, host='127.0.0.1', port=0):
+    """Build a ForumSimulator from the options added by add_simulator_arguments"""
+    forum = SimulatedForum(args.threads, args.boards, args.posts_per_page, args.max_pages, args.mean_posts,
+                           args.missing_rate, seed=args.seed)
+    faults = Faults(args.latency, args.latency_jitter, args.rate_429, args.retry_after, args.rate_5xx,
+                    args.truncate_rate, args.seed)
+    return ForumSimulator(forum, faults, host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic myBB forum for load testing the scraper")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+    simulator = simulator_from_args(args, args.host, args.port)
+    print(f"Serving a forum of {args.threads} threads at {simulator.base_url}/showthread.php")
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server.server_close()
+        print(simulator.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import logging
+import os
+import socket
+import threading
+import time
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    """Return a name identifying this process across hosts"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseHeartbeat:
+    """Background thread extending the leases of a worker's jobs on its own connection"""
+
+    def __init__(self, worker, lease_seconds=None, interval=None):
+        self.worker = worker
+        self.lease_seconds = lease_seconds or config.JOB_LEASE_SECONDS
+        self.interval = interval or config.JOB_HEARTBEAT_SECONDS
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lease-heartbeat', daemon=True)
+
+    def run(self):
+        db = Database()
+        try:
+            while not self.stopped.wait(self.interval):
+                db.extend_leases(self.worker, self.lease_seconds)
+        finally:
+            db.close()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class CrawlWorker:
+    """Scrapes threads claimed from the shared crawl_jobs queue until it is empty
+
+    Any number of workers on any number of hosts can run against the same database.
+    Jobs are leased in batches; the heartbeat keeps the leases alive while the batch is
+    scraped, and a job is only marked done after its rows are written. Threads that failed
+    or were only partly scraped go back to pending until they were tried JOB_MAX_ATTEMPTS
+    times. If a worker dies, its leases expire and the jobs are claimed again by another worker.
+    """
+
+    # Thread outcomes (see ForumScraper.scrape_threads) worth another attempt
+    RETRY_OUTCOMES = ('partial', 'http_error', 'error')
+
+    def __init__(self, scraper, batch_size=None):
+        self.scraper = scraper
+        self.db = scraper.db
+        self.batch_size = batch_size or config.JOB_BATCH_SIZE
+        self.worker = worker_name()
+
+    def run(self, concurrent=None):
+        """Claim and scrape batches of jobs until none are left"""
+        heartbeat = LeaseHeartbeat(self.worker)
+        heartbeat.start()
+        batches = 0
+        try:
+            while True:
+                thread_ids = self.db.claim_jobs(self.worker, self.batch_size,
+                                                config.JOB_LEASE_SECONDS, config.JOB_MAX_ATTEMPTS)
+                if not thread_ids:
+                    # Jobs leased by other workers may still come back if those workers die
+                    if self.db.get_job_counts().get('running'):
+                        time.sleep(config.JOB_POLL_SECONDS)
+                        continue
+                    break
+                batches += 1
+                logger.info("Worker %s claimed %s jobs (threads %s-%s)",
+                            self.worker, len(thread_ids), thread_ids[0], thread_ids[-1])
+                try:
+                    # The negative cache would skip a job retried after an HTTP error, so it isn't used
+                    outcomes = self.scraper.scrape_threads(thread_ids, concurrent, use_negative_cache=False)
+                except BaseException:
+                    # Hand the batch back so another worker can take it right away
+                    self.db.finish_jobs(self.worker, thread_ids, 'pending')
+                    raise
+                retry = [thread_id for thread_id in thread_ids if outcomes[thread_id] in self.RETRY_OUTCOMES]
+                self.db.finish_jobs(self.worker, [thread_id for thread_id in thread_ids if thread_id not in retry])
+                if retry:
+                    logger.info("Worker %s: %s threads failed and go back to the queue", self.worker, len(retry))
+                    self.db.retry_jobs(self.worker, retry, config.JOB_MAX_ATTEMPTS)
+        finally:
+            heartbeat.stop()
+        logger.info("Worker %s finished after %s batches", self.worker, batches)
+
+
+def print_job_counts(db):
+    """Print how many crawl jobs are in each state"""
+    counts = db.get_job_counts()
+    print(', '.join(f"{status}: {counts.get(status, 0)}"
+                    for status in ('pending', 'running', 'expired', 'done', 'failed')))
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import sys
+import time
+import psycopg2
+import config
+from forum_simulator import add_simulator_arguments, simulator_from_args
+from logs import configure_logging
+from metrics import metrics
+
+
+def point_config_at(base_url):
+    """Send all forum requests to base_url instead of the real forum"""
+    config.BASE_URL = base_url
+    config.THREAD_URL_TEMPLATE = base_url + "/showthread.php?tid={tid}&page={page}"
+    config.PRINT_THREAD_URL_TEMPLATE = base_url + "/printthread.php?tid={tid}&page={page}"
+    config.INDEX_URL = base_url + "/index.php"
+    config.FORUM_URL_TEMPLATE = base_url + "/forumdisplay.php?fid={fid}&page={page}"
+
+
+def connect():
+    return psycopg2.connect(host=config.DB_HOST, port=config.DB_PORT, database=config.DB_NAME,
+                            user=config.DB_USER, password=config.DB_PASSWORD)
+
+
+def stored_posts(conn):
+    """Return {thread_id: number of posts} and the set of threads recorded as missing"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT thread_id, COUNT(*) FROM posts GROUP BY thread_id")
+        posts = dict(cursor.fetchall())
+        cursor.execute("SELECT thread_id FROM crawl_misses WHERE outcome = 'not_found'")
+        misses = {row[0] for row in cursor.fetchall()}
+    return posts, misses
+
+
+def completeness(expected, posts, misses, thread_ids):
+    """Compare what was stored with what the simulated forum holds"""
+    complete = sum(1 for thread_id, count in expected.items() if posts.get(thread_id) == count)
+    partial = sum(1 for thread_id, count in expected.items() if 0 < posts.get(thread_id, 0) < count)
+    missing_tids = set(thread_ids) - set(expected)
+    return {
+        'threads_expected': len(expected),
+        'threads_complete': complete,
+        'threads_partial': partial,
+        'threads_absent': len(expected) - complete - partial,
+        'posts_expected': sum(expected.values()),
+        'posts_stored': sum(posts.get(thread_id, 0) for thread_id in expected),
+        'unexpected_threads': len(set(posts) - set(expected)),
+        'missing_tids': len(missing_tids),
+        'missing_tids_recorded': len(missing_tids & misses),
+    }
+
+
+def run(args):
+    """Crawl a simulated forum into a scratch schema and return the report"""
+    simulator = simulator_from_args(args).start()
+    point_config_at(simulator.base_url)
+    config.REQUESTS_PER_SECOND = args.requests_per_second
+    config.MAX_CONCURRENCY = args.concurrency
+    config.MAX_CONCURRENCY_PER_HOST = args.concurrency
+    config.DELAY_BETWEEN_REQUESTS = 0
+    config.ARCHIVE_PAGES = False
+
+    # Every connection the scraper opens uses the scratch schema, so the configured
+    # database is never touched
+    schema = f"loadtest_{os.getpid()}"
+    admin = connect()
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+    os.environ['PGOPTIONS'] = f"-c search_path={schema}"
+
+    from database import Database
+    from scraper import ForumScraper
+    try:
+        db = Database()
+        db.create_tables()
+        db.close()
+        scraper = ForumScraper()
+        started = time.monotonic()
+        try:
+            if args.discover:
+                scraper.scrape_discovered(not args.sequential)
+            else:
+                thread_ids = range(1, args.threads + 1)
+                scraper.scrape_threads(thread_ids, not args.sequential)
+        finally:
+            limiter = scraper.limiter.snapshot()
+            scraper.close()
+        elapsed = time.monotonic() - started
+
+        conn = connect()
+        try:
+            posts, misses = stored_posts(conn)
+        finally:
+            conn.close()
+    finally:
+        simulator.stop()
+        with admin.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        admin.close()
+
+    server = simulator.stats()
+    expected = simulator.forum.expected_posts()
+    thread_ids = [] if args.discover else range(1, args.threads + 1)
+    data = completeness(expected, posts, misses, thread_ids)
+    pages = server['statuses'].get('200', 0) - server['faults'].get('truncated', 0)
+    return {
+        'elapsed_seconds': elapsed,
+        'requests_per_sec': server['requests'] / elapsed,
+        'pages_per_sec': pages / elapsed,
+        'posts_per_sec': data['posts_stored'] / elapsed,
+        'limiter': limiter,
+        'metrics': metrics.snapshot(),
+        'server': server,
+        'completeness': data,
+    }
+
+
+def print_report(report):
+    server = report['server']
+    data = report['completeness']
+    print(f"\nCrawled in {report['elapsed_seconds']:.1f}s: {report['requests_per_sec']:.1f} requests/sec, "
+          f"{report['pages_per_sec']:.1f} pages/sec, {report['posts_per_sec']:.0f} posts/sec")
+    print(f"Requests: {server['requests']} for {server['urls']} URLs ({server['retries']} retries), "
+          f"statuses {server['statuses']}, faults injected {server['faults']}")
+    print(f"Rate limiter ended at {report['limiter']['rate']:.1f} requests/sec after "
+          f"{report['limiter']['throttled']} throttled responses")
+    print(f"Threads: {data['threads_complete']}/{data['threads_expected']} complete, "
+          f"{data['threads_partial']} partial, {data['threads_absent']} absent, "
+          f"{data['unexpected_threads']} unexpected")
+    print(f"Posts: {data['posts_stored']}/{data['posts_expected']} stored "
+          f"({data['posts_stored'] / max(data['posts_expected'], 1):.1%})")
+    if data['missing_tids']:
+        print(f"Missing thread IDs recorded as not found: {data['missing_tids_recorded']}/{data['missing_tids']}")
+    for name, histogram in report['metrics']['histograms'].items():
+        print(f"{name}: {histogram['count']} observed, p50 <= {histogram['p50']}s, p90 <= {histogram['p90']}s, "
+              f"p99 <= {histogram['p99']}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Crawl a local simulated myBB forum end to end and report "
+                                                 "throughput, retries and how much of the forum was stored")
+    add_simulator_arguments(parser)
+    parser.add_argument('--discover', action='store_true', help="find threads from the board listings")
+    parser.add_argument('--sequential', action='store_true', help="scrape one thread at a time")
+    parser.add_argument('--concurrency', type=int, default=config.MAX_CONCURRENCY,
+                        help="concurrent requests (MAX_CONCURRENCY)")
+    parser.add_argument('--requests-per-second', type=float, default=100,
+                        help="starting request rate (REQUESTS_PER_SECOND)")
+    parser.add_argument('--output', help="also save the report as JSON")
+    parser.add_argument('--quiet', action='store_true', help="hide the scraper's output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    configure_logging('ERROR' if args.quiet else None)
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    data = report['completeness']
+    sys.exit(0 if data['threads_complete'] == data['threads_expected'] else 1)
+
+
+if __name__ == "__main__":
+    main()
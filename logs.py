@@ -0,0 +1,50 @@
+import json
+import logging
+import sys
+import config
+
+# Attributes every LogRecord has; anything else was passed in `extra` and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line
+
+    'event' is the unformatted message, so all records of one kind share it and can be
+    counted or filtered without parsing the text; 'args' holds the values filled into it.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'event': record.msg if isinstance(record.msg, str) else str(record.msg),
+        }
+        if record.args:
+            entry['args'] = record.args if isinstance(record.args, dict) else list(record.args)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(level=None, log_format=None, path=None):
+    """Send the scraper's log to stdout or a file, as plain text or JSON lines"""
+    path = path or config.LOG_FILE
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    if (log_format or config.LOG_FORMAT) == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel((level or config.LOG_LEVEL).upper())
+    # Keep the HTTP libraries' own chatter out of the scraper's log
+    for name in ('urllib3', 'asyncio'):
+        logging.getLogger(name).setLevel(logging.WARNING)
@@ -0,0 +1,436 @@
+import logging
+import re
+from urllib.parse import parse_qs, urlparse
+from lxml import etree
+from lxml.cssselect import CSSSelector
+import config
+from metrics import timed
+from page_parser import PostRecord, is_thumbnail, media_kind, media_url, parse_joined_date, parse_post_date
+
+logger = logging.getLogger(__name__)
+
+# Strings inside these tags are left out of get_text() by BeautifulSoup, so they are skipped here too
+SKIPPED_TAGS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+
+POST_ID_RE = re.compile(r'post_\d+')
+CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+def has_class(element, name):
+    """Check if element's class attribute contains name, like BeautifulSoup's class_ matching"""
+    classes = element.get('class')
+    return classes is not None and (classes == name or name in classes.split())
+
+
+def iter_strings(element):
+    """Yield the text nodes of element's subtree in document order, as get_text() sees them"""
+    if element.text is not None:
+        yield element.text
+    for child in element:
+        if isinstance(child.tag, str) and child.tag not in SKIPPED_TAGS:
+            yield from iter_strings(child)
+        if child.tail is not None:
+            yield child.tail
+
+
+def text_content(element):
+    """Equivalent of BeautifulSoup's get_text()"""
+    return ''.join(iter_strings(element))
+
+
+def stripped_text(element):
+    """Equivalent of BeautifulSoup's get_text(strip=True)"""
+    return ''.join(s for s in (s.strip() for s in iter_strings(element)) if s)
+
+
+def find_first(element, tag, class_name):
+    """Return the first descendant with the given tag and class, or None"""
+    for descendant in element.iter(tag):
+        if descendant is not element and has_class(descendant, class_name):
+            return descendant
+    return None
+
+
+def has_ancestor(element, tag, class_name):
+    """Check if any ancestor has the given tag and class"""
+    for ancestor in element.iterancestors(tag):
+        if has_class(ancestor, class_name):
+            return True
+    return False
+
+
+def normalize_lines(lines):
+    """Strip trailing whitespace, compress runs of blank lines and drop leading/trailing blank lines"""
+    result = []
+    for line in lines:
+        line = line.rstrip()
+        if line == '':
+            if not result or result[-1] != '':
+                result.append('')
+        else:
+            result.append(line)
+    while result and result[0] == '':
+        result.pop(0)
+    while result and result[-1] == '':
+        result.pop(-1)
+    return result
+
+
+class LxmlThreadParser:
+    """lxml engine producing the same rows as ThreadParser
+
+    Each post is walked once: a single pass over its descendants finds the date, body,
+    username and statistics elements, and a single pass over the body builds the text
+    with reply quotes removed, links rewritten and quotes prefixed with "> ", without
+    copying or modifying the tree.
+    """
+
+    @timed('scraper_parse_seconds', stage='document')
+    def parse_document(self, content):
+        """Parse a fetched page body into an lxml element tree"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+            encoding = 'utf-8'
+        else:
+            # Use the declared charset like BeautifulSoup does, falling back when it doesn't decode
+            match = CHARSET_RE.search(content[:4096])
+            encoding = match.group(1).decode('ascii').lower() if match else 'utf-8'
+            try:
+                content.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                content = content.decode('windows-1252', errors='replace').encode('utf-8')
+                encoding = 'utf-8'
+        root = etree.fromstring(content, etree.HTMLParser(encoding=encoding)) if content.strip() else None
+        return root if root is not None else etree.Element('html')
+
+    def count_posts(self, root):
+        """Return the number of posts on a thread page"""
+        return len(self.find_posts(root))
+
+    def find_posts(self, root):
+        """Return the post elements of a thread page in document order"""
+        return [div for div in root.iter('div') if POST_ID_RE.search(div.get('id') or '')]
+
+    def is_not_found(self, root):
+        """Check if a thread page is the forum's "not found" error page"""
+        error_msg = find_first(root, 'div', 'error')
+        return error_msg is not None and 'not found' in text_content(error_msg).lower()
+
+    def is_forbidden(self, root):
+        """Check if a thread page is the forum's "no permission" page instead of a thread"""
+        if self.count_posts(root):
+            return False
+        return config.NO_PERMISSION_TEXT in text_content(root).lower()
+
+    def extract_number_of_pages(self, root, thread_id=None, script='showthread.php'):
+        """Extract the total number of pages from the first page of a thread"""
+        page_numbers = set()
+        for link in root.iter('a'):
+            href = link.get('href')
+            if href is None or script not in href or f'tid={thread_id}' not in href:
+                continue
+            if 'page=' in href:
+                match = re.search(r'page=(\d+)', href)
+                if match:
+                    page_numbers.add(int(match.group(1)))
+            text = stripped_text(link)
+            if text.isdigit():
+                try:
+                    page_numbers.add(int(text))
+                except ValueError:
+                    pass
+
+        # Fall back to the pagination div, skipping the forum pagination in the breadcrumb
+        if not page_numbers:
+            for pagination in root.iter('div'):
+                if not has_class(pagination, 'pagination') or has_ancestor(pagination, 'div', 'navigation'):
+                    continue
+                for link in pagination.iter('a'):
+                    text = stripped_text(link)
+                    if text.isdigit():
+                        try:
+                            page_numbers.add(int(text))
+                        except ValueError:
+                            pass
+                if page_numbers:
+                    break
+
+        page_numbers.add(1)
+        return max(page_numbers)
+
+    @timed('scraper_parse_seconds', stage='post')
+    def parse_post_record(self, post_element):
+        """Extract a PostRecord from a post element in one pass over its descendants"""
+        date_elem = body_elem = username_elem = stats_div = None
+        for element in post_element.iter('span', 'div'):
+            if element is post_element:
+                continue
+            classes = element.get('class')
+            if classes is None:
+                continue
+            classes = classes.split()
+            if element.tag == 'span':
+                if date_elem is None and 'post_date' in classes:
+                    date_elem = element
+                elif username_elem is None and 'largetext' in classes:
+                    username_elem = element
+            elif body_elem is None and 'post_body' in classes:
+                body_elem = element
+            elif stats_div is None and 'author_statistics' in classes:
+                stats_div = element
+
+        post_id = None
+        post_id_attr = post_element.get('id')
+        if post_id_attr:
+            match = re.search(r'(\d+)', post_id_attr)
+            if match:
+                post_id = int(match.group(1))
+        if not post_id:
+            logger.debug("Could not extract post_id from %s", post_id_attr)
+
+        post_date = None
+        if date_elem is not None:
+            date_text = stripped_text(date_elem)
+            if '(' in date_text:
+                date_text = date_text.split('(')[0].strip()
+            post_date = parse_post_date(date_text)
+        if not post_date:
+            logger.debug("Could not parse date for post %s", post_id)
+
+        post_text = None
+        replies_to = None
+        if body_elem is not None:
+            post_text = self.body_text(body_elem)
+            replies_to = self.replies_to(body_elem)
+        if not post_text:
+            logger.debug("Could not find post_body in post %s", post_id)
+
+        username = None
+        if username_elem is not None:
+            # Registered users are linked, unregistered ones are plain text
+            username_link = next(username_elem.iter('a'), None)
+            username = stripped_text(username_link if username_link is not None else username_elem)
+        if not username:
+            logger.debug("Could not find username in post %s", post_id)
+
+        num_posts = num_threads = joined_date = None
+        if stats_div is not None:
+            stats_text = text_content(stats_div)
+            posts_match = re.search(r'Posts:\s*(\d+)', stats_text)
+            if posts_match:
+                num_posts = int(posts_match.group(1))
+            threads_match = re.search(r'Threads:\s*(\d+)', stats_text)
+            if threads_match:
+                num_threads = int(threads_match.group(1))
+            joined_match = re.search(r'Joined:\s*(\w+\s+\d{4})', stats_text)
+            if joined_match:
+                joined_date = parse_joined_date(joined_match.group(1))
+                if not joined_date:
+                    logger.debug("Could not parse joined date '%s' for user %s", joined_match.group(1), username)
+
+        return PostRecord(post_id, post_date, post_text, username,
+                          num_posts, num_threads, joined_date, replies_to)
+
+    def parse_post(self, post_element, thread_id):
+        """Parse individual post from a post element"""
+        record = self.parse_post_record(post_element)
+        return record.post_id, record.post_date, record.post_text, record.username, record.replies_to
+
+    def is_reply_quote(self, blockquote):
+        """Check if a mycode_quote blockquote quotes another post (its first cite links to a pid)"""
+        cite = self.first_cite(blockquote)
+        if cite is None:
+            return False
+        return any('pid=' in a.get('href') for a in cite.iter('a') if a.get('href') is not None)
+
+    def first_cite(self, element):
+        """Return the first <cite> below element, ignoring cites of nested reply quotes"""
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            if child.tag == 'cite':
+                return child
+            if child.tag == 'blockquote' and has_class(child, 'mycode_quote') and self.is_reply_quote(child):
+                continue
+            cite = self.first_cite(child)
+            if cite is not None:
+                return cite
+        return None
+
+    def link_text(self, a_tag):
+        """Return the text a link is rewritten to"""
+        href = a_tag.get('href').strip()
+        inner_text = stripped_text(a_tag)
+        # Truncated link texts like "https://example.com/a/ve...long" are replaced by the full URL
+        is_truncated = ('...' in inner_text) or \
+                       (href.startswith('http') and not inner_text.startswith('http'))
+        if href and is_truncated:
+            return href
+        if href and href != inner_text:
+            return f"{inner_text} ({href})"
+        return inner_text
+
+    def body_strings(self, element, out, in_quote=False):
+        """Append the text nodes of a post body to out, with links, quotes and <br> rewritten"""
+        if element.text is not None:
+            out.append(element.text)
+        for child in element:
+            tag = child.tag
+            if isinstance(tag, str) and tag not in SKIPPED_TAGS:
+                if tag == 'br':
+                    out.append('\n')
+                elif tag == 'a' and child.get('href') is not None:
+                    out.append(self.link_text(child))
+                elif tag == 'blockquote' and has_class(child, 'mycode_quote'):
+                    if not self.is_reply_quote(child):
+                        if in_quote:
+                            # Quotes nested in a quote are part of the outer quote's text
+                            self.body_strings(child, out, in_quote=True)
+                        else:
+                            out.append(self.quote_text(child))
+                else:
+                    self.body_strings(child, out, in_quote)
+            if child.tail is not None:
+                out.append(child.tail)
+
+    def quote_text(self, blockquote):
+        """Return a quote as text with each line prefixed by "> " """
+        out = []
+        self.body_strings(blockquote, out, in_quote=True)
+        lines = [line.rstrip() for line in '\n'.join(out).split('\n')]
+        while lines and lines[0] == '':
+            lines.pop(0)
+        while lines and lines[-1] == '':
+            lines.pop(-1)
+        quoted_lines = []
+        for line in lines:
+            if line == '':
+                if quoted_lines and quoted_lines[-1] == '>':
+                    continue
+                quoted_lines.append('>')
+            else:
+                quoted_lines.append(f"> {line}")
+        return '\n'.join(quoted_lines)
+
+    def body_text(self, body_elem):
+        """Return the normalized text of a post body"""
+        out = []
+        self.body_strings(body_elem, out)
+        post_text = '\n'.join(normalize_lines('\n'.join(out).split('\n'))).strip()
+        if not post_text:
+            post_text = ''.join(s for s in (s.strip() for s in out) if s)
+        return post_text
+
+    def replies_to(self, body_elem):
+        """Return the pid quoted by the first top-level quote of a post body"""
+        for blockquote in body_elem.iterchildren('blockquote'):
+            if not has_class(blockquote, 'mycode_quote'):
+                continue
+            cite = next(blockquote.iter('cite'), None)
+            if cite is None:
+                return None
+            link = next(cite.iter('a'), None)
+            if link is None:
+                return None
+            href = link.get('href', '')
+            try:
+                pid_values = parse_qs(urlparse(href).query).get('pid')
+                if pid_values and pid_values[0].isdigit():
+                    return int(pid_values[0])
+            except Exception as e:
+                logger.debug("Could not parse href %s: %s", href, e)
+            return None
+        return None
+
+    def parse_media(self, root):
+        """Return (post_id, url, kind) of the attachments and inline images of the posts on a page, see ThreadParser.parse_media"""
+        media_rows = []
+        for post in self.find_posts(root):
+            post_id = int(re.search(r'(\d+)', post.get('id')).group(1))
+            urls = {}
+            for a_tag in post.iter('a'):
+                url = media_url(a_tag.get('href')) if a_tag.get('href') is not None else None
+                if url and media_kind(url) == 'attachment':
+                    urls.setdefault(url, 'attachment')
+            post_body = find_first(post, 'div', 'post_body')
+            if post_body is not None:
+                for img in post_body.iter('img'):
+                    url = media_url(img.get('src')) if img.get('src') is not None else None
+                    if url and not is_thumbnail(url) and not has_class(img, 'smilie'):
+                        urls.setdefault(url, media_kind(url))
+            media_rows.extend((post_id, url, kind) for url, kind in urls.items())
+        return media_rows
+
+    def board_name(self, root):
+        """Return the breadcrumb path of a thread page, without pagination links"""
+        nav_div = find_first(root, 'div', 'navigation')
+        if nav_div is None:
+            return None
+        link_texts = []
+        for a in nav_div.iter('a'):
+            classes = a.get('class')
+            if classes and any(cls.startswith('pagination_') for cls in classes.split()):
+                continue
+            if has_ancestor(a, 'div', 'pagination'):
+                continue
+            link_texts.append(stripped_text(a))
+        return ' › '.join(link_texts) if link_texts else None
+
+    @timed('scraper_parse_seconds', stage='page')
+    def parse_thread_page(self, thread_id, page_num, root):
+        """Parse a fetched thread page into plain rows
+
+        Returns (thread_row, user_rows, post_rows), or None if page 1 has no thread title.
+        thread_row is only set on page 1.
+        """
+        thread_row = None
+        user_rows = []
+        post_rows = []
+
+        if page_num == 1:
+            title_elem = next(root.iter('title'), None)
+            thread_title = stripped_text(title_elem) if title_elem is not None else None
+            board_name = self.board_name(root)
+
+            # Thread date is the date of the first post
+            thread_date = None
+            first_post = find_first(root, 'div', 'post')
+            if first_post is not None:
+                date_elem = find_first(first_post, 'span', 'post_date')
+                if date_elem is not None:
+                    date_text = stripped_text(date_elem)
+                    if '(' in date_text:
+                        date_text = date_text.split('(')[0].strip()
+                    thread_date = parse_post_date(date_text)
+
+            total_pages = self.extract_number_of_pages(root, thread_id)
+            if thread_title:
+                thread_row = (thread_id, thread_title, board_name, thread_date)
+                logger.info("Thread %s: %s (Board: %s) - %s pages", thread_id, thread_title, board_name, total_pages)
+            else:
+                logger.warning("Thread %s: Could not extract thread title, not saving thread to database", thread_id)
+                return None
+
+        posts = self.find_posts(root)
+        logger.debug("Found %s posts on page %s", len(posts), page_num)
+        for post in posts:
+            record = self.parse_post_record(post)
+            if record.post_id and record.username:
+                user_rows.append(record.user_row())
+                post_rows.append(record.post_row(thread_id))
+            else:
+                logger.warning("Failed to parse post from element %s", post.get('id'))
+
+        return thread_row, user_rows, post_rows
+
+    def parse_print_posts(self, thread_id, print_roots):
+        """Parse the posts of a thread's print view in thread order, or None if one can't be parsed"""
+        selector = CSSSelector(config.PRINT_POST_SELECTOR)
+        parsed = []
+        for root in print_roots:
+            for post in selector(root):
+                post_id, post_date, post_text, username, replies_to = self.parse_post(post, thread_id)
+                if not (post_id and username):
+                    return None
+                parsed.append((post_id, post_date, post_text, username, replies_to))
+        return parsed
@@ -0,0 +1,145 @@
+import asyncio
+import itertools
+import logging
+import os
+import threading
+from collections import Counter
+from hashlib import sha256
+import config
+from database import Database
+from fetcher import AsyncFetcher, is_permanent_error
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def media_path(media_dir, digest):
+    """Return the file path of a downloaded file with the given content hash"""
+    return os.path.join(media_dir, 'objects', digest[:2], digest)
+
+
+class MediaDownloader:
+    """Downloads the attachments and images recorded in post_media
+
+    Runs in a thread of its own with its own event loop, fetching through an AsyncFetcher
+    that shares the process-wide rate limiter, so media and pages draw on one request budget.
+    Each distinct URL is fetched once for all the posts linking to it. Bodies are streamed to
+    a temporary file while they are hashed, then renamed to MEDIA_DIR/objects/ab/<sha256>
+    unless a file with the same content is already there.
+    """
+
+    def __init__(self, media_dir=None, concurrency=None, batch_size=None):
+        self.media_dir = media_dir or config.MEDIA_DIR
+        self.concurrency = concurrency or config.MEDIA_CONCURRENCY
+        self.batch_size = batch_size or config.MEDIA_BATCH_SIZE
+        # stopped ends the downloads after those in flight, finishing once nothing is pending
+        self.stopped = threading.Event()
+        self.finishing = threading.Event()
+        self.temp_names = itertools.count()
+        self.counts = Counter()
+        self.thread = threading.Thread(target=self.run, name='media-downloader', daemon=True)
+
+    def run(self):
+        db = Database()
+        try:
+            os.makedirs(os.path.join(self.media_dir, 'tmp'), exist_ok=True)
+            asyncio.run(self.download_pending(db))
+        except Exception as e:
+            logger.error("Error downloading media: %s", e)
+        finally:
+            db.close()
+        if self.counts:
+            logger.info("Media files: %s", ', '.join(f"{count} {outcome}" for outcome, count in sorted(self.counts.items())))
+
+    async def download_pending(self, db):
+        """Download the pending URLs a batch at a time until stopped, or until none are left once finishing"""
+        async with AsyncFetcher(max_concurrency=self.concurrency, timeout=config.MEDIA_TIMEOUT) as fetcher:
+            while not self.stopped.is_set():
+                pending = await asyncio.to_thread(db.get_pending_media, self.batch_size)
+                if not pending:
+                    if self.finishing.is_set():
+                        return
+                    await asyncio.to_thread(self.finishing.wait, config.MEDIA_POLL_SECONDS)
+                    continue
+                batch = iter(pending)
+
+                async def worker():
+                    for url, attempts in batch:
+                        if self.stopped.is_set():
+                            return
+                        await self.download(db, fetcher, url, attempts)
+
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def download(self, db, fetcher, url, attempts):
+        """Download one URL and record the outcome for the posts linking to it
+
+        An error saving the body counts as a failed attempt; a local I/O error also stops the
+        downloads, as it would fail every other one the same way.
+        """
+        error = None
+        try:
+            status, saved = await fetcher.fetch_response(url, read=self.save)
+        except Exception as e:
+            logger.error("Error saving %s: %s", url, e)
+            error, status, saved = e, None, None
+        if saved is None:
+            outcome = 'failed' if is_permanent_error(status) or attempts + 1 >= config.MEDIA_MAX_ATTEMPTS else 'retry'
+            await asyncio.to_thread(db.finish_media, url, 'failed' if outcome == 'failed' else 'pending', status)
+        else:
+            outcome, digest, size, content_type = saved
+            await asyncio.to_thread(db.finish_media, url, 'too_large' if outcome == 'too_large' else 'done',
+                                    status, digest, content_type, size)
+        self.counts[outcome] += 1
+        metrics.inc('scraper_media_files_total', outcome=outcome)
+        if isinstance(error, OSError):
+            logger.error("Stopping media downloads after a local I/O error")
+            self.stopped.set()
+
+    async def save(self, response):
+        """Stream a response body to a temporary file while hashing it, then move it to its content address
+
+        Returns (outcome, sha256, size, content_type), outcome being 'new', 'duplicate' or
+        'too_large' for bodies over MEDIA_MAX_BYTES, which are not kept.
+        """
+        content_type = response.content_type
+        if response.content_length is not None and response.content_length > config.MEDIA_MAX_BYTES:
+            return 'too_large', None, response.content_length, content_type
+        temp_path = os.path.join(self.media_dir, 'tmp', f"{os.getpid()}.{next(self.temp_names)}.tmp")
+        digest = sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(config.MEDIA_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > config.MEDIA_MAX_BYTES:
+                        return 'too_large', None, None, content_type
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            path = media_path(self.media_dir, digest)
+            if os.path.exists(path):
+                return 'duplicate', digest, size, content_type
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            return 'new', digest, size, content_type
+        finally:
+            metrics.inc('scraper_downloaded_bytes_total', size)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, finish=True):
+        """Wait for the pending URLs to be downloaded, or unless finish only for the downloads in flight"""
+        if not finish:
+            self.stopped.set()
+        self.finishing.set()
+        self.thread.join()
+
+    def download_all(self):
+        """Download every pending URL in the calling thread"""
+        self.finishing.set()
+        self.run()
@@ -0,0 +1,273 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a fraction of a post's parse time up to a slow HTTP request
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+DESCRIPTIONS = {
+    'scraper_http_request_seconds': ('histogram', "Time from sending a request to reading its body"),
+    'scraper_http_responses_total': ('counter', "HTTP responses by status"),
+    'scraper_http_retries_total': ('counter', "Requests that were retried"),
+    'scraper_http_failures_total': ('counter', "Fetches given up after MAX_RETRIES or a client error"),
+    'scraper_downloaded_bytes_total': ('counter', "Response bytes downloaded"),
+    'scraper_media_files_total': ('counter', "Media URLs downloaded or given up, by outcome"),
+    'scraper_parse_seconds': ('histogram', "Time spent parsing, by stage (document, page, post)"),
+    'scraper_db_write_seconds': ('histogram', "Time to upsert one batch, by table"),
+    'scraper_db_flush_seconds': ('histogram', "Time to flush and commit all buffered rows"),
+    'scraper_db_rows_written_total': ('counter', "Rows sent to the database, by table"),
+    'scraper_db_buffered_rows': ('gauge', "Rows buffered for the next flush"),
+    'scraper_db_pool_connections': ('gauge', "Open database connections in the pool, by state"),
+    'scraper_db_pool_wait_seconds': ('histogram', "Time to check a connection out of the pool"),
+    'scraper_db_reconnects_total': ('counter', "Broken database connections replaced"),
+    'scraper_queue_depth': ('gauge', "Items waiting in a pipeline queue"),
+    'scraper_rate_limit': ('gauge', "Current requests per second of the rate limiter"),
+    'scraper_threads_total': ('counter', "Threads finished, by outcome"),
+}
+
+
+class Histogram:
+    """Counts of observations per latency bucket, plus their sum"""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Timer:
+    """Context manager observing its duration in a histogram"""
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class Metrics:
+    """Process-wide counters, gauges and latency histograms
+
+    Recording is a dict lookup and an addition under a lock, cheap enough to leave on for
+    every request, page, post and database write.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Time a block into the histogram name"""
+        return Timer(self, name, labels)
+
+    def take(self):
+        """Return and reset the counters and histograms, for handing over to another process"""
+        with self.lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return counters, {key: (histogram.counts, histogram.sum, histogram.count)
+                          for key, histogram in histograms.items()}
+
+    def merge(self, taken):
+        """Add what take() returned in another process"""
+        counters, histograms = taken
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def snapshot(self):
+        """Return all metrics as a JSON-serialisable dict"""
+        def name(key):
+            metric, labels = key
+            return metric + ('{' + ','.join(f'{k}={v}' for k, v in labels) + '}' if labels else '')
+
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': {name(key): value for key, value in sorted(self.counters.items())},
+                'gauges': {name(key): value for key, value in sorted(self.gauges.items())},
+                'histograms': {name(key): {'count': histogram.count, 'sum': histogram.sum,
+                                           'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9),
+                                           'p99': histogram.quantile(0.99)}
+                               for key, histogram in sorted(self.histograms.items())},
+            }
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        def labels_text(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        described = set()
+
+        def describe(metric, kind):
+            if metric not in described:
+                described.add(metric)
+                kind, help_text = DESCRIPTIONS.get(metric, (kind, None))
+                if help_text:
+                    lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} {kind}")
+
+        with self.lock:
+            for (metric, labels), value in sorted(self.counters.items()):
+                describe(metric, 'counter')
+                lines.append(f"{metric}{labels_text(labels)} {value}")
+            for (metric, labels), value in sorted(self.gauges.items()):
+                describe(metric, 'gauge')
+                lines.append(f"{metric}{labels_text(labels)} {value}")
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                describe(metric, 'histogram')
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_sum{labels_text(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{labels_text(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed(name, **labels):
+    """Decorator timing every call of a function into the histogram name"""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics.json':
+            body = json.dumps(metrics.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            body = metrics.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsExporter:
+    """Serves the metrics over HTTP and/or writes them to a JSON file periodically"""
+
+    def __init__(self, port=None, path=None, interval=None):
+        self.port = port or config.METRICS_PORT
+        self.path = path or config.METRICS_FILE
+        self.interval = interval or config.METRICS_INTERVAL
+        self.server = None
+        self.stopped = threading.Event()
+        self.writer = None
+
+    def write(self):
+        """Replace the metrics file with the current metrics"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(metrics.snapshot(), f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.error("Error writing metrics to %s: %s", self.path, e)
+
+    def start(self):
+        if self.port:
+            self.server = ThreadingHTTPServer(('', self.port), MetricsHandler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+            logger.info("Serving metrics at http://localhost:%d/metrics", self.port)
+        if self.path:
+            self.writer = threading.Thread(target=self.write_periodically, name='metrics-writer', daemon=True)
+            self.writer.start()
+            logger.info("Writing metrics to %s every %ss", self.path, self.interval)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            try:
+                self.write()
+            except OSError as e:
+                logger.error("Error writing metrics to %s: %s", self.path, e)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
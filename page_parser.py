@@ -0,0 +1,544 @@
+import logging
+import re
+from datetime import datetime
+from functools import lru_cache
+from urllib.parse import parse_qs, urljoin, urlparse
+from bs4 import BeautifulSoup
+import config
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4096)
+def parse_post_date(date_text):
+    """Parse a myBB post date like "09-Dec-2021, 10:06 PM", or return None"""
+    # Try common formats seen in the sample
+    for fmt in ('%d-%b-%Y, %I:%M %p', '%d-%b-%Y, %H:%M'):
+        try:
+            return datetime.strptime(date_text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+@lru_cache(maxsize=1024)
+def parse_joined_date(joined_str):
+    """Parse a joined date like "Dec 2021" (day set to 1), or return None"""
+    try:
+        return datetime.strptime(joined_str, '%b %Y')
+    except ValueError:
+        # Try alternative format maybe with extra spaces
+        try:
+            return datetime.strptime(joined_str.strip(), '%b %Y')
+        except ValueError:
+            return None
+
+
+def media_url(url):
+    """Return the absolute URL of an attachment or image, or None if it isn't fetched over http(s)"""
+    url = urljoin(config.BASE_URL + '/', url.strip())
+    return url if urlparse(url).scheme in ('http', 'https') else None
+
+
+def media_kind(url):
+    """Return 'attachment' for myBB attachment.php URLs and 'image' for anything else"""
+    return 'attachment' if urlparse(url).path.endswith('/attachment.php') else 'image'
+
+
+def is_thumbnail(url):
+    """Check if url is the thumbnail of an attachment, whose link is collected instead"""
+    return media_kind(url) == 'attachment' and 'thumbnail' in parse_qs(urlparse(url).query)
+
+
+class PostRecord:
+    """Everything extracted from one post element"""
+    __slots__ = ('post_id', 'post_date', 'post_text', 'username',
+                 'num_posts', 'num_threads', 'joined_date', 'replies_to')
+    
+    def __init__(self, post_id, post_date, post_text, username,
+                 num_posts, num_threads, joined_date, replies_to):
+        self.post_id = post_id
+        self.post_date = post_date
+        self.post_text = post_text
+        self.username = username
+        self.num_posts = num_posts
+        self.num_threads = num_threads
+        self.joined_date = joined_date
+        self.replies_to = replies_to
+    
+    def user_row(self):
+        return (self.username, self.num_posts, self.num_threads, self.joined_date)
+    
+    def post_row(self, thread_id):
+        return (self.post_id, self.post_date, self.post_text, self.username, thread_id, self.replies_to)
+
+
+def make_parser(engine=None):
+    """Return a parser for the configured engine ('lxml' or 'bs4')"""
+    engine = engine or config.PARSER_ENGINE
+    if engine == 'lxml':
+        from lxml_parser import LxmlThreadParser
+        return LxmlThreadParser()
+    if engine == 'bs4':
+        return ThreadParser()
+    raise ValueError(f"Unknown parser engine: {engine}")
+
+
+class ThreadParser:
+    """Turns fetched myBB pages into plain rows, without any network or database access
+    
+    This is the BeautifulSoup engine; LxmlThreadParser produces the same rows faster.
+    """
+    
+    @timed('scraper_parse_seconds', stage='document')
+    def parse_document(self, content):
+        """Parse a fetched page body into the document object the other methods take"""
+        return BeautifulSoup(content, 'lxml')
+    
+    def count_posts(self, soup):
+        """Return the number of posts on a thread page"""
+        return len(soup.find_all('div', id=re.compile(r'post_\d+')))
+    
+    def extract_number_of_pages(self, soup, thread_id=None, script='showthread.php'):
+        """Extract the total number of pages from the first page of a thread"""
+        # First, try to find pagination specific to this thread
+        # Look for links that point to showthread.php (or script) with this thread_id
+        page_numbers = set()
+        
+        # Find all links
+        for link in soup.find_all('a', href=True):
+            href = link['href']
+            # Check if it's a showthread.php link for this thread
+            if script in href and f'tid={thread_id}' in href:
+                # Extract page number from the href
+                # Look for page= parameter
+                if 'page=' in href:
+                    # Parse the page number
+                    match = re.search(r'page=(\d+)', href)
+                    if match:
+                        try:
+                            page_num = int(match.group(1))
+                            page_numbers.add(page_num)
+                        except ValueError:
+                            pass
+                # Also check if the link text is a number (for numbered pagination)
+                text = link.get_text(strip=True)
+                if text.isdigit():
+                    try:
+                        page_num = int(text)
+                        page_numbers.add(page_num)
+                    except ValueError:
+                        pass
+        
+        # Also look for traditional pagination div as a fallback,
+        # but exclude pagination that is inside navigation breadcrumb (forum pagination)
+        if not page_numbers:
+            pagination_divs = soup.find_all('div', class_='pagination')
+            for pagination in pagination_divs:
+                # Skip if inside navigation breadcrumb
+                if pagination.find_parent('div', class_='navigation'):
+                    continue
+                page_links = pagination.find_all('a')
+                for link in page_links:
+                    text = link.get_text(strip=True)
+                    if text.isdigit():
+                        try:
+                            page_numbers.add(int(text))
+                        except ValueError:
+                            pass
+                # If we found any page numbers from this pagination div, break
+                if page_numbers:
+                    break
+        
+        # Include page 1 always
+        page_numbers.add(1)
+        
+        if page_numbers:
+            return max(page_numbers)
+        else:
+            return 1
+    
+    def parse_user_info(self, post_element):
+        """Extract user information from a post element"""
+        username = None
+        num_posts = None
+        num_threads = None
+        joined_date = None
+        
+        # Find username from largetext
+        username_elem = post_element.find('span', class_='largetext')
+        if username_elem:
+            # First try to find an <a> tag (for registered users)
+            username_link = username_elem.find('a')
+            if username_link:
+                username = username_link.get_text(strip=True)
+            else:
+                # If no <a> tag, get the text directly (for unregistered users)
+                username = username_elem.get_text(strip=True)
+        
+        # Find author_statistics div
+        stats_div = post_element.find('div', class_='author_statistics')
+        if stats_div:
+            stats_text = stats_div.get_text()
+            # Parse Posts: X
+            posts_match = re.search(r'Posts:\s*(\d+)', stats_text)
+            if posts_match:
+                num_posts = int(posts_match.group(1))
+            # Parse Threads: X
+            threads_match = re.search(r'Threads:\s*(\d+)', stats_text)
+            if threads_match:
+                num_threads = int(threads_match.group(1))
+            # Parse Joined: MMM YYYY
+            joined_match = re.search(r'Joined:\s*(\w+\s+\d{4})', stats_text)
+            if joined_match:
+                joined_str = joined_match.group(1)
+                joined_date = parse_joined_date(joined_str)
+                if not joined_date:
+                    # Debug output
+                    logger.debug("Could not parse joined date '%s' for user %s", joined_str, username)
+        
+        return username, num_posts, num_threads, joined_date
+    
+    @timed('scraper_parse_seconds', stage='post')
+    def parse_post(self, post_element, thread_id):
+        """Parse individual post from a post element"""
+        # Extract post ID
+        post_id = None
+        post_id_elem = post_element.get('id')
+        if post_id_elem:
+            match = re.search(r'(\d+)', post_id_elem)
+            if match:
+                post_id = int(match.group(1))
+        if not post_id:
+            logger.debug("Could not extract post_id from %s", post_id_elem)
+        
+        # Extract post date
+        post_date = None
+        date_elem = post_element.find('span', class_='post_date')
+        if date_elem:
+            date_text = date_elem.get_text(strip=True)
+            # Remove any trailing edited indicator
+            # Example: "09-Dec-2021, 10:06 PM " or "09-Dec-2021, 10:06 PM (This post was last modified: ...)"
+            # We'll try to parse the part before the first '('
+            if '(' in date_text:
+                date_text = date_text.split('(')[0].strip()
+            post_date = parse_post_date(date_text)
+        if not post_date:
+            logger.debug("Could not parse date from element %s", date_elem)
+        
+        # Extract post text
+        post_text = None
+        text_elem = post_element.find('div', class_='post_body')
+        if text_elem:
+            # Make a copy to avoid modifying the original
+            text_elem_copy = BeautifulSoup(str(text_elem), 'lxml')
+            
+            # First, identify and remove reply blockquotes (those with post IDs)
+            # We need to do this before processing <a> tags to preserve the href for detection
+            all_blockquotes = list(text_elem_copy.find_all('blockquote', class_='mycode_quote'))
+            for blockquote in reversed(all_blockquotes):
+                # Check if the blockquote still exists (may have been removed by parent decomposition)
+                if not blockquote or not blockquote.parent:
+                    continue
+                    
+                # Check if this blockquote has a <cite> element containing a link with pid=
+                # This indicates it's a reply to another post
+                is_reply_quote = False
+                cite_elem = blockquote.find('cite')
+                if cite_elem:
+                    # Look for any <a> tag within the cite that has 'pid=' in href
+                    for a_tag in cite_elem.find_all('a', href=True):
+                        href = a_tag.get('href', '')
+                        if 'pid=' in href:
+                            is_reply_quote = True
+                            break
+                
+                # If it's a reply quote, remove it entirely
+                if is_reply_quote:
+                    blockquote.decompose()
+            
+            # Now process all remaining <a> tags to ensure URLs are valid
+            for a_tag in text_elem_copy.find_all('a', href=True):
+                href = a_tag.get('href', '').strip()
+                inner_text = a_tag.get_text(strip=True)
+                
+                # Check if the inner text appears to be a truncated URL
+                # Common patterns: contains "...", ends with "...", or is clearly a partial URL
+                is_truncated = ('...' in inner_text) or \
+                               (inner_text.startswith('http') and '...' in inner_text) or \
+                               (href.startswith('http') and not inner_text.startswith('http'))
+                
+                if href and is_truncated:
+                    # Replace the entire tag with the full URL
+                    a_tag.replace_with(href)
+                elif href and href != inner_text:
+                    # Keep the link text but append the full URL in parentheses
+                    # Replace the tag with: "text (url)"
+                    a_tag.replace_with(f"{inner_text} ({href})")
+                else:
+                    # If href and inner_text are the same, or no href, just keep the text
+                    a_tag.replace_with(inner_text)
+            
+            # Now process remaining blockquote elements (regular quotes, not replies)
+            # These are blockquotes that weren't removed in the first pass
+            remaining_blockquotes = list(text_elem_copy.find_all('blockquote', class_='mycode_quote'))
+            for blockquote in remaining_blockquotes:
+                # Check if the blockquote still exists
+                if not blockquote or not blockquote.parent:
+                    continue
+                
+                # Before processing, replace <br> tags inside the blockquote with newlines
+                for br in blockquote.find_all('br'):
+                    br.replace_with('\n')
+                
+                # Get the text from the blockquote, preserving newlines
+                quote_text = blockquote.get_text(separator='\n', strip=False)
+                # Split into lines and process
+                lines = quote_text.split('\n')
+                # Clean up each line
+                cleaned_lines = []
+                for line in lines:
+                    line = line.rstrip()
+                    cleaned_lines.append(line)
+                # Remove leading and trailing empty lines
+                while cleaned_lines and cleaned_lines[0] == '':
+                    cleaned_lines.pop(0)
+                while cleaned_lines and cleaned_lines[-1] == '':
+                    cleaned_lines.pop(-1)
+                # Compress multiple consecutive empty lines within the quote to single empty lines
+                compressed_lines = []
+                for line in cleaned_lines:
+                    if line == '':
+                        if not compressed_lines or compressed_lines[-1] != '':
+                            compressed_lines.append('')
+                    else:
+                        compressed_lines.append(line)
+                # Prefix each line with "> " to indicate it's a quote
+                quoted_lines = []
+                for line in compressed_lines:
+                    if line == '':
+                        quoted_lines.append('>')
+                    else:
+                        quoted_lines.append(f"> {line}")
+                # Join them back with newlines
+                formatted_quote = '\n'.join(quoted_lines)
+                # Replace the blockquote with the formatted quote text
+                blockquote.replace_with(formatted_quote)
+            
+            # Replace <br> tags with newlines to preserve line breaks
+            for br in text_elem_copy.find_all('br'):
+                br.replace_with('\n')
+            
+            # Get text with newlines preserved
+            raw_text = text_elem_copy.get_text(separator='\n', strip=False)
+            
+            # Split into lines and process each line
+            lines = raw_text.split('\n')
+            processed_lines = []
+            
+            for line in lines:
+                # Strip trailing whitespace, but keep leading whitespace (for indentation)
+                line = line.rstrip()
+                # Skip empty lines that are between other empty lines (compress multiple blank lines)
+                if line == '':
+                    if not processed_lines or processed_lines[-1] != '':
+                        processed_lines.append('')
+                else:
+                    processed_lines.append(line)
+            
+            # Remove leading empty lines
+            while processed_lines and processed_lines[0] == '':
+                processed_lines.pop(0)
+            # Remove trailing empty lines
+            while processed_lines and processed_lines[-1] == '':
+                processed_lines.pop(-1)
+            
+            # Join lines back together
+            post_text = '\n'.join(processed_lines)
+            
+            # Remove leading/trailing whitespace
+            post_text = post_text.strip()
+            
+            # If post_text is empty after processing, try a different approach
+            if not post_text:
+                # Fallback to original method
+                post_text = text_elem_copy.get_text(strip=True)
+        if not post_text:
+            logger.debug("Could not find post_body in post %s", post_id)
+        
+        # Extract username (same as in parse_user_info)
+        username = None
+        username_elem = post_element.find('span', class_='largetext')
+        if username_elem:
+            # First try to find an <a> tag (for registered users)
+            username_link = username_elem.find('a')
+            if username_link:
+                username = username_link.get_text(strip=True)
+            else:
+                # If no <a> tag, get the text directly (for unregistered users)
+                username = username_elem.get_text(strip=True)
+        if not username:
+            logger.debug("Could not find username in post %s", post_id)
+        
+        # Extract replies_to from blockquote
+        replies_to = None
+        # Find the post_body element
+        post_body = post_element.find('div', class_='post_body')
+        if post_body:
+            # Look for blockquote elements that are direct children of post_body
+            # We want the top-level reply, which should be the first direct child blockquote
+            blockquotes = post_body.find_all('blockquote', class_='mycode_quote', recursive=False)
+            if blockquotes:
+                # Take the first top-level blockquote
+                blockquote = blockquotes[0]
+                # Find the link inside the blockquote's cite
+                cite = blockquote.find('cite')
+                if cite:
+                    # Look for a link
+                    link = cite.find('a')
+                    if link:
+                        href = link.get('href', '')
+                        # Parse the URL to extract the pid parameter
+                        try:
+                            parsed = urlparse(href)
+                            query_params = parse_qs(parsed.query)
+                            if 'pid' in query_params:
+                                pid_value = query_params['pid'][0]
+                                if pid_value.isdigit():
+                                    replies_to = int(pid_value)
+                        except Exception as e:
+                            logger.debug("Could not parse href %s: %s", href, e)
+        
+        return post_id, post_date, post_text, username, replies_to
+    
+    @timed('scraper_parse_seconds', stage='page')
+    def parse_thread_page(self, thread_id, page_num, soup):
+        """Parse a fetched thread page into plain rows
+        
+        Returns (thread_row, user_rows, post_rows), or None if page 1 has no thread title.
+        thread_row is only set on page 1.
+        """
+        thread_row = None
+        user_rows = []
+        post_rows = []
+        
+        # On first page, extract thread info so it is stored before the posts
+        if page_num == 1:
+            # Extract thread title
+            thread_title = None
+            title_elem = soup.find('title')
+            if title_elem:
+                thread_title = title_elem.get_text(strip=True)
+            
+            # Extract board name from navigation breadcrumb
+            board_name = None
+            nav_div = soup.find('div', class_='navigation')
+            if nav_div:
+                # Find all <a> tags that are not part of pagination
+                links = []
+                for a in nav_div.find_all('a'):
+                    # Skip pagination links
+                    if a.get('class') and any(cls.startswith('pagination_') for cls in a.get('class')):
+                        continue
+                    # Also skip if inside a div with class 'pagination'
+                    parent_div = a.find_parent('div', class_='pagination')
+                    if parent_div:
+                        continue
+                    links.append(a)
+                if links:
+                    # Combine all link texts to form full breadcrumb path
+                    link_texts = [link.get_text(strip=True) for link in links]
+                    board_name = ' › '.join(link_texts)
+            
+            # Extract thread date (from first post's date)
+            thread_date = None
+            first_post = soup.find('div', class_='post')
+            if first_post:
+                date_elem = first_post.find('span', class_='post_date')
+                if date_elem:
+                    date_text = date_elem.get_text(strip=True)
+                    if '(' in date_text:
+                        date_text = date_text.split('(')[0].strip()
+                    thread_date = parse_post_date(date_text)
+            
+            # Get total pages
+            total_pages = self.extract_number_of_pages(soup, thread_id)
+            
+            # Insert thread info if we have a title
+            if thread_title:
+                thread_row = (thread_id, thread_title, board_name, thread_date)
+                logger.info("Thread %s: %s (Board: %s) - %s pages", thread_id, thread_title, board_name, total_pages)
+            else:
+                logger.warning("Thread %s: Could not extract thread title, not saving thread to database", thread_id)
+                # Without a thread title, we can't insert the thread, so we shouldn't process posts
+                return None
+        
+        # Find all posts on the page by their id pattern (more reliable than class)
+        posts = soup.find_all('div', id=re.compile(r'post_\d+'))
+        logger.debug("Found %s posts on page %s", len(posts), page_num)
+        
+        for post in posts:
+            post_id, post_date, post_text, username, replies_to = self.parse_post(post, thread_id)
+            if post_id and username:
+                # Parse user info (posts, threads, joined date)
+                user_info = self.parse_user_info(post)
+                username_found, num_posts, num_threads, joined_date = user_info
+                # Ensure username matches
+                if username_found and username_found != username:
+                    # Use the one from parse_user_info
+                    username = username_found
+                user_rows.append((username, num_posts, num_threads, joined_date))
+                post_rows.append((post_id, post_date, post_text, username, thread_id, replies_to))
+            else:
+                # Debug: print why post wasn't parsed
+                logger.warning("Failed to parse post from element %s", post.get('id'))
+        
+        return thread_row, user_rows, post_rows
+    
+    def parse_print_posts(self, thread_id, print_soups):
+        """Parse the posts of a thread's print view in thread order, or None if one can't be parsed"""
+        parsed = []
+        for soup in print_soups:
+            for post in soup.select(config.PRINT_POST_SELECTOR):
+                post_id, post_date, post_text, username, replies_to = self.parse_post(post, thread_id)
+                if not (post_id and username):
+                    return None
+                parsed.append((post_id, post_date, post_text, username, replies_to))
+        return parsed
+    
+    def parse_media(self, soup):
+        """Return (post_id, url, kind) of the attachments and inline images of the posts on a page
+        
+        Attachments are the attachment.php links anywhere in a post, images the <img> tags in
+        its body other than smilies. Each URL is listed once per post.
+        """
+        media_rows = []
+        for post in soup.find_all('div', id=re.compile(r'post_\d+')):
+            post_id = int(re.search(r'(\d+)', post['id']).group(1))
+            urls = {}
+            for a_tag in post.find_all('a', href=True):
+                url = media_url(a_tag['href'])
+                if url and media_kind(url) == 'attachment':
+                    urls.setdefault(url, 'attachment')
+            post_body = post.find('div', class_='post_body')
+            if post_body:
+                for img in post_body.find_all('img', src=True):
+                    url = media_url(img['src'])
+                    if url and not is_thumbnail(url) and 'smilie' not in (img.get('class') or []):
+                        urls.setdefault(url, media_kind(url))
+            media_rows.extend((post_id, url, kind) for url, kind in urls.items())
+        return media_rows
+    
+    def is_forbidden(self, soup):
+        """Check if a thread page is the forum's "no permission" page instead of a thread"""
+        if self.count_posts(soup):
+            return False
+        return config.NO_PERMISSION_TEXT in soup.get_text().lower()
+    
+    def is_not_found(self, soup):
+        """Check if a thread page is the forum's "not found" error page"""
+        # Check if thread exists by looking for error messages or empty content
+        # This is forum-specific
+        error_msg = soup.find('div', class_='error')
+        return bool(error_msg and 'not found' in error_msg.get_text().lower())
@@ -0,0 +1,78 @@
+import json
+import os
+from archive import PageArchive
+from benchmark import CORPUS_DIR, load_corpus
+from page_parser import make_parser
+
+
+def parse_page(parser, thread_id, page_num, kind, content):
+    """Run everything the scraper extracts from a page through one engine"""
+    document = parser.parse_document(content)
+    if kind == 'print':
+        return parser.parse_print_posts(thread_id, [document]), parser.parse_media(document)
+    return (parser.is_not_found(document),
+            parser.is_forbidden(document),
+            parser.extract_number_of_pages(document, thread_id),
+            parser.count_posts(document),
+            parser.parse_thread_page(thread_id, page_num, document),
+            parser.parse_media(document))
+
+
+def render(result):
+    """Serialize a parse result as the text of a golden file"""
+    return json.dumps(result, default=str, ensure_ascii=False, indent=1) + '\n'
+
+
+def expected_path(name, corpus_dir=CORPUS_DIR):
+    """Return the path of the golden file holding the expected parse result of a corpus page"""
+    return os.path.join(corpus_dir, os.path.splitext(name)[0] + '.expected.json')
+
+
+def write_corpus_expected(engine='bs4', corpus_dir=CORPUS_DIR):
+    """Regenerate the golden files of the benchmark corpus from the output of engine"""
+    parser = make_parser(engine)
+    for name, thread_id, page_num, content in load_corpus(corpus_dir):
+        with open(expected_path(name, corpus_dir), 'w', encoding='utf-8') as f:
+            f.write(render(parse_page(parser, thread_id, page_num, 'thread', content)))
+
+
+def first_difference(expected, actual):
+    """Describe where two parse results first differ"""
+    if isinstance(expected, (list, tuple)) and isinstance(actual, (list, tuple)):
+        for index, (a, b) in enumerate(zip(expected, actual)):
+            if a != b:
+                return f"[{index}] " + first_difference(a, b)
+        return f"length {len(expected)} != {len(actual)}"
+    return f"{expected!r} != {actual!r}"
+
+
+def check_parity(archive_path=None, engine='lxml', reference='bs4'):
+    """Check that engine produces exactly the rows of the reference engine for every archived page
+
+    Returns the number of pages that differ.
+    """
+    archive = PageArchive(archive_path)
+    expected_parser = make_parser(reference)
+    actual_parser = make_parser(engine)
+    pages = 0
+    mismatches = 0
+    try:
+        for thread_id, thread_pages in archive.latest_threads():
+            for kind, kind_pages in thread_pages.items():
+                for page_num, digest in kind_pages:
+                    content = archive.load(digest)
+                    expected = parse_page(expected_parser, thread_id, page_num, kind, content)
+                    actual = parse_page(actual_parser, thread_id, page_num, kind, content)
+                    pages += 1
+                    if expected != actual:
+                        mismatches += 1
+                        print(f"Mismatch in thread {thread_id} {kind} page {page_num} ({digest}): "
+                              f"{first_difference(expected, actual)}")
+    finally:
+        archive.close()
+    print(f"Checked {pages} archived pages: {mismatches} differ between {engine} and {reference}")
+    return mismatches
+
+
+if __name__ == '__main__':
+    write_corpus_expected()
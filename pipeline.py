@@ -0,0 +1,203 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import config
+from metrics import metrics
+from page_parser import make_parser
+from profiler import worker_initializer
+
+logger = logging.getLogger(__name__)
+
+_parser = None
+
+
+def parse_page(thread_id, page_num, content, first=False, media=False):
+    """Parse a fetched thread page into plain rows in a parser process
+
+    Returns ((outcome, total_pages, rows, media_rows), metrics). For the first page fetched of
+    a thread, outcome is 'not_found' or 'forbidden' if it is an error page and total_pages is set.
+    rows is the result of parse_thread_page, media_rows that of parse_media if media is set.
+    metrics are the parse timings recorded in this process, for the main process to merge.
+    """
+    global _parser
+    if _parser is None:
+        _parser = make_parser()
+        # Drop what a forked worker inherited from the main process, it is counted there
+        metrics.take()
+    soup = _parser.parse_document(content)
+    if not first:
+        parsed = None, None, _parser.parse_thread_page(thread_id, page_num, soup)
+    elif _parser.is_not_found(soup):
+        parsed = 'not_found', None, None
+    elif _parser.is_forbidden(soup):
+        parsed = 'forbidden', None, None
+    else:
+        total_pages = _parser.extract_number_of_pages(soup, thread_id)
+        parsed = None, total_pages, _parser.parse_thread_page(thread_id, page_num, soup)
+    media_rows = _parser.parse_media(soup) if media and parsed[2] is not None else None
+    return parsed + (media_rows,), metrics.take()
+
+
+class ScrapePipeline:
+    """Scrapes threads in three stages: fetching, parsing and writing
+
+    Pages are fetched by the scraper's async workers, parsed into row tuples by a pool of
+    processes so parsing never blocks the network, and written by a single writer that runs
+    the database calls in a thread, in page order per thread. The bounded page slots and
+    write queue hold back fetching when parsing or writing falls behind.
+    """
+
+    def __init__(self, scraper, parse_workers=None, queue_size=None):
+        self.scraper = scraper
+        self.parse_workers = parse_workers or config.PARSE_WORKERS
+        self.queue_size = queue_size or config.PIPELINE_QUEUE_SIZE
+        self.executor = None
+        self.progress = {}
+        self.page_slots = None
+        self.pages_in_flight = 0
+        self.write_queue = None
+
+    async def take_page_slot(self):
+        """Wait for a page slot, which a page holds from before it is fetched until it is written or dropped"""
+        await self.page_slots.acquire()
+        self.pages_in_flight += 1
+        metrics.set('scraper_queue_depth', self.pages_in_flight, queue='pages')
+
+    def release_page_slot(self):
+        self.pages_in_flight -= 1
+        metrics.set('scraper_queue_depth', self.pages_in_flight, queue='pages')
+        self.page_slots.release()
+
+    async def fetch_and_parse(self, fetcher, thread_id, page_num, first=False):
+        """Fetch a page and parse it in the process pool, returning (status, parse_page's result or None)"""
+        status, content = await self.scraper.fetch_page_response(fetcher, thread_id, page_num)
+        if content is None:
+            return status, None
+        loop = asyncio.get_running_loop()
+        parsed, parse_metrics = await loop.run_in_executor(self.executor, parse_page, thread_id, page_num,
+                                                           content, first, config.MEDIA_DOWNLOAD)
+        metrics.merge(parse_metrics)
+        return status, parsed
+
+    async def fetch_pages(self, fetcher, thread_id, first_page, last_page, fetches):
+        """Start fetching and parsing pages first_page to last_page, putting the tasks on fetches in page order
+
+        Each page takes its slot before it is started, so slots are always taken in page order
+        and the earliest page a thread is waiting for never waits for one itself.
+        """
+        for page_num in range(first_page, last_page + 1):
+            await self.take_page_slot()
+            fetches.put_nowait(asyncio.create_task(self.fetch_and_parse(fetcher, thread_id, page_num)))
+
+    async def scrape_thread(self, fetcher, thread_id):
+        """Fetch and parse the pages of a thread, queueing each page's rows for the writer in page order
+
+        The slot of a page queued for the writer is released once the writer stored it,
+        that of any other page here.
+        """
+        start_page = self.scraper.resume_page(thread_id, self.progress.get(thread_id))
+        resumed = start_page > 1
+        fetches = asyncio.Queue()
+        fetching = fetch = None
+        await self.take_page_slot()
+        holding_slot = True
+        try:
+            status, parsed = await self.fetch_and_parse(fetcher, thread_id, start_page, first=True)
+            if parsed is None:
+                logger.info("Thread %s might not exist or is inaccessible", thread_id)
+                await self.queue_write(('unavailable', thread_id, self.scraper.miss_outcome(status), status, resumed))
+                return
+            outcome, total_pages, rows, _ = parsed
+            if outcome == 'not_found':
+                logger.info("Thread %s not found", thread_id)
+            elif outcome == 'forbidden':
+                logger.info("Thread %s is not accessible with the configured cookies", thread_id)
+            if outcome:
+                await self.queue_write(('unavailable', thread_id, outcome, status, resumed))
+                return
+            total_pages = max(total_pages, start_page)
+            if resumed and rows and self.scraper.past_last_page(thread_id, rows[2]):
+                logger.info("Thread %s was already scraped up to its last page", thread_id)
+                await self.queue_write(('finish', thread_id, True, True))
+                return
+
+            fetching = asyncio.create_task(self.fetch_pages(fetcher, thread_id, start_page + 1, total_pages, fetches))
+            page_results = []
+            for page_num in range(start_page, total_pages + 1):
+                if page_num > start_page:
+                    fetch = await fetches.get()
+                    holding_slot = True
+                    status, parsed = await fetch
+                rows = parsed[2] if parsed is not None else None
+                page_results.append(rows is not None and bool(rows[2]))
+                if not page_results[-1]:
+                    break
+                await self.queue_write(('page', thread_id, page_num, rows, parsed[3]))
+                holding_slot = False
+        finally:
+            if holding_slot:
+                if fetch is not None:
+                    fetch.cancel()
+                self.release_page_slot()
+            if fetching is not None:
+                fetching.cancel()
+                await asyncio.gather(fetching, return_exceptions=True)
+            while not fetches.empty():
+                fetches.get_nowait().cancel()
+                self.release_page_slot()
+        await self.queue_write(('finish', thread_id,
+                                *self.scraper.thread_outcome(thread_id, start_page, total_pages, resumed, page_results)))
+
+    async def queue_write(self, item):
+        """Queue an item for the writer, waiting while the queue is full"""
+        await self.write_queue.put(item)
+        metrics.set('scraper_queue_depth', self.write_queue.qsize(), queue='write')
+
+    def write(self, item):
+        """Store one item from the write queue"""
+        kind, thread_id = item[:2]
+        if kind == 'page':
+            page_num, rows, media_rows = item[2:]
+            self.scraper.store_thread_page(thread_id, page_num, rows)
+            self.scraper.store_media(media_rows)
+        elif kind == 'finish':
+            self.scraper.finish_thread(thread_id, *item[2:])
+        else:
+            self.scraper.thread_unavailable(thread_id, *item[2:])
+
+    async def writer(self):
+        """Write queued items until the None sentinel, keeping the database off the event loop"""
+        while True:
+            item = await self.write_queue.get()
+            metrics.set('scraper_queue_depth', self.write_queue.qsize(), queue='write')
+            if item is None:
+                return
+            try:
+                await asyncio.to_thread(self.write, item)
+            except Exception as e:
+                logger.error("Error writing thread %s: %s", item[1], e)
+                self.scraper.thread_failed(item[1])
+            finally:
+                if item[0] == 'page':
+                    self.release_page_slot()
+
+    async def run(self, thread_ids):
+        """Scrape the given thread IDs through the pipeline"""
+        thread_ids = list(thread_ids)
+        self.progress = self.scraper.db.get_thread_progress(thread_ids)
+        complete = {thread_id for thread_id, progress in self.progress.items() if progress[3]}
+        for thread_id in sorted(complete):
+            logger.info("Thread %s already exists in database, skipping", thread_id)
+        thread_ids = [thread_id for thread_id in thread_ids if thread_id not in complete]
+
+        self.page_slots = asyncio.Semaphore(self.queue_size)
+        self.write_queue = asyncio.Queue(maxsize=self.queue_size)
+        initializer, initargs = worker_initializer()
+        with ProcessPoolExecutor(max_workers=self.parse_workers, initializer=initializer,
+                                 initargs=initargs) as self.executor:
+            writer = asyncio.create_task(self.writer())
+            try:
+                await self.scraper.run_thread_workers(thread_ids, self.scrape_thread)
+            finally:
+                await self.queue_write(None)
+                await writer
@@ -0,0 +1,207 @@
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from multiprocessing import util
+import config
+
+logger = logging.getLogger(__name__)
+
+# A sample belongs to the stage of the innermost frame from one of these files
+STAGE_FILES = (
+    ('parse', ('page_parser.py', 'lxml_parser.py', os.sep + 'bs4' + os.sep, os.sep + 'lxml' + os.sep)),
+    ('write', ('database.py', os.sep + 'psycopg2' + os.sep)),
+    ('fetch', ('fetcher.py', os.sep + 'aiohttp' + os.sep, os.sep + 'requests' + os.sep,
+               os.sep + 'urllib3' + os.sep)),
+    ('wait', ('selectors.py', 'threading.py', 'queues.py', 'connection.py',
+              os.sep + 'futures' + os.sep + 'thread.py')),
+)
+# Files of the parse path, for attributing allocations made inside bs4 or lxml to our code
+PARSE_PATH_FILES = ('page_parser.py', 'lxml_parser.py')
+
+_profile = None
+
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def stage_of(filenames):
+    """Return the stage of a stack from its filenames, innermost first"""
+    for filename in filenames:
+        for stage, patterns in STAGE_FILES:
+            if any(pattern in filename for pattern in patterns):
+                return stage
+    return 'other'
+
+
+class Profile:
+    """A bounded profiling window: a sampling profiler plus periodic tracemalloc snapshots
+
+    A background thread records the stack of every other thread each `interval` seconds
+    and a tracemalloc snapshot each `snapshot_interval` seconds, until `seconds` have passed
+    or stop() is called. Then it writes, to output_dir:
+
+    - profile-<name>.collapsed: one line per distinct stack with its sample count, rooted at
+      the stage (parse, write, fetch, wait, other), for flamegraph.pl or speedscope
+    - profile-<name>.txt: samples per stage and the functions most samples were spent in
+    - allocations-<name>.txt: the lines holding the most memory on average over the
+      snapshots, overall and attributed to the parse path
+    """
+
+    def __init__(self, output_dir=None, seconds=None, interval=None, snapshot_interval=None, name=None):
+        self.output_dir = output_dir or config.PROFILE_DIR
+        self.seconds = seconds or config.PROFILE_SECONDS
+        self.interval = interval or config.PROFILE_INTERVAL
+        self.snapshot_interval = snapshot_interval or config.PROFILE_SNAPSHOT_INTERVAL
+        self.name = name or f"main-{os.getpid()}"
+        self.stacks = Counter()
+        self.samples = 0
+        self.snapshots = 0
+        self.allocations = {}
+        self.parse_allocations = {}
+        self.stopped = threading.Event()
+        self.finished = threading.Lock()
+        self.done = False
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        global _profile
+        _profile = self
+        tracemalloc.start(config.PROFILE_TRACEMALLOC_FRAMES)
+        self.thread.start()
+        logger.info("Profiling for %ss, writing results to %s", self.seconds, self.output_dir)
+        return self
+
+    def run(self):
+        ends = time.monotonic() + self.seconds
+        next_snapshot = time.monotonic() + self.snapshot_interval
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            if now >= ends:
+                break
+            self.sample(own_id)
+            if now >= next_snapshot:
+                self.snapshot()
+                next_snapshot = time.monotonic() + self.snapshot_interval
+        self.finish()
+
+    def sample(self, own_id):
+        """Record the current stack of every thread but the profiler's"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            labels = []
+            filenames = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                filenames.append(frame.f_code.co_filename)
+                frame = frame.f_back
+            labels.append(names.get(thread_id, 'thread'))
+            labels.append(stage_of(filenames))
+            self.stacks[';'.join(reversed(labels))] += 1
+        self.samples += 1
+
+    def snapshot(self):
+        """Add the memory held per line, overall and on the parse path, to the running totals"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        self.snapshots += 1
+        for trace in snapshot.traces:
+            frames = trace.traceback
+            innermost = frames[-1]
+            self.add_allocation(self.allocations, (innermost.filename, innermost.lineno), trace.size)
+            # Frames go from the oldest to the most recent
+            for frame in reversed(frames):
+                if frame.filename.endswith(PARSE_PATH_FILES):
+                    self.add_allocation(self.parse_allocations, (frame.filename, frame.lineno), trace.size)
+                    break
+
+    def add_allocation(self, totals, key, size):
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [size, 1]
+        else:
+            total[0] += size
+            total[1] += 1
+
+    def finish(self):
+        """Stop tracing and write the results, once"""
+        with self.finished:
+            if self.done:
+                return
+            self.done = True
+            if tracemalloc.is_tracing():
+                if not self.snapshots:
+                    self.snapshot()
+                tracemalloc.stop()
+            try:
+                self.write()
+            except OSError as e:
+                logger.error("Error writing profile to %s: %s", self.output_dir, e)
+
+    def stop(self):
+        """End the window early and wait for the results to be written"""
+        self.stopped.set()
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join()
+        self.finish()
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        collapsed_path = os.path.join(self.output_dir, f"profile-{self.name}.collapsed")
+        with open(collapsed_path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        stages = Counter()
+        own = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            stages[frames[0]] += count
+            own[frames[-1]] += count
+        total = sum(stages.values()) or 1
+        with open(os.path.join(self.output_dir, f"profile-{self.name}.txt"), 'w') as f:
+            f.write(f"{self.samples} samples every {self.interval * 1000:g} ms\n\nStage\n")
+            for stage, count in stages.most_common():
+                f.write(f"{count / total:7.1%}  {stage}\n")
+            f.write("\nFunctions most samples were spent in\n")
+            for label, count in own.most_common(30):
+                f.write(f"{count / total:7.1%}  {label}\n")
+
+        with open(os.path.join(self.output_dir, f"allocations-{self.name}.txt"), 'w') as f:
+            f.write(f"Average memory held over {self.snapshots} snapshots\n")
+            for title, totals in (("\nParse path (allocations made in or under these lines)", self.parse_allocations),
+                                  ("\nAll lines", self.allocations)):
+                f.write(title + "\n")
+                top = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:30]
+                for (filename, lineno), (size, count) in top:
+                    f.write(f"{size / max(self.snapshots, 1) / 1024:10.1f} KiB  {count / max(self.snapshots, 1):10.0f} blocks  "
+                            f"{filename}:{lineno}\n")
+        logger.info("Profile written to %s (%s samples, %s allocation snapshots)",
+                    collapsed_path, self.samples, self.snapshots)
+
+
+def start_worker_profile(output_dir, seconds, interval, snapshot_interval):
+    """ProcessPoolExecutor initializer profiling a worker process like the main one"""
+    # A forked worker inherits the main process's traces; only its own allocations count
+    tracemalloc.stop()
+    profile = Profile(output_dir, seconds, interval, snapshot_interval, name=f"worker-{os.getpid()}")
+    profile.start()
+    # Workers exit without running atexit handlers, but do run multiprocessing finalizers
+    util.Finalize(profile, profile.stop, exitpriority=10)
+
+
+def worker_initializer():
+    """Return (initializer, initargs) making process pool workers profile themselves, if profiling"""
+    if _profile is None or _profile.done:
+        return None, ()
+    return start_worker_profile, (_profile.output_dir, _profile.seconds, _profile.interval,
+                                  _profile.snapshot_interval)
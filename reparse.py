@@ -0,0 +1,114 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import config
+from archive import PageArchive, load_object
+from database import Database
+from page_parser import make_parser
+from profiler import worker_initializer
+
+logger = logging.getLogger(__name__)
+
+
+def parse_archived_thread(archive_path, thread_id, pages, media=False):
+    """Parse the archived pages of one thread into (page_rows, media_rows)
+
+    page_rows is a list of (thread_row, user_rows, post_rows), media_rows the attachments
+    and images of the thread's posts if media is set. Runs in a worker process, so it only
+    reads object files and never touches the network or the database. Pages are handled
+    like scrape_thread does: parsing stops at the first page without valid posts.
+    """
+    parser = make_parser()
+    thread_pages = dict(pages.get('thread', []))
+    page_rows = []
+    media_rows = []
+    if 1 not in thread_pages:
+        return page_rows, media_rows
+    
+    for page_num in sorted(thread_pages):
+        soup = parser.parse_document(load_object(archive_path, thread_pages[page_num]))
+        if page_num == 1 and parser.is_not_found(soup):
+            break
+        rows = parser.parse_thread_page(thread_id, page_num, soup)
+        if rows is None or not rows[2]:
+            break
+        page_rows.append(rows)
+        if media:
+            media_rows.extend(parser.parse_media(soup))
+    
+    # Threads scraped in print view mode only have some paginated pages archived,
+    # the remaining posts come from the print view
+    if page_rows and 'print' in pages:
+        print_soups = [parser.parse_document(load_object(archive_path, digest))
+                       for _, digest in sorted(pages['print'])]
+        parsed = parser.parse_print_posts(thread_id, print_soups)
+        if parsed and media:
+            for print_soup in print_soups:
+                media_rows.extend(parser.parse_media(print_soup))
+        if parsed:
+            stored = {post_row[0] for _, _, post_rows in page_rows for post_row in post_rows}
+            page_rows.append((None, [], [(post_id, post_date, post_text, username, thread_id, replies_to)
+                                         for post_id, post_date, post_text, username, replies_to in parsed
+                                         if post_id not in stored]))
+    return page_rows, media_rows
+
+
+def write_thread_rows(db, page_rows):
+    """Write the rows of one reparsed thread in page order
+
+    Authors of print view posts whose paginated page wasn't archived have no user row
+    here; they are stored without statistics unless they are already in the database.
+    """
+    known = {user_row[0] for _, user_rows, _ in page_rows for user_row in user_rows}
+    db.insert_missing_users(sorted({post_row[3] for _, _, post_rows in page_rows for post_row in post_rows
+                                    if post_row[3] is not None and post_row[3] not in known}))
+    for thread_row, user_rows, post_rows in page_rows:
+        if thread_row:
+            db.insert_thread(*thread_row)
+        for user_row in user_rows:
+            db.insert_user(*user_row)
+        for post_row in post_rows:
+            db.insert_post(*post_row)
+
+
+def reparse_archive(archive_path=None, workers=None):
+    """Rebuild the database from the page archive using a pool of parser processes"""
+    archive = PageArchive(archive_path)
+    db = Database()
+    workers = workers or config.REPARSE_WORKERS
+    start = time.monotonic()
+    threads = 0
+    pages = 0
+    
+    def write(thread_id, future):
+        nonlocal threads, pages
+        try:
+            page_rows, media_rows = future.result()
+        except Exception as e:
+            logger.error("Error reparsing thread %s, skipping it: %s", thread_id, e)
+            return
+        write_thread_rows(db, page_rows)
+        if media_rows:
+            db.insert_post_media(media_rows)
+        threads += 1
+        pages += len(page_rows)
+    
+    initializer, initargs = worker_initializer()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            # Keep a bounded window of threads in flight so memory stays flat on big archives
+            pending = deque()
+            for thread_id, thread_pages in archive.latest_threads():
+                pending.append((thread_id, executor.submit(parse_archived_thread, archive.path, thread_id,
+                                                           thread_pages, config.MEDIA_DOWNLOAD)))
+                if len(pending) >= workers * 4:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+    finally:
+        db.close()
+        archive.close()
+    
+    elapsed = max(time.monotonic() - start, 1e-9)
+    logger.info("Reparsed %s threads (%s pages) in %.1fs (%.0f pages/sec)", threads, pages, elapsed, pages / elapsed)
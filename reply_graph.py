@@ -0,0 +1,279 @@
+# Tables derived from the posts and kept up to date as posts are written
+#
+# - post_replies: one row per post that quotes another, with its depth in the conversation
+#   (1 for a reply to a post that quotes nothing) and the root post of that conversation
+# - thread_stats: posts, replies, participants and first/last post date of each thread
+# - thread_participants: posts per thread and author, from which participants are counted
+# - user_reply_stats: replies each user wrote (out-degree) and received (in-degree)
+#
+# post_replies.replied_username is the author of the quoted post, NULL while it isn't stored.
+#
+# Statement-level triggers on posts apply the rows each upsert inserted or changed as deltas,
+# inside the transaction of the write, so concurrent workers never count a post twice or miss
+# one. Edits that leave the thread, author, quoted post and date alone cost nothing. The
+# scraper never deletes posts; deleting any means building the tables again (drop the
+# triggers and Database.create_reply_graph() rebuilds them).
+
+# Longest chain of quotes followed to find a post's depth and root (quotes can form cycles)
+MAX_REPLY_DEPTH = 100
+
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS post_replies (
+        post_id INTEGER PRIMARY KEY,
+        replies_to INTEGER NOT NULL,
+        thread_id INTEGER,
+        depth INTEGER NOT NULL,
+        root_post_id INTEGER NOT NULL,
+        replied_username VARCHAR(255)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS post_replies_replies_to_idx ON post_replies (replies_to)",
+    "CREATE INDEX IF NOT EXISTS post_replies_root_idx ON post_replies (root_post_id)",
+    "CREATE INDEX IF NOT EXISTS post_replies_thread_idx ON post_replies (thread_id, replies_to)",
+    """
+    CREATE TABLE IF NOT EXISTS thread_participants (
+        thread_id INTEGER NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        post_count INTEGER NOT NULL,
+        PRIMARY KEY (thread_id, username)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS thread_stats (
+        thread_id INTEGER PRIMARY KEY,
+        post_count INTEGER NOT NULL DEFAULT 0,
+        reply_count INTEGER NOT NULL DEFAULT 0,
+        participant_count INTEGER NOT NULL DEFAULT 0,
+        first_post_date TIMESTAMP,
+        last_post_date TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_reply_stats (
+        username VARCHAR(255) PRIMARY KEY,
+        replies_sent INTEGER NOT NULL DEFAULT 0,
+        replies_received INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """,
+]
+
+# The rows a statement changed, as -1 for the old version and +1 for the new one
+INSERTED_CHANGES = """changes AS (
+        SELECT 1 AS sign, post_id, thread_id, username, replies_to, post_date FROM new_posts
+    )"""
+UPDATED_CHANGES = """changes AS (
+        SELECT -1 AS sign, o.post_id, o.thread_id, o.username, o.replies_to, o.post_date
+        FROM old_posts AS o JOIN new_posts AS n USING (post_id)
+        WHERE (o.thread_id, o.username, o.replies_to, o.post_date)
+            IS DISTINCT FROM (n.thread_id, n.username, n.replies_to, n.post_date)
+        UNION ALL
+        SELECT 1, n.post_id, n.thread_id, n.username, n.replies_to, n.post_date
+        FROM old_posts AS o JOIN new_posts AS n USING (post_id)
+        WHERE (o.thread_id, o.username, o.replies_to, o.post_date)
+            IS DISTINCT FROM (n.thread_id, n.username, n.replies_to, n.post_date)
+    )"""
+
+TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $function$
+BEGIN
+    IF NOT EXISTS (WITH {changes} SELECT 1 FROM changes) THEN
+        RETURN NULL;
+    END IF;
+
+    -- Posts per thread and author
+    WITH {changes}
+    INSERT INTO thread_participants AS tp (thread_id, username, post_count)
+    SELECT thread_id, username, sum(sign) FROM changes
+    WHERE thread_id IS NOT NULL AND username IS NOT NULL
+    GROUP BY thread_id, username HAVING sum(sign) <> 0
+    ORDER BY thread_id, username
+    ON CONFLICT (thread_id, username) DO UPDATE SET post_count = tp.post_count + EXCLUDED.post_count;
+
+    WITH {changes}
+    DELETE FROM thread_participants AS tp USING changes AS c
+    WHERE tp.thread_id = c.thread_id AND tp.username = c.username AND tp.post_count <= 0;
+
+    -- Thread counts; a new date can only widen the date range
+    WITH {changes}
+    INSERT INTO thread_stats AS ts (thread_id, post_count, reply_count, first_post_date, last_post_date)
+    SELECT thread_id, sum(sign), coalesce(sum(sign) FILTER (WHERE replies_to IS NOT NULL), 0),
+           min(post_date) FILTER (WHERE sign > 0), max(post_date) FILTER (WHERE sign > 0)
+    FROM changes WHERE thread_id IS NOT NULL
+    GROUP BY thread_id
+    ORDER BY thread_id
+    ON CONFLICT (thread_id) DO UPDATE SET
+        post_count = ts.post_count + EXCLUDED.post_count,
+        reply_count = ts.reply_count + EXCLUDED.reply_count,
+        first_post_date = least(ts.first_post_date, EXCLUDED.first_post_date),
+        last_post_date = greatest(ts.last_post_date, EXCLUDED.last_post_date),
+        updated_at = now();
+
+    -- Participants, and the date range where a post left it
+    WITH {changes}
+    UPDATE thread_stats AS ts SET
+        participant_count = (SELECT count(*) FROM thread_participants AS tp WHERE tp.thread_id = ts.thread_id),
+        first_post_date = CASE WHEN d.stale THEN (SELECT min(post_date) FROM posts WHERE thread_id = ts.thread_id)
+                               ELSE ts.first_post_date END,
+        last_post_date = CASE WHEN d.stale THEN (SELECT max(post_date) FROM posts WHERE thread_id = ts.thread_id)
+                              ELSE ts.last_post_date END
+    FROM (
+        SELECT c.thread_id, bool_or(c.sign < 0 AND c.post_date IN (s.first_post_date, s.last_post_date)) AS stale
+        FROM changes AS c JOIN thread_stats AS s ON s.thread_id = c.thread_id
+        GROUP BY c.thread_id
+    ) AS d
+    WHERE ts.thread_id = d.thread_id;
+
+    -- Replies sent: the changed posts that quote another
+    WITH {changes}
+    INSERT INTO user_reply_stats AS us (username, replies_sent)
+    SELECT username, sum(sign) FROM changes
+    WHERE username IS NOT NULL AND replies_to IS NOT NULL
+    GROUP BY username HAVING sum(sign) <> 0
+    ORDER BY username
+    ON CONFLICT (username) DO UPDATE SET
+        replies_sent = us.replies_sent + EXCLUDED.replies_sent,
+        updated_at = now();
+
+    -- Reply edges are replaced by those of the new versions of the posts, as direct replies
+    -- at first. Each edge remembers the author it was counted as a reply received by, so
+    -- replies received are kept exact however the insert and update triggers interleave.
+    WITH {changes}, removed AS (
+        DELETE FROM post_replies AS e USING changes AS c
+        WHERE c.sign < 0 AND e.post_id = c.post_id
+        RETURNING e.replied_username
+    )
+    INSERT INTO user_reply_stats AS us (username, replies_received)
+    SELECT replied_username, -count(*) FROM removed
+    WHERE replied_username IS NOT NULL
+    GROUP BY replied_username
+    ORDER BY replied_username
+    ON CONFLICT (username) DO UPDATE SET
+        replies_received = us.replies_received + EXCLUDED.replies_received,
+        updated_at = now();
+
+    WITH {changes}, added AS (
+        INSERT INTO post_replies (post_id, replies_to, thread_id, depth, root_post_id, replied_username)
+        SELECT c.post_id, c.replies_to, c.thread_id, 1, c.replies_to, p.username
+        FROM changes AS c LEFT JOIN posts AS p ON p.post_id = c.replies_to
+        WHERE c.sign > 0 AND c.replies_to IS NOT NULL
+        ORDER BY c.post_id
+        ON CONFLICT (post_id) DO NOTHING
+        RETURNING replied_username
+    )
+    INSERT INTO user_reply_stats AS us (username, replies_received)
+    SELECT replied_username, count(*) FROM added
+    WHERE replied_username IS NOT NULL
+    GROUP BY replied_username
+    ORDER BY replied_username
+    ON CONFLICT (username) DO UPDATE SET
+        replies_received = us.replies_received + EXCLUDED.replies_received,
+        updated_at = now();
+
+    -- Replies to posts that are new or changed author are received by their new author
+    WITH {changes}, moved AS (
+        UPDATE post_replies AS e SET replied_username = m.new_username
+        FROM (
+            SELECT r.post_id, r.replied_username AS old_username, c.username AS new_username
+            FROM changes AS c JOIN post_replies AS r ON r.replies_to = c.post_id
+            WHERE c.sign > 0 AND r.replied_username IS DISTINCT FROM c.username
+            FOR UPDATE OF r
+        ) AS m
+        WHERE e.post_id = m.post_id
+        RETURNING m.old_username, m.new_username
+    )
+    INSERT INTO user_reply_stats AS us (username, replies_received)
+    SELECT username, sum(received) FROM (
+        SELECT new_username AS username, 1 AS received FROM moved
+        UNION ALL
+        SELECT old_username, -1 FROM moved
+    ) AS d
+    WHERE username IS NOT NULL
+    GROUP BY username HAVING sum(received) <> 0
+    ORDER BY username
+    ON CONFLICT (username) DO UPDATE SET
+        replies_received = us.replies_received + EXCLUDED.replies_received,
+        updated_at = now();
+
+    -- A changed post moves the conversations below it too
+    WITH RECURSIVE {changes}, affected (post_id) AS (
+        SELECT post_id FROM changes
+        UNION
+        SELECT e.post_id FROM affected AS a JOIN post_replies AS e ON e.replies_to = a.post_id
+    ), chain (post_id, ancestor, depth) AS (
+        SELECT e.post_id, e.replies_to, 1 FROM post_replies AS e JOIN affected AS a ON a.post_id = e.post_id
+        UNION ALL
+        SELECT c.post_id, e.replies_to, c.depth + 1
+        FROM chain AS c JOIN post_replies AS e ON e.post_id = c.ancestor
+        WHERE c.depth < {max_depth}
+    )
+    UPDATE post_replies AS e SET depth = t.depth, root_post_id = t.ancestor
+    FROM (SELECT DISTINCT ON (post_id) post_id, ancestor, depth FROM chain ORDER BY post_id, depth DESC) AS t
+    WHERE e.post_id = t.post_id AND (e.depth, e.root_post_id) IS DISTINCT FROM (t.depth, t.ancestor);
+
+    RETURN NULL;
+END
+$function$
+"""
+
+FUNCTIONS = [
+    TRIGGER_FUNCTION.format(name='posts_reply_graph_insert', changes=INSERTED_CHANGES, max_depth=MAX_REPLY_DEPTH),
+    TRIGGER_FUNCTION.format(name='posts_reply_graph_update', changes=UPDATED_CHANGES, max_depth=MAX_REPLY_DEPTH),
+]
+
+TRIGGER_NAMES = ('posts_reply_graph_insert', 'posts_reply_graph_update')
+TRIGGERS = [
+    """
+    CREATE TRIGGER posts_reply_graph_insert AFTER INSERT ON posts
+    REFERENCING NEW TABLE AS new_posts
+    FOR EACH STATEMENT EXECUTE FUNCTION posts_reply_graph_insert()
+    """,
+    """
+    CREATE TRIGGER posts_reply_graph_update AFTER UPDATE ON posts
+    REFERENCING OLD TABLE AS old_posts NEW TABLE AS new_posts
+    FOR EACH STATEMENT EXECUTE FUNCTION posts_reply_graph_update()
+    """,
+]
+
+# Build the tables from the stored posts, with the same definitions the triggers maintain
+REBUILD = [
+    "TRUNCATE post_replies, thread_participants, thread_stats, user_reply_stats",
+    f"""
+    INSERT INTO post_replies (post_id, replies_to, thread_id, depth, root_post_id, replied_username)
+    WITH RECURSIVE chain (post_id, replies_to, thread_id, ancestor, depth) AS (
+        SELECT post_id, replies_to, thread_id, replies_to, 1 FROM posts WHERE replies_to IS NOT NULL
+        UNION ALL
+        SELECT c.post_id, c.replies_to, c.thread_id, p.replies_to, c.depth + 1
+        FROM chain AS c JOIN posts AS p ON p.post_id = c.ancestor
+        WHERE p.replies_to IS NOT NULL AND c.depth < {MAX_REPLY_DEPTH}
+    )
+    SELECT DISTINCT ON (c.post_id) c.post_id, c.replies_to, c.thread_id, c.depth, c.ancestor, p.username
+    FROM chain AS c LEFT JOIN posts AS p ON p.post_id = c.replies_to
+    ORDER BY c.post_id, c.depth DESC
+    """,
+    """
+    INSERT INTO thread_participants (thread_id, username, post_count)
+    SELECT thread_id, username, count(*) FROM posts
+    WHERE thread_id IS NOT NULL AND username IS NOT NULL
+    GROUP BY thread_id, username
+    """,
+    """
+    INSERT INTO thread_stats (thread_id, post_count, reply_count, participant_count, first_post_date, last_post_date)
+    SELECT thread_id, count(*), count(replies_to), count(DISTINCT username), min(post_date), max(post_date)
+    FROM posts WHERE thread_id IS NOT NULL
+    GROUP BY thread_id
+    """,
+    """
+    INSERT INTO user_reply_stats (username, replies_sent, replies_received)
+    SELECT username, coalesce(sum(sent), 0), coalesce(sum(received), 0) FROM (
+        SELECT username, count(*) AS sent, 0 AS received FROM posts
+        WHERE replies_to IS NOT NULL GROUP BY username
+        UNION ALL
+        SELECT replied_username, 0, count(*) FROM post_replies GROUP BY replied_username
+    ) AS d
+    WHERE username IS NOT NULL
+    GROUP BY username
+    """,
+]
@@ -1,28 +1,180 @@
+import argparse
+import logging
 import sys
 import config
 from database import Database
+from discovery import discover_threads
+from export import EXPORT_TABLES, Exporter
+from jobs import CrawlWorker, print_job_counts
+from logs import configure_logging
+from media import MediaDownloader
+from metrics import MetricsExporter
+from parity import check_parity
+from profiler import Profile
+from reparse import reparse_archive
+from scheduler import CrawlScheduler, print_schedule
 from scraper import ForumScraper
+from search import SearchIndexer, print_search_results
+
+logger = logging.getLogger(__name__)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrape a myBB forum into postgres")
+    parser.add_argument('command', nargs='?', default='scrape', choices=['scrape', 'refresh', 'schedule', 'enqueue', 'worker', 'jobs',
+                                 'reparse', 'parity', 'export', 'search', 'search-index',
+                                 'partition-posts', 'media'],
+                        help="scrape the forum (default), fetch only new replies to threads already stored, "
+                             "show the recrawl queue, add threads to the shared crawl_jobs queue, "
+                             "scrape threads claimed from that queue, show the queue's progress, "
+                             "rebuild the database from the page archive, "
+                             "check that the parser engines agree on the archived pages, "
+                             "export the users, threads and posts tables to files, "
+                             "search the posts, build the search index, "
+                             "move the posts into a table partitioned by thread ID, "
+                             "or download the attachments and images recorded for posts")
+    parser.add_argument('query', nargs='*', help="with search, the words to search for "
+                                                 "(\"quoted phrases\", OR and -word are understood)")
+    parser.add_argument('--discover', action='store_true',
+                        help="find threads from the board listings instead of trying every thread ID "
+                             "from START_TID to END_TID; with refresh, only refresh threads whose "
+                             "reply count grew and scrape new ones")
+    parser.add_argument('--scheduled', action='store_true',
+                        help="with refresh, only refresh the threads the activity-weighted schedule says are due, "
+                             "hottest first")
+    parser.add_argument('--max-requests', type=int,
+                        help="request budget of a scheduled refresh (default SCHEDULE_MAX_REQUESTS)")
+    parser.add_argument('--max-minutes', type=float,
+                        help="time budget of a scheduled refresh (default SCHEDULE_MAX_MINUTES)")
+    parser.add_argument('--format', choices=['parquet', 'jsonl'],
+                        help="with export, write Parquet or gzip-compressed JSON lines (default EXPORT_FORMAT)")
+    parser.add_argument('--partition', choices=['board', 'month', 'none'],
+                        help="with export, split threads and posts by board or by month of their date "
+                             "(default EXPORT_PARTITION)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="with export, only export rows written since the last export to the same directory")
+    parser.add_argument('--output', help="with export, the directory to write to (default EXPORT_DIR)")
+    parser.add_argument('--tables', nargs='+', choices=EXPORT_TABLES, default=EXPORT_TABLES,
+                        help="with export, the tables to export (default all)")
+    parser.add_argument('--limit', type=int, help="with search, the number of posts to show (default SEARCH_LIMIT)")
+    parser.add_argument('--board', help="with search, only search the posts of this board")
+    parser.add_argument('--substring', action='store_true',
+                        help="with search, find posts containing the text as typed instead of ranking word matches")
+    parser.add_argument('--profile', type=float, nargs='?', const=config.PROFILE_SECONDS, metavar='SECONDS',
+                        help="sample stacks and trace allocations for the first SECONDS of the run "
+                             "(default PROFILE_SECONDS), writing the results to PROFILE_DIR")
+    return parser.parse_args()
 
 def main():
-    # First, ensure database tables exist
-    print("Setting up database...")
+    args = parse_args()
+    configure_logging()
+    profile = Profile(seconds=args.profile).start() if args.profile else None
+    try:
+        run(args)
+    finally:
+        if profile is not None:
+            profile.stop()
+
+def run(args):
+    """Run the command given on the command line"""
+    if args.command == 'parity':
+        sys.exit(1 if check_parity() else 0)
+    
+    # First, ensure database tables exist; a reparse into a new database builds the indexes after loading
+    logger.info("Setting up database...")
     db = Database()
-    db.create_tables()
+    db.create_tables(defer_indexes=args.command == 'reparse')
     db.close()
     
+    if args.command == 'schedule':
+        db = Database()
+        CrawlScheduler(db).update()
+        print_schedule(db)
+        db.close()
+        return
+    
+    if args.command in ('enqueue', 'jobs'):
+        db = Database()
+        if args.command == 'enqueue':
+            if args.discover:
+                threads = discover_threads()
+                db.insert_thread_listings([listing.row() for listing in threads.values()])
+                thread_ids = sorted(threads)
+            else:
+                thread_ids = range(config.START_TID, config.END_TID + 1)
+            logger.info("Added %s crawl jobs", db.enqueue_jobs(thread_ids))
+        print_job_counts(db)
+        db.close()
+        return
+    
+    if args.command == 'export':
+        exporter = Exporter(output_dir=args.output, file_format=args.format, partition=args.partition)
+        if not exporter.export(args.tables, incremental=args.incremental):
+            sys.exit(1)
+        return
+    
+    if args.command == 'search':
+        db = Database()
+        print_search_results(db, ' '.join(args.query), args.limit, args.board, args.substring)
+        db.close()
+        return
+    
+    if args.command == 'search-index':
+        SearchIndexer().run()
+        return
+    
+    if args.command == 'reparse':
+        logger.info("Reparsing page archive...")
+        reparse_archive()
+        db = Database()
+        db.create_tables()
+        db.close()
+        return
+    
+    if args.command == 'media':
+        MediaDownloader().download_all()
+        return
+    
+    if args.command == 'partition-posts':
+        db = Database()
+        partitioned = db.partition_posts(config.POSTS_PARTITION_SIZE)
+        db.close()
+        if not partitioned:
+            sys.exit(1)
+        return
+    
     # Start scraping
-    print("Starting scraper...")
+    logger.info("Starting scraper...")
     scraper = ForumScraper()
+    exporter = MetricsExporter().start()
+    indexer = SearchIndexer().start() if config.SEARCH_BACKGROUND_INDEX else None
+    downloader = MediaDownloader().start() if config.MEDIA_DOWNLOAD else None
+    interrupted = False
     
     try:
-        scraper.scrape_range(config.START_TID, config.END_TID)
+        if args.command == 'refresh' and args.scheduled:
+            scraper.refresh_scheduled(max_requests=args.max_requests, max_minutes=args.max_minutes)
+        elif args.command == 'refresh':
+            scraper.refresh(discover=args.discover)
+        elif args.command == 'worker':
+            CrawlWorker(scraper).run()
+        elif args.discover:
+            scraper.scrape_discovered()
+        else:
+            scraper.scrape_range(config.START_TID, config.END_TID)
     except KeyboardInterrupt:
-        print("\nScraping interrupted by user")
+        logger.info("Scraping interrupted by user")
+        interrupted = True
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
     finally:
+        if indexer is not None:
+            indexer.stop()
         scraper.close()
-        print("Scraping completed")
+        if downloader is not None:
+            # Media of the last pages scraped is downloaded before exiting, unless interrupted
+            downloader.stop(finish=not interrupted)
+        exporter.stop()
+        logger.info("Scraping completed")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+import config
+
+
+class ScheduleEntry:
+    """A thread's place in the recrawl queue"""
+    __slots__ = ('thread_id', 'priority', 'posts_per_day', 'interval_hours', 'hours_until_due')
+
+    def __init__(self, thread_id, priority, posts_per_day, interval_hours, hours_until_due):
+        self.thread_id = thread_id
+        self.priority = priority
+        self.posts_per_day = posts_per_day
+        self.interval_hours = interval_hours
+        self.hours_until_due = hours_until_due
+
+    def row(self):
+        return (self.thread_id, self.priority, self.posts_per_day, self.interval_hours, self.hours_until_due)
+
+    @property
+    def is_due(self):
+        return self.priority >= 1
+
+
+class CrawlScheduler:
+    """Orders stored threads for recrawling by how active they are
+
+    A thread's refresh interval is the time in which SCHEDULE_POSTS_PER_REFRESH new posts
+    are expected, and its priority is the time since it was last crawled divided by that
+    interval, so a thread is due at priority 1 and hot threads come round far more often
+    than cold ones. The queue is saved in the crawl_schedule table after every update.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def expected_posts_per_day(self, recent_posts, days_since_last_post):
+        """Estimate how many posts a day a thread gets from its recent post rate and last post"""
+        rate = recent_posts / config.SCHEDULE_ACTIVITY_WINDOW_DAYS
+        if days_since_last_post is not None:
+            rate += 0.5 ** (max(days_since_last_post, 0) / config.SCHEDULE_RECENCY_HALF_LIFE_DAYS)
+        return rate
+
+    def entry(self, thread_id, recent_posts, days_since_last_post, hours_since_crawl):
+        """Compute the schedule entry of one thread"""
+        posts_per_day = self.expected_posts_per_day(recent_posts, days_since_last_post)
+        if posts_per_day > 0:
+            interval_hours = 24 * config.SCHEDULE_POSTS_PER_REFRESH / posts_per_day
+        else:
+            interval_hours = config.SCHEDULE_MAX_INTERVAL_HOURS
+        interval_hours = min(max(interval_hours, config.SCHEDULE_MIN_INTERVAL_HOURS),
+                             config.SCHEDULE_MAX_INTERVAL_HOURS)
+        if hours_since_crawl is None:
+            # Never crawled with crawl state recorded: due now, hottest first
+            hours_since_crawl = config.SCHEDULE_MAX_INTERVAL_HOURS
+        return ScheduleEntry(thread_id, hours_since_crawl / interval_hours, posts_per_day,
+                             interval_hours, max(interval_hours - hours_since_crawl, 0))
+
+    def update(self):
+        """Recompute and save the schedule, returning its entries highest priority first"""
+        entries = [self.entry(*activity)
+                   for activity in self.db.get_thread_activity(config.SCHEDULE_ACTIVITY_WINDOW_DAYS)]
+        entries.sort(key=lambda entry: (-entry.priority, entry.thread_id))
+        self.db.save_schedule([entry.row() for entry in entries])
+        return entries
+
+    def queue(self, limit=None):
+        """Return the saved schedule, highest priority first"""
+        return self.db.get_schedule(limit)
+
+
+def print_schedule(db, limit=50):
+    """Print the top of the saved crawl schedule"""
+    rows = CrawlScheduler(db).queue(limit)
+    print(f"{'tid':>8}  {'priority':>8}  {'posts/day':>9}  {'interval':>9}  {'next crawl':<19}  title")
+    for thread_id, title, priority, posts_per_day, interval_hours, next_crawl in rows:
+        next_crawl = next_crawl.strftime('%Y-%m-%d %H:%M:%S') if next_crawl else ''
+        print(f"{thread_id:>8}  {priority:>8.2f}  {posts_per_day:>9.2f}  {interval_hours:>8.1f}h  "
+              f"{next_crawl:<19}  {title or ''}")
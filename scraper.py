@@ -1,15 +1,30 @@
+import asyncio
+import logging
+import math
 import requests
-from bs4 import BeautifulSoup
 import time
-import re
-from datetime import datetime
-from urllib.parse import urljoin, parse_qs, urlparse
 import config
+from archive import PageArchive
 from database import Database
+from discovery import discover_threads
+from fetcher import AsyncFetcher, is_permanent_error, parse_retry_after, shared_limiter
+from metrics import metrics
+from page_parser import make_parser
+from pipeline import ScrapePipeline
+from scheduler import CrawlScheduler
+
+logger = logging.getLogger(__name__)
 
 class ForumScraper:
     def __init__(self):
         self.db = Database()
+        self.parser = make_parser()
+        self.known_misses = set()
+        self.crawl_progress = {}
+        # Outcome of each thread scraped by the current scrape_threads call
+        self.thread_outcomes = {}
+        self.archive = PageArchive() if config.ARCHIVE_PAGES else None
+        self.limiter = shared_limiter()
         self.session = requests.Session()
         self.session.headers.update(config.HEADERS)
         
@@ -31,495 +46,672 @@ class ForumScraper:
             for name, value in config.COOKIES.items():
                 self.session.cookies.set(name, value)
         
-    def get_soup(self, url):
-        """Fetch a URL and return BeautifulSoup object"""
+    def get_response(self, url):
+        """Fetch a URL and return (status, body), body is None if the fetch failed"""
+        status = None
         for attempt in range(config.MAX_RETRIES):
+            status = None
+            self.limiter.acquire_sync()
+            started = time.monotonic()
             try:
                 response = self.session.get(url, timeout=config.TIMEOUT)
+                status = response.status_code
+                self.limiter.record_response(status, time.monotonic() - started,
+                                             parse_retry_after(response.headers.get('Retry-After')))
+                metrics.inc('scraper_http_responses_total', status=status)
                 response.raise_for_status()
-                return BeautifulSoup(response.content, 'lxml')
+                metrics.observe('scraper_http_request_seconds', time.monotonic() - started, client='sync')
+                metrics.inc('scraper_downloaded_bytes_total', len(response.content))
+                return status, response.content
             except requests.RequestException as e:
-                print(f"Attempt {attempt + 1} failed for {url}: {e}")
+                logger.warning("Attempt %s failed for %s: %s", attempt + 1, url, e)
+                if status is None:
+                    self.limiter.record_response(None, time.monotonic() - started)
+                    metrics.inc('scraper_http_responses_total', status='error')
+                if is_permanent_error(status):
+                    # Client errors like 404 or 403 won't go away by retrying
+                    metrics.inc('scraper_http_failures_total')
+                    return status, None
                 if attempt < config.MAX_RETRIES - 1:
+                    metrics.inc('scraper_http_retries_total')
                     time.sleep(2 ** attempt)  # Exponential backoff
                 else:
-                    print(f"Max retries exceeded for {url}")
-                    return None
-        return None
-    
-    def extract_number_of_pages(self, soup, thread_id=None):
-        """Extract the total number of pages from the first page of a thread"""
-        # First, try to find pagination specific to this thread
-        # Look for links that point to showthread.php with this thread_id
-        page_numbers = set()
-        
-        # Find all links
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-            # Check if it's a showthread.php link for this thread
-            if 'showthread.php' in href and f'tid={thread_id}' in href:
-                # Extract page number from the href
-                # Look for page= parameter
-                if 'page=' in href:
-                    # Parse the page number
-                    match = re.search(r'page=(\d+)', href)
-                    if match:
-                        try:
-                            page_num = int(match.group(1))
-                            page_numbers.add(page_num)
-                        except ValueError:
-                            pass
-                # Also check if the link text is a number (for numbered pagination)
-                text = link.get_text(strip=True)
-                if text.isdigit():
-                    try:
-                        page_num = int(text)
-                        page_numbers.add(page_num)
-                    except ValueError:
-                        pass
-        
-        # Also look for traditional pagination div as a fallback,
-        # but exclude pagination that is inside navigation breadcrumb (forum pagination)
-        if not page_numbers:
-            pagination_divs = soup.find_all('div', class_='pagination')
-            for pagination in pagination_divs:
-                # Skip if inside navigation breadcrumb
-                if pagination.find_parent('div', class_='navigation'):
-                    continue
-                page_links = pagination.find_all('a')
-                for link in page_links:
-                    text = link.get_text(strip=True)
-                    if text.isdigit():
-                        try:
-                            page_numbers.add(int(text))
-                        except ValueError:
-                            pass
-                # If we found any page numbers from this pagination div, break
-                if page_numbers:
-                    break
-        
-        # Include page 1 always
-        page_numbers.add(1)
-        
-        if page_numbers:
-            return max(page_numbers)
-        else:
-            return 1
+                    metrics.inc('scraper_http_failures_total')
+                    logger.error("Max retries exceeded for %s", url)
+        return status, None
     
-    def parse_user_info(self, post_element):
-        """Extract user information from a post element"""
-        username = None
-        num_posts = None
-        num_threads = None
-        joined_date = None
-        
-        # Find username from largetext
-        username_elem = post_element.find('span', class_='largetext')
-        if username_elem:
-            # First try to find an <a> tag (for registered users)
-            username_link = username_elem.find('a')
-            if username_link:
-                username = username_link.get_text(strip=True)
-            else:
-                # If no <a> tag, get the text directly (for unregistered users)
-                username = username_elem.get_text(strip=True)
-        
-        # Find author_statistics div
-        stats_div = post_element.find('div', class_='author_statistics')
-        if stats_div:
-            stats_text = stats_div.get_text()
-            # Parse Posts: X
-            posts_match = re.search(r'Posts:\s*(\d+)', stats_text)
-            if posts_match:
-                num_posts = int(posts_match.group(1))
-            # Parse Threads: X
-            threads_match = re.search(r'Threads:\s*(\d+)', stats_text)
-            if threads_match:
-                num_threads = int(threads_match.group(1))
-            # Parse Joined: MMM YYYY
-            joined_match = re.search(r'Joined:\s*(\w+\s+\d{4})', stats_text)
-            if joined_match:
-                joined_str = joined_match.group(1)
-                try:
-                    # Convert "Dec 2021" to datetime (day set to 1)
-                    joined_date = datetime.strptime(joined_str, '%b %Y')
-                except Exception as e:
-                    # Try alternative format maybe with extra spaces
-                    joined_str_clean = joined_str.strip()
-                    try:
-                        joined_date = datetime.strptime(joined_str_clean, '%b %Y')
-                    except Exception:
-                        # Debug output
-                        print(f"Debug: Could not parse joined date '{joined_str}' for user {username}")
-                        pass
-        
-        return username, num_posts, num_threads, joined_date
-    
-    def parse_post(self, post_element, thread_id):
-        """Parse individual post from a post element"""
-        # Extract post ID
-        post_id = None
-        post_id_elem = post_element.get('id')
-        if post_id_elem:
-            match = re.search(r'(\d+)', post_id_elem)
-            if match:
-                post_id = int(match.group(1))
-        if not post_id:
-            print(f"Debug: Could not extract post_id from {post_id_elem}")
-        
-        # Extract post date
-        post_date = None
-        date_elem = post_element.find('span', class_='post_date')
-        if date_elem:
-            date_text = date_elem.get_text(strip=True)
-            # Remove any trailing edited indicator
-            # Example: "09-Dec-2021, 10:06 PM " or "09-Dec-2021, 10:06 PM (This post was last modified: ...)"
-            # We'll try to parse the part before the first '('
-            if '(' in date_text:
-                date_text = date_text.split('(')[0].strip()
-            # Try common formats seen in the sample
-            for fmt in ('%d-%b-%Y, %I:%M %p', '%d-%b-%Y, %H:%M'):
-                try:
-                    post_date = datetime.strptime(date_text, fmt)
-                    break
-                except:
-                    continue
-        if not post_date:
-            print(f"Debug: Could not parse date from element {date_elem}")
-        
-        # Extract post text
-        post_text = None
-        text_elem = post_element.find('div', class_='post_body')
-        if text_elem:
-            # Make a copy to avoid modifying the original
-            text_elem_copy = BeautifulSoup(str(text_elem), 'lxml')
-            
-            # First, identify and remove reply blockquotes (those with post IDs)
-            # We need to do this before processing <a> tags to preserve the href for detection
-            all_blockquotes = list(text_elem_copy.find_all('blockquote', class_='mycode_quote'))
-            for blockquote in reversed(all_blockquotes):
-                # Check if the blockquote still exists (may have been removed by parent decomposition)
-                if not blockquote or not blockquote.parent:
-                    continue
-                    
-                # Check if this blockquote has a <cite> element containing a link with pid=
-                # This indicates it's a reply to another post
-                is_reply_quote = False
-                cite_elem = blockquote.find('cite')
-                if cite_elem:
-                    # Look for any <a> tag within the cite that has 'pid=' in href
-                    for a_tag in cite_elem.find_all('a', href=True):
-                        href = a_tag.get('href', '')
-                        if 'pid=' in href:
-                            is_reply_quote = True
-                            break
-                
-                # If it's a reply quote, remove it entirely
-                if is_reply_quote:
-                    blockquote.decompose()
-            
-            # Now process all remaining <a> tags to ensure URLs are valid
-            for a_tag in text_elem_copy.find_all('a', href=True):
-                href = a_tag.get('href', '').strip()
-                inner_text = a_tag.get_text(strip=True)
-                
-                # Check if the inner text appears to be a truncated URL
-                # Common patterns: contains "...", ends with "...", or is clearly a partial URL
-                is_truncated = ('...' in inner_text) or \
-                               (inner_text.startswith('http') and '...' in inner_text) or \
-                               (href.startswith('http') and not inner_text.startswith('http'))
-                
-                if href and is_truncated:
-                    # Replace the entire tag with the full URL
-                    a_tag.replace_with(href)
-                elif href and href != inner_text:
-                    # Keep the link text but append the full URL in parentheses
-                    # Replace the tag with: "text (url)"
-                    a_tag.replace_with(f"{inner_text} ({href})")
-                else:
-                    # If href and inner_text are the same, or no href, just keep the text
-                    a_tag.replace_with(inner_text)
-            
-            # Now process remaining blockquote elements (regular quotes, not replies)
-            # These are blockquotes that weren't removed in the first pass
-            remaining_blockquotes = list(text_elem_copy.find_all('blockquote', class_='mycode_quote'))
-            for blockquote in remaining_blockquotes:
-                # Check if the blockquote still exists
-                if not blockquote or not blockquote.parent:
-                    continue
-                
-                # Before processing, replace <br> tags inside the blockquote with newlines
-                for br in blockquote.find_all('br'):
-                    br.replace_with('\n')
-                
-                # Get the text from the blockquote, preserving newlines
-                quote_text = blockquote.get_text(separator='\n', strip=False)
-                # Split into lines and process
-                lines = quote_text.split('\n')
-                # Clean up each line
-                cleaned_lines = []
-                for line in lines:
-                    line = line.rstrip()
-                    cleaned_lines.append(line)
-                # Remove leading and trailing empty lines
-                while cleaned_lines and cleaned_lines[0] == '':
-                    cleaned_lines.pop(0)
-                while cleaned_lines and cleaned_lines[-1] == '':
-                    cleaned_lines.pop(-1)
-                # Compress multiple consecutive empty lines within the quote to single empty lines
-                compressed_lines = []
-                for line in cleaned_lines:
-                    if line == '':
-                        if not compressed_lines or compressed_lines[-1] != '':
-                            compressed_lines.append('')
-                    else:
-                        compressed_lines.append(line)
-                # Prefix each line with "> " to indicate it's a quote
-                quoted_lines = []
-                for line in compressed_lines:
-                    if line == '':
-                        quoted_lines.append('>')
-                    else:
-                        quoted_lines.append(f"> {line}")
-                # Join them back with newlines
-                formatted_quote = '\n'.join(quoted_lines)
-                # Replace the blockquote with the formatted quote text
-                blockquote.replace_with(formatted_quote)
-            
-            # Replace <br> tags with newlines to preserve line breaks
-            for br in text_elem_copy.find_all('br'):
-                br.replace_with('\n')
-            
-            # Get text with newlines preserved
-            raw_text = text_elem_copy.get_text(separator='\n', strip=False)
-            
-            # Split into lines and process each line
-            lines = raw_text.split('\n')
-            processed_lines = []
-            
-            for line in lines:
-                # Strip trailing whitespace, but keep leading whitespace (for indentation)
-                line = line.rstrip()
-                # Skip empty lines that are between other empty lines (compress multiple blank lines)
-                if line == '':
-                    if not processed_lines or processed_lines[-1] != '':
-                        processed_lines.append('')
-                else:
-                    processed_lines.append(line)
-            
-            # Remove leading empty lines
-            while processed_lines and processed_lines[0] == '':
-                processed_lines.pop(0)
-            # Remove trailing empty lines
-            while processed_lines and processed_lines[-1] == '':
-                processed_lines.pop(-1)
-            
-            # Join lines back together
-            post_text = '\n'.join(processed_lines)
-            
-            # Remove leading/trailing whitespace
-            post_text = post_text.strip()
-            
-            # If post_text is empty after processing, try a different approach
-            if not post_text:
-                # Fallback to original method
-                post_text = text_elem_copy.get_text(strip=True)
-        if not post_text:
-            print(f"Debug: Could not find post_body in post {post_id}")
-        
-        # Extract username (same as in parse_user_info)
-        username = None
-        username_elem = post_element.find('span', class_='largetext')
-        if username_elem:
-            # First try to find an <a> tag (for registered users)
-            username_link = username_elem.find('a')
-            if username_link:
-                username = username_link.get_text(strip=True)
-            else:
-                # If no <a> tag, get the text directly (for unregistered users)
-                username = username_elem.get_text(strip=True)
-        if not username:
-            print(f"Debug: Could not find username in post {post_id}")
-        
-        # Extract replies_to from blockquote
-        replies_to = None
-        # Find the post_body element
-        post_body = post_element.find('div', class_='post_body')
-        if post_body:
-            # Look for blockquote elements that are direct children of post_body
-            # We want the top-level reply, which should be the first direct child blockquote
-            blockquotes = post_body.find_all('blockquote', class_='mycode_quote', recursive=False)
-            if blockquotes:
-                # Take the first top-level blockquote
-                blockquote = blockquotes[0]
-                # Find the link inside the blockquote's cite
-                cite = blockquote.find('cite')
-                if cite:
-                    # Look for a link
-                    link = cite.find('a')
-                    if link:
-                        href = link.get('href', '')
-                        # Parse the URL to extract the pid parameter
-                        try:
-                            parsed = urlparse(href)
-                            query_params = parse_qs(parsed.query)
-                            if 'pid' in query_params:
-                                pid_value = query_params['pid'][0]
-                                if pid_value.isdigit():
-                                    replies_to = int(pid_value)
-                        except Exception as e:
-                            print(f"Debug: Could not parse href {href}: {e}")
-        
-        return post_id, post_date, post_text, username, replies_to
+    def get_content(self, url):
+        """Fetch a URL and return the response body as bytes"""
+        return self.get_response(url)[1]
+    
+    def get_soup(self, url):
+        """Fetch a URL and return the parsed document"""
+        content = self.get_content(url)
+        if content is None:
+            return None
+        return self.parser.parse_document(content)
+    
+    def page_url(self, thread_id, page_num, kind='thread'):
+        """Return the URL of a thread page, kind is 'thread' or 'print'"""
+        template = config.PRINT_THREAD_URL_TEMPLATE if kind == 'print' else config.THREAD_URL_TEMPLATE
+        return template.format(tid=thread_id, page=page_num)
+    
+    def archive_page(self, thread_id, page_num, url, content, kind='thread'):
+        """Keep a copy of a fetched page in the archive, if archiving is enabled"""
+        if self.archive is not None:
+            self.archive.store(thread_id, page_num, url, content, kind)
+    
+    def get_page_response(self, thread_id, page_num, kind='thread'):
+        """Fetch a thread page and archive it, returning (status, parsed document or None)"""
+        url = self.page_url(thread_id, page_num, kind)
+        status, content = self.get_response(url)
+        if content is None:
+            return status, None
+        self.archive_page(thread_id, page_num, url, content, kind)
+        return status, self.parser.parse_document(content)
+    
+    def get_page_soup(self, thread_id, page_num, kind='thread'):
+        """Fetch a thread page, archive it and return the parsed document"""
+        return self.get_page_response(thread_id, page_num, kind)[1]
+    
+    async def fetch_page_response(self, fetcher, thread_id, page_num, kind='thread'):
+        """Fetch a thread page through fetcher and archive it, returning (status, body)"""
+        url = self.page_url(thread_id, page_num, kind)
+        status, content = await fetcher.fetch_response(url)
+        if content is not None:
+            self.archive_page(thread_id, page_num, url, content, kind)
+        return status, content
+    
+    async def fetch_page(self, fetcher, thread_id, page_num, kind='thread'):
+        """Fetch a thread page through fetcher, archive it and return its body"""
+        return (await self.fetch_page_response(fetcher, thread_id, page_num, kind))[1]
+    
+    def miss_outcome(self, status):
+        """Classify a failed page 1 fetch for the negative cache"""
+        if status in (401, 403):
+            return 'forbidden'
+        if status in (404, 410):
+            return 'not_found'
+        return 'http_error'
+    
+    def record_outcome(self, thread_id, outcome, status=None):
+        """Record a thread miss in the negative cache, or clear it once the thread was scraped"""
+        if outcome:
+            self.db.record_miss(thread_id, outcome, status)
+            self.known_misses.add(thread_id)
+        elif thread_id in self.known_misses:
+            self.db.clear_miss(thread_id)
+            self.known_misses.discard(thread_id)
     
     def scrape_thread_page(self, thread_id, page_num):
         """Scrape a single page of a thread"""
-        url = config.THREAD_URL_TEMPLATE.format(tid=thread_id, page=page_num)
-        print(f"Scraping {url}")
+        url = self.page_url(thread_id, page_num)
+        logger.debug("Scraping %s", url)
         
-        soup = self.get_soup(url)
-        if not soup:
-            print(f"Failed to retrieve {url}")
+        soup = self.get_page_soup(thread_id, page_num)
+        if soup is None:
+            logger.warning("Failed to retrieve %s", url)
             return False
         
-        # On first page, extract thread info and insert it before processing posts
-        if page_num == 1:
-            # Extract thread title
-            thread_title = None
-            title_elem = soup.find('title')
-            if title_elem:
-                thread_title = title_elem.get_text(strip=True)
-            
-            # Extract board name from navigation breadcrumb
-            board_name = None
-            nav_div = soup.find('div', class_='navigation')
-            if nav_div:
-                # Find all <a> tags that are not part of pagination
-                links = []
-                for a in nav_div.find_all('a'):
-                    # Skip pagination links
-                    if a.get('class') and any(cls.startswith('pagination_') for cls in a.get('class')):
-                        continue
-                    # Also skip if inside a div with class 'pagination'
-                    parent_div = a.find_parent('div', class_='pagination')
-                    if parent_div:
-                        continue
-                    links.append(a)
-                if links:
-                    # Combine all link texts to form full breadcrumb path
-                    link_texts = [link.get_text(strip=True) for link in links]
-                    board_name = ' › '.join(link_texts)
-            
-            # Extract thread date (from first post's date)
-            thread_date = None
-            first_post = soup.find('div', class_='post')
-            if first_post:
-                date_elem = first_post.find('span', class_='post_date')
-                if date_elem:
-                    date_text = date_elem.get_text(strip=True)
-                    if '(' in date_text:
-                        date_text = date_text.split('(')[0].strip()
-                    for fmt in ('%d-%b-%Y, %I:%M %p', '%d-%b-%Y, %H:%M'):
-                        try:
-                            thread_date = datetime.strptime(date_text, fmt)
-                            break
-                        except:
-                            continue
-            
-            # Get total pages
-            total_pages = self.extract_number_of_pages(soup, thread_id)
-            
-            # Insert thread info if we have a title
-            if thread_title:
-                self.db.insert_thread(thread_id, thread_title, board_name, thread_date)
-                print(f"Thread {thread_id}: {thread_title} (Board: {board_name}) - {total_pages} pages")
-            else:
-                print(f"Thread {thread_id}: Could not extract thread title, not saving thread to database")
-                # Without a thread title, we can't insert the thread, so we shouldn't process posts
-                return False
-        
-        # Find all posts on the page by their id pattern (more reliable than class)
-        posts = soup.find_all('div', id=re.compile(r'post_\d+'))
-        print(f"Found {len(posts)} posts on page {page_num}")
-        
-        # Track if we found at least one valid post
-        found_valid_posts = False
-        
-        for post in posts:
-            post_id, post_date, post_text, username, replies_to = self.parse_post(post, thread_id)
-            if post_id and username:
-                found_valid_posts = True
-                # Parse user info (posts, threads, joined date)
-                user_info = self.parse_user_info(post)
-                username_found, num_posts, num_threads, joined_date = user_info
-                # Ensure username matches
-                if username_found and username_found != username:
-                    # Use the one from parse_user_info
-                    username = username_found
-                # Insert user with extracted info
-                self.db.insert_user(username, num_posts, num_threads, joined_date)
-                # Insert post
-                self.db.insert_post(post_id, post_date, post_text, username, thread_id, replies_to)
-            else:
-                # Debug: print why post wasn't parsed
-                print(f"Warning: Failed to parse post from element {post.get('id')}")
-        
+        found_valid_posts = self.process_thread_page(thread_id, page_num, soup)
         time.sleep(config.DELAY_BETWEEN_REQUESTS)
         return found_valid_posts
     
-    def scrape_thread(self, thread_id):
-        """Scrape all pages of a thread"""
-        # Check if thread already exists
-        if self.db.thread_exists(thread_id):
-            print(f"Thread {thread_id} already exists in database, skipping")
-            return True
-        
-        # First, get the first page to know total number of pages
-        url = config.THREAD_URL_TEMPLATE.format(tid=thread_id, page=1)
-        soup = self.get_soup(url)
-        if not soup:
-            print(f"Thread {thread_id} might not exist or is inaccessible")
+    def process_thread_page(self, thread_id, page_num, soup, checkpoint=True):
+        """Parse an already fetched thread page and store its thread, users and posts"""
+        rows = self.parser.parse_thread_page(thread_id, page_num, soup)
+        if rows is None:
             return False
+        self.collect_media(soup)
+        return self.store_thread_page(thread_id, page_num, rows, checkpoint)
+    
+    def collect_media(self, soup):
+        """Record the attachments and images of the posts on a fetched page, if MEDIA_DOWNLOAD is set"""
+        if config.MEDIA_DOWNLOAD:
+            self.store_media(self.parser.parse_media(soup))
+    
+    def store_media(self, media_rows):
+        """Record (post_id, url, kind) rows for the media downloader"""
+        if media_rows:
+            self.db.insert_post_media(media_rows)
+    
+    def store_thread_page(self, thread_id, page_num, rows, checkpoint=True):
+        """Store the rows of a thread page along with a checkpoint of the thread's progress
         
-        # Check if thread exists by looking for error messages or empty content
-        # This is forum-specific
-        error_msg = soup.find('div', class_='error')
-        if error_msg and 'not found' in error_msg.get_text().lower():
-            print(f"Thread {thread_id} not found")
-            return False
+        Pages must be stored in order for the checkpoint to be valid, pages stored out of
+        order (checkpoint=False) only count towards the state saved when the thread is finished.
+        """
+        self.track_progress(thread_id, page_num, rows[2])
+        progress = self.crawl_progress.get(thread_id)
+        crawl_state = (thread_id, *progress, False) if checkpoint and progress else None
+        return self.store_page_rows(*rows, crawl_state=crawl_state)
+    
+    def store_page_rows(self, thread_row, user_rows, post_rows, crawl_state=None):
+        """Store the rows parsed from a thread page, returning True if it had valid posts"""
+        self.db.insert_page(thread_row, user_rows, post_rows, crawl_state)
+        return bool(post_rows)
+    
+    def track_progress(self, thread_id, page_num, post_rows):
+        """Remember the last page, highest post id and post count stored for a thread"""
+        if not post_rows:
+            return
+        last_page, max_post_id, post_count = self.crawl_progress.get(thread_id, (0, 0, 0))
+        self.crawl_progress[thread_id] = (max(last_page, page_num),
+                                          max(max_post_id, max(row[0] for row in post_rows)),
+                                          post_count + len(post_rows))
+    
+    def resume_page(self, thread_id, progress):
+        """Return the first page of a thread still to scrape, given its stored progress
         
-        total_pages = self.extract_number_of_pages(soup, thread_id)
+        A thread with an incomplete checkpoint resumes after the last page committed.
+        """
+        if progress is None or not progress[0]:
+            return 1
+        last_page, max_post_id, post_count, _ = progress
+        self.crawl_progress[thread_id] = (last_page, max_post_id, post_count)
+        logger.info("Resuming thread %s from page %s", thread_id, last_page + 1)
+        return last_page + 1
+    
+    def past_last_page(self, thread_id, post_rows):
+        """Check if the page fetched to resume a thread only has posts stored before
         
-        # Track if any valid posts were found across all pages
-        any_valid_posts_found = False
+        The forum serves an earlier page when asked for one past the end, which happens
+        when the checkpoint was already at the thread's last page.
+        """
+        progress = self.crawl_progress.get(thread_id)
+        return bool(post_rows) and progress is not None and max(row[0] for row in post_rows) <= progress[1]
+    
+    def thread_unavailable(self, thread_id, outcome, status, resumed=False):
+        """Handle a thread whose first fetched page failed or is an error page"""
+        metrics.inc('scraper_threads_total', outcome=outcome)
+        if resumed:
+            # Keep the checkpoint so the next run resumes from the same page
+            self.crawl_progress.pop(thread_id, None)
+        else:
+            self.record_outcome(thread_id, outcome, status)
+        self.thread_outcomes.setdefault(thread_id, outcome)
+    
+    def thread_failed(self, thread_id):
+        """Record that scraping or storing a thread raised an error, whatever it is finished with"""
+        self.thread_outcomes[thread_id] = 'error'
+    
+    def finish_thread(self, thread_id, found_valid_posts, complete=True):
+        """Record the outcome of a scraped thread and save how far it was crawled
+        
+        complete is False when a page failed, so the next run resumes from that page.
+        """
+        self.record_outcome(thread_id, None if found_valid_posts else 'no_posts')
+        outcome = ('complete' if complete else 'partial') if found_valid_posts else 'no_posts'
+        metrics.inc('scraper_threads_total', outcome=outcome)
+        progress = self.crawl_progress.pop(thread_id, None)
+        if found_valid_posts and progress:
+            self.db.insert_crawl_state(thread_id, *progress, complete)
+        self.thread_outcomes.setdefault(thread_id, outcome)
+    
+    def thread_outcome(self, thread_id, start_page, total_pages, resumed, page_results):
+        """Work out how far a thread was scraped from whether each of its pages had valid posts
         
-        # Scrape each page
-        for page_num in range(1, total_pages + 1):
-            success = self.scrape_thread_page(thread_id, page_num)
-            # If scrape_thread_page returns True, it means it found valid posts on that page
+        page_results holds one result per page in order from start_page. It is consumed up to
+        the first page without valid posts, so a generator can fetch and store each page as it goes.
+        Returns (any_valid_posts_found, complete) for finish_thread.
+        """
+        any_valid_posts_found = resumed
+        complete = False
+        for page_num, success in enumerate(page_results, start=start_page):
             if success:
                 any_valid_posts_found = True
-            elif not success and page_num == 1:
+                complete = page_num == total_pages
+            elif page_num == 1:
                 # If the first page has no valid posts, there's no point in continuing
-                print(f"No valid posts found on first page of thread {thread_id}, stopping")
+                logger.info("No valid posts found on first page of thread %s, stopping", thread_id)
+                break
+            elif page_num == start_page:
+                # The checkpoint was already at the thread's last page
+                complete = True
                 break
             else:
-                print(f"Failed to scrape page {page_num} of thread {thread_id}")
+                logger.warning("Failed to scrape page %s of thread %s", page_num, thread_id)
                 break
+        return any_valid_posts_found, complete
+    
+    def scrape_thread(self, thread_id):
+        """Scrape all pages of a thread, resuming it if an earlier run was interrupted"""
+        # Check if thread already exists
+        progress = self.db.get_thread_progress([thread_id]).get(thread_id)
+        if progress is not None and progress[3]:
+            logger.info("Thread %s already exists in database, skipping", thread_id)
+            return True
+        start_page = self.resume_page(thread_id, progress)
+        resumed = start_page > 1
+        
+        # First, get the first page to know total number of pages
+        logger.debug("Scraping %s", self.page_url(thread_id, start_page))
+        status, soup = self.get_page_response(thread_id, start_page)
+        if soup is None:
+            logger.info("Thread %s might not exist or is inaccessible", thread_id)
+            self.thread_unavailable(thread_id, self.miss_outcome(status), status, resumed)
+            return False
+        
+        if self.parser.is_not_found(soup):
+            logger.info("Thread %s not found", thread_id)
+            self.thread_unavailable(thread_id, 'not_found', status, resumed)
+            return False
+        
+        if self.parser.is_forbidden(soup):
+            logger.info("Thread %s is not accessible with the configured cookies", thread_id)
+            self.thread_unavailable(thread_id, 'forbidden', status, resumed)
+            return False
+        
+        total_pages = max(self.parser.extract_number_of_pages(soup, thread_id), start_page)
+        if resumed and self.past_last_page(thread_id, self.parser.parse_thread_page(thread_id, start_page, soup)[2]):
+            logger.info("Thread %s was already scraped up to its last page", thread_id)
+            self.finish_thread(thread_id, True)
+            return True
+        
+        if config.PRINT_VIEW and not resumed:
+            result = self.scrape_thread_print(thread_id, soup, total_pages)
+            if result is not None:
+                self.finish_thread(thread_id, result)
+                return result
+            logger.info("Print view unusable for thread %s, using paginated pages", thread_id)
+        
+        # Scrape each page, the first one is reused from above
+        def scrape_pages():
+            yield self.process_thread_page(thread_id, start_page, soup)
+            time.sleep(config.DELAY_BETWEEN_REQUESTS)
+            for page_num in range(start_page + 1, total_pages + 1):
+                yield self.scrape_thread_page(thread_id, page_num)
+        
+        any_valid_posts_found, complete = self.thread_outcome(thread_id, start_page, total_pages, resumed,
+                                                              scrape_pages())
         
         # Return True only if we found at least one valid post
         # This helps track whether the thread was actually saved to the database
+        self.finish_thread(thread_id, any_valid_posts_found, complete)
         return any_valid_posts_found
     
-    def scrape_range(self, start_tid, end_tid):
-        """Scrape a range of thread IDs"""
-        for thread_id in range(start_tid, end_tid + 1):
-            print(f"\nProcessing thread ID: {thread_id}")
-            self.scrape_thread(thread_id)
-            # Add a small delay between threads
+    def print_stats_pages(self, first_soup, parsed, total_pages):
+        """Pick the paginated pages needed for author statistics missing from the print view
+        
+        Returns None if the print view doesn't look complete compared to the paginated view.
+        """
+        per_page = self.parser.count_posts(first_soup)
+        if per_page == 0 or len(parsed) < (total_pages - 1) * per_page + 1:
+            return None
+        
+        # Users on page 1 get their statistics from the page we already have,
+        # users already in the database keep the statistics stored for them
+        first_index = {}
+        for index, post in enumerate(parsed):
+            first_index.setdefault(post[3], index)
+        missing = [username for username, index in first_index.items() if index >= per_page]
+        known = self.db.get_users_with_stats(missing) if missing else set()
+        return sorted({first_index[username] // per_page + 1
+                       for username in missing if username not in known}), per_page
+    
+    def store_print_thread(self, thread_id, first_soup, parsed, per_page, stats_soups):
+        """Store a thread parsed from its print view plus the paginated pages fetched for user statistics
+        
+        Returns None if a paginated page couldn't be fetched or stored, as the print view
+        posts of its authors would then reference users that were never stored.
+        """
+        if any(soup is None for soup in stats_soups.values()):
+            return None
+        if not self.process_thread_page(thread_id, 1, first_soup):
+            return False
+        
+        stored_pages = {1}
+        for page_num, soup in stats_soups.items():
+            # Out of order, so only page 1 checkpoints an interrupted thread
+            if not self.process_thread_page(thread_id, page_num, soup, checkpoint=False):
+                # The paginated path stores these pages again and counts them afresh
+                self.crawl_progress.pop(thread_id, None)
+                return None
+            stored_pages.add(page_num)
+        
+        for index, (post_id, post_date, post_text, username, replies_to) in enumerate(parsed):
+            page_num = index // per_page + 1
+            if page_num in stored_pages:
+                continue
+            self.db.insert_post(post_id, post_date, post_text, username, thread_id, replies_to)
+            self.track_progress(thread_id, page_num, [(post_id,)])
+        logger.info("Thread %s: stored %s posts from print view (%s paginated pages fetched)",
+                    thread_id, len(parsed), len(stored_pages))
+        return True
+    
+    def scrape_thread_print(self, thread_id, first_soup, total_pages):
+        """Scrape a thread from printthread.php, returning None if the paginated path must be used"""
+        logger.debug("Scraping %s", self.page_url(thread_id, 1, 'print'))
+        print_soup = self.get_page_soup(thread_id, 1, 'print')
+        if print_soup is None:
+            return None
+        print_soups = [print_soup]
+        print_pages = self.parser.extract_number_of_pages(print_soup, thread_id, script='printthread.php')
+        for page_num in range(2, print_pages + 1):
+            time.sleep(config.DELAY_BETWEEN_REQUESTS)
+            print_soups.append(self.get_page_soup(thread_id, page_num, 'print'))
+            if print_soups[-1] is None:
+                return None
+        
+        parsed = self.parser.parse_print_posts(thread_id, print_soups)
+        plan = self.print_stats_pages(first_soup, parsed, total_pages) if parsed else None
+        if plan is None:
+            return None
+        stats_pages, per_page = plan
+        
+        stats_soups = {}
+        for page_num in stats_pages:
+            if page_num == 1:
+                continue
             time.sleep(config.DELAY_BETWEEN_REQUESTS)
+            stats_soups[page_num] = self.get_page_soup(thread_id, page_num)
+        for print_soup in print_soups:
+            self.collect_media(print_soup)
+        return self.store_print_thread(thread_id, first_soup, parsed, per_page, stats_soups)
+    
+    async def scrape_thread_print_async(self, fetcher, thread_id, first_soup, total_pages):
+        """Concurrent version of scrape_thread_print"""
+        logger.debug("Scraping %s", self.page_url(thread_id, 1, 'print'))
+        content = await self.fetch_page(fetcher, thread_id, 1, 'print')
+        if content is None:
+            return None
+        print_soup = self.parser.parse_document(content)
+        print_pages = self.parser.extract_number_of_pages(print_soup, thread_id, script='printthread.php')
+        contents = await asyncio.gather(*(self.fetch_page(fetcher, thread_id, page_num, 'print')
+                                          for page_num in range(2, print_pages + 1)))
+        if any(c is None for c in contents):
+            return None
+        print_soups = [print_soup] + [self.parser.parse_document(c) for c in contents]
+        
+        parsed = self.parser.parse_print_posts(thread_id, print_soups)
+        plan = self.print_stats_pages(first_soup, parsed, total_pages) if parsed else None
+        if plan is None:
+            return None
+        stats_pages, per_page = plan
+        
+        stats_pages = [page_num for page_num in stats_pages if page_num != 1]
+        contents = await asyncio.gather(*(self.fetch_page(fetcher, thread_id, page_num)
+                                          for page_num in stats_pages))
+        stats_soups = {page_num: self.parser.parse_document(c) if c is not None else None
+                       for page_num, c in zip(stats_pages, contents)}
+        for print_soup in print_soups:
+            self.collect_media(print_soup)
+        return self.store_print_thread(thread_id, first_soup, parsed, per_page, stats_soups)
+    
+    async def scrape_thread_async(self, fetcher, thread_id):
+        """Scrape all pages of a thread, fetching pages concurrently through fetcher"""
+        progress = self.db.get_thread_progress([thread_id]).get(thread_id)
+        if progress is not None and progress[3]:
+            logger.info("Thread %s already exists in database, skipping", thread_id)
+            return True
+        start_page = self.resume_page(thread_id, progress)
+        resumed = start_page > 1
+        
+        status, content = await self.fetch_page_response(fetcher, thread_id, start_page)
+        if content is None:
+            logger.info("Thread %s might not exist or is inaccessible", thread_id)
+            self.thread_unavailable(thread_id, self.miss_outcome(status), status, resumed)
+            return False
+        first_soup = self.parser.parse_document(content)
+        
+        if self.parser.is_not_found(first_soup):
+            logger.info("Thread %s not found", thread_id)
+            self.thread_unavailable(thread_id, 'not_found', status, resumed)
+            return False
+        
+        if self.parser.is_forbidden(first_soup):
+            logger.info("Thread %s is not accessible with the configured cookies", thread_id)
+            self.thread_unavailable(thread_id, 'forbidden', status, resumed)
+            return False
+        
+        total_pages = max(self.parser.extract_number_of_pages(first_soup, thread_id), start_page)
+        if resumed and self.past_last_page(thread_id, self.parser.parse_thread_page(thread_id, start_page, first_soup)[2]):
+            logger.info("Thread %s was already scraped up to its last page", thread_id)
+            self.finish_thread(thread_id, True)
+            return True
+        
+        if config.PRINT_VIEW and not resumed:
+            result = await self.scrape_thread_print_async(fetcher, thread_id, first_soup, total_pages)
+            if result is not None:
+                self.finish_thread(thread_id, result)
+                return result
+            logger.info("Print view unusable for thread %s, using paginated pages", thread_id)
+        
+        # Fetch the remaining pages concurrently, the first one is reused from above
+        contents = [content] + list(await asyncio.gather(*(self.fetch_page(fetcher, thread_id, page_num)
+                                                           for page_num in range(start_page + 1, total_pages + 1))))
+        
+        # Process pages in order so the database ends up as with the sequential path
+        def process_pages():
+            for page_num, page_content in enumerate(contents, start=start_page):
+                url = self.page_url(thread_id, page_num)
+                logger.debug("Scraping %s", url)
+                if page_content is None:
+                    logger.warning("Failed to retrieve %s", url)
+                    yield False
+                else:
+                    soup = first_soup if page_num == start_page else self.parser.parse_document(page_content)
+                    yield self.process_thread_page(thread_id, page_num, soup)
+        
+        any_valid_posts_found, complete = self.thread_outcome(thread_id, start_page, total_pages, resumed,
+                                                              process_pages())
+        self.finish_thread(thread_id, any_valid_posts_found, complete)
+        return any_valid_posts_found
+    
+    async def run_thread_workers(self, thread_ids, handle, concurrency=None, stop=None):
+        """Run handle(fetcher, thread_id) for the given thread IDs with several threads in flight at once
+        
+        If stop is given, no more threads are started once stop(fetcher) returns True.
+        """
+        concurrency = concurrency or config.MAX_CONCURRENCY
+        queue = asyncio.Queue()
+        for thread_id in thread_ids:
+            queue.put_nowait(thread_id)
+        
+        async def worker(fetcher):
+            while True:
+                if stop is not None and stop(fetcher):
+                    return
+                try:
+                    thread_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                logger.info("Processing thread ID: %s", thread_id)
+                try:
+                    await handle(fetcher, thread_id)
+                except Exception as e:
+                    logger.error("Error scraping thread %s: %s", thread_id, e)
+                    self.thread_failed(thread_id)
+        
+        async with AsyncFetcher(max_concurrency=concurrency) as fetcher:
+            await asyncio.gather(*(worker(fetcher) for _ in range(concurrency)))
+    
+    async def scrape_threads_async(self, thread_ids):
+        """Scrape the given thread IDs with several threads in flight at once"""
+        await self.run_thread_workers(thread_ids, self.scrape_thread_async)
+    
+    async def refresh_thread_async(self, fetcher, thread_id, crawl_state):
+        """Fetch the last known page of a stored thread and any pages after it, storing only new or edited posts
+        
+        crawl_state is (last_page, max_post_id, post_count) as returned by Database.get_crawl_states.
+        Returns the number of new posts stored, or None if the thread couldn't be refreshed.
+        """
+        last_page, max_post_id, post_count = crawl_state
+        max_post_id = max_post_id or 0
+        pages = {}
+        
+        async def fetch_soup(page_num):
+            content = await self.fetch_page(fetcher, thread_id, page_num)
+            if content is None:
+                logger.warning("Failed to retrieve %s", self.page_url(thread_id, page_num))
+                return None
+            return self.parser.parse_document(content)
+        
+        start_page = last_page or 1
+        soup = await fetch_soup(start_page)
+        if soup is None:
+            return None
+        if self.parser.is_not_found(soup) or self.parser.is_forbidden(soup):
+            logger.info("Thread %s is no longer accessible", thread_id)
+            return None
+        if not last_page:
+            # Threads stored before crawl state was recorded: estimate the last page from the post count
+            per_page = self.parser.count_posts(soup)
+            if per_page and post_count > per_page:
+                pages[1] = soup
+                start_page = math.ceil(post_count / per_page)
+                soup = await fetch_soup(start_page)
+                if soup is None:
+                    return None
+        pages[start_page] = soup
+        
+        # If posts were deleted, new posts may have moved onto earlier pages
+        while start_page > 1:
+            post_ids = [row[0] for row in self.parser.parse_thread_page(thread_id, start_page, soup)[2]]
+            if post_ids and min(post_ids) <= max_post_id:
+                break
+            start_page -= 1
+            soup = pages.get(start_page) or await fetch_soup(start_page)
+            if soup is None:
+                return None
+            pages[start_page] = soup
+        
+        total_pages = max(self.parser.extract_number_of_pages(pages[max(pages)], thread_id), max(pages))
+        later_pages = [page_num for page_num in range(start_page + 1, total_pages + 1) if page_num not in pages]
+        soups = await asyncio.gather(*(fetch_soup(page_num) for page_num in later_pages))
+        pages.update(zip(later_pages, soups))
+        
+        known_hashes = self.db.get_post_hashes(thread_id)
+        new_posts = 0
+        for page_num in range(start_page, total_pages + 1):
+            soup = pages.get(page_num)
+            if soup is None:
+                break
+            rows = self.parser.parse_thread_page(thread_id, page_num, soup)
+            if rows is None or not rows[2]:
+                break
+            # Posts edited since they were stored are rewritten along with the new ones
+            user_rows, post_rows = self.db.skip_unchanged_posts(rows[1], rows[2], known_hashes)
+            if post_rows:
+                self.store_page_rows(None, user_rows, post_rows)
+                self.collect_media(soup)
+            new_posts += sum(1 for post_row in post_rows if post_row[0] > max_post_id)
+            last_page = page_num
+            max_post_id = max([max_post_id] + [row[0] for row in rows[2]])
+        
+        self.db.insert_crawl_state(thread_id, last_page, max_post_id, post_count + new_posts)
+        logger.info("Thread %s: %s new posts, last page %s", thread_id, new_posts, last_page)
+        return new_posts
+    
+    def refresh(self, concurrent=None, discover=False):
+        """Collect new replies to threads already in the database without recrawling them
+        
+        With discover, only threads whose listed reply count grew are refreshed and threads
+        that aren't in the database yet are scraped in full.
+        """
+        if concurrent is None:
+            concurrent = config.CONCURRENT_FETCH
+        states = self.db.get_crawl_states()
+        thread_ids = sorted(states)
+        if discover:
+            threads = discover_threads()
+            self.db.insert_thread_listings([listing.row() for listing in threads.values()])
+            thread_ids = [thread_id for thread_id in thread_ids if thread_id in threads and
+                          (threads[thread_id].replies is None or threads[thread_id].replies + 1 > states[thread_id][2])]
+            new_threads = sorted(set(threads) - set(states))
+            if new_threads:
+                logger.info("Scraping %s new threads", len(new_threads))
+                self.scrape_threads(new_threads, concurrent)
+        logger.info("Refreshing %s of %s known threads", len(thread_ids), len(states))
+        self.refresh_threads(thread_ids, states, concurrent)
+    
+    def refresh_threads(self, thread_ids, states, concurrent, stop=None):
+        """Refresh the given stored threads in order, see refresh_thread_async"""
+        async def refresh_thread(fetcher, thread_id):
+            await self.refresh_thread_async(fetcher, thread_id, states[thread_id])
+        
+        asyncio.run(self.run_thread_workers(thread_ids, refresh_thread, None if concurrent else 1, stop))
+    
+    def refresh_scheduled(self, concurrent=None, max_requests=None, max_minutes=None):
+        """Refresh the threads that are due according to the activity-weighted schedule
+        
+        Threads are refreshed highest priority first until the request or time budget
+        is used up, then the schedule is recomputed and saved for the next run.
+        """
+        if concurrent is None:
+            concurrent = config.CONCURRENT_FETCH
+        if max_requests is None:
+            max_requests = config.SCHEDULE_MAX_REQUESTS
+        if max_minutes is None:
+            max_minutes = config.SCHEDULE_MAX_MINUTES
+        scheduler = CrawlScheduler(self.db)
+        entries = scheduler.update()
+        due = [entry.thread_id for entry in entries if entry.is_due]
+        logger.info("%s of %s threads are due for a refresh", len(due), len(entries))
+        
+        deadline = time.monotonic() + max_minutes * 60 if max_minutes else None
+        def out_of_budget(fetcher):
+            return ((max_requests and fetcher.request_count >= max_requests) or
+                    (deadline is not None and time.monotonic() >= deadline))
+        
+        self.refresh_threads(due, self.db.get_crawl_states(), concurrent, out_of_budget)
+        entries = scheduler.update()
+        logger.info("Refresh done, %s threads still due", sum(entry.is_due for entry in entries))
+    
+    def skip_known_misses(self, thread_ids, skip=True):
+        """Filter out threads whose negative cache entry hasn't expired yet, unless skip is False
+        
+        Either way the recorded misses are remembered, so they are cleared for the threads scraped.
+        """
+        misses = self.db.get_misses(config.MISS_TTL_HOURS)
+        self.known_misses = set(misses)
+        active = {thread_id for thread_id, is_active in misses.items() if is_active} if skip else set()
+        if active:
+            logger.info("Skipping %s threads recorded as missing or failed (negative cache)", len(active))
+        return (thread_id for thread_id in thread_ids if thread_id not in active)
+    
+    def scrape_threads(self, thread_ids, concurrent=None, use_negative_cache=True):
+        """Scrape the given thread IDs, returning {thread_id: outcome}
+        
+        outcome is the scraper_threads_total outcome the thread finished with ('complete',
+        'partial', 'no_posts', 'not_found', 'forbidden' or 'http_error'), 'error' if scraping
+        it raised, or 'skipped' if it was already complete or is in the negative cache.
+        Without use_negative_cache, threads with an unexpired miss are scraped all the same.
+        """
+        if concurrent is None:
+            concurrent = config.CONCURRENT_FETCH
+        thread_ids = list(thread_ids)
+        self.thread_outcomes = {}
+        to_scrape = self.skip_known_misses(thread_ids, skip=use_negative_cache)
+        if concurrent and config.PIPELINE and not config.PRINT_VIEW:
+            asyncio.run(ScrapePipeline(self).run(to_scrape))
+        elif concurrent:
+            asyncio.run(self.scrape_threads_async(to_scrape))
+        else:
+            for thread_id in to_scrape:
+                logger.info("Processing thread ID: %s", thread_id)
+                try:
+                    self.scrape_thread(thread_id)
+                except Exception as e:
+                    logger.error("Error scraping thread %s: %s", thread_id, e)
+                    self.thread_failed(thread_id)
+                # Add a small delay between threads
+                time.sleep(config.DELAY_BETWEEN_REQUESTS)
+        return {thread_id: self.thread_outcomes.get(thread_id, 'skipped') for thread_id in thread_ids}
+    
+    def scrape_range(self, start_tid, end_tid, concurrent=None):
+        """Scrape a range of thread IDs"""
+        self.scrape_threads(range(start_tid, end_tid + 1), concurrent)
+    
+    def scrape_discovered(self, concurrent=None):
+        """Scrape the threads listed on the forum's boards instead of probing every thread ID"""
+        threads = discover_threads()
+        self.db.insert_thread_listings([listing.row() for listing in threads.values()])
+        self.scrape_threads(sorted(threads), concurrent)
     
     def close(self):
         """Clean up resources"""
         self.db.close()
         self.session.close()
+        if self.archive is not None:
+            self.archive.close()
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class SearchIndexer:
+    """Fills in the search vectors of posts stored before full-text search existed, then builds the indexes
+
+    Posts are updated SEARCH_BACKFILL_BATCH at a time in post_id order, each batch in its own
+    transaction on the indexer's own connection, so it can run in a background thread while
+    scraping. Once every post has a vector the GIN index (and the trigram index if
+    SEARCH_TRIGRAM_INDEX) are created concurrently. stop() ends it between batches; the next
+    run skips the posts that already have vectors.
+    """
+
+    def __init__(self, batch_size=None, trigram=None):
+        self.batch_size = batch_size or config.SEARCH_BACKFILL_BATCH
+        self.trigram = trigram if trigram is not None else config.SEARCH_TRIGRAM_INDEX
+        self.stopped = threading.Event()
+        self.db = None
+        self.thread = threading.Thread(target=self.run, name='search-indexer', daemon=True)
+
+    def run(self):
+        self.db = db = Database()
+        try:
+            if self.fill(db) and not self.stopped.is_set():
+                self.create_indexes(db)
+        except Exception as e:
+            logger.error("Error building the search index: %s", e)
+        finally:
+            db.close()
+
+    def fill(self, db):
+        """Compute the missing search vectors, returning False if stopped before the end"""
+        started = time.monotonic()
+        filled = 0
+        # myBB post IDs start at 1
+        last_post_id = 0
+        while not self.stopped.is_set():
+            count, next_post_id = db.fill_search_vectors(last_post_id, self.batch_size)
+            filled += count
+            if next_post_id is None:
+                if filled:
+                    logger.info("Computed the search vectors of %s posts in %.1fs", filled, time.monotonic() - started)
+                return True
+            last_post_id = next_post_id
+            if count:
+                logger.debug("Computed %s search vectors up to post %s", count, last_post_id)
+        logger.info("Stopped computing search vectors at post %s (%s done)", last_post_id, filled)
+        return False
+
+    def create_indexes(self, db):
+        search_index, trigram_index = Database.SEARCH_INDEXES
+        db.create_index_concurrently(*search_index)
+        if self.trigram and db.create_trigram_support():
+            db.create_index_concurrently(*trigram_index)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop between batches, or cancel an index build (an interrupted build is redone next run)"""
+        self.stopped.set()
+        if self.db is not None and self.thread.is_alive():
+            try:
+                self.db.cancel()
+            except Exception as e:
+                logger.debug("Could not cancel the search indexer's query: %s", e)
+        self.thread.join()
+
+
+def print_search_results(db, query, limit=None, board=None, substring=False):
+    """Print the posts matching query, most relevant first, or the latest containing it if substring"""
+    limit = limit or config.SEARCH_LIMIT
+    started = time.perf_counter()
+    if substring:
+        rows = db.search_posts_substring(query, limit, board)
+    else:
+        rows = db.search_posts(query, limit, board)
+    elapsed = (time.perf_counter() - started) * 1000
+    for post_id, post_date, username, thread_id, title, board_name, rank, excerpt in rows:
+        post_date = post_date.strftime('%Y-%m-%d %H:%M') if post_date else ''
+        rank = f"{rank:.3f}" if rank is not None else ''
+        print(f"{rank:>6}  post {post_id}  {post_date}  {username or ''}  "
+              f"[{board_name or ''}] {title or ''} (tid {thread_id})")
+        print(f"        {' '.join((excerpt or '').split())}")
+    print(f"{len(rows)} posts in {elapsed:.1f} ms")
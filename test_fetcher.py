@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import pytest
+import fetcher
+from fetcher import RateLimiter, parse_retry_after
+
+
+class FakeClock:
+    """Stands in for the time module in fetcher, so tests decide when time passes"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(fetcher, 'time', clock)
+    monkeypatch.setattr(fetcher.config, 'RATE_INCREASE', 0.05)
+    monkeypatch.setattr(fetcher.config, 'RATE_DECREASE_FACTOR', 0.5)
+    monkeypatch.setattr(fetcher.config, 'LATENCY_BACKOFF_FACTOR', 2.0)
+    monkeypatch.setattr(fetcher.config, 'RATE_REPORT_INTERVAL', 0)
+    return clock
+
+
+def test_reserve_spaces_requests(clock):
+    limiter = RateLimiter(2)
+    assert [limiter.reserve() for _ in range(3)] == [0, 0.5, 1.0]
+    clock.now += 10
+    assert limiter.reserve() == 0
+
+
+def test_rate_grows_on_healthy_responses(clock):
+    limiter = RateLimiter(2, adaptive=True, max_rate=3)
+    rates = []
+    for _ in range(20):
+        limiter.record_response(200, 0.1)
+        rates.append(limiter.rate)
+    assert rates == sorted(rates) and rates[0] > 2
+    for _ in range(1000):
+        limiter.record_response(200, 0.1)
+    assert limiter.rate == 3
+
+
+def test_rate_halves_once_per_cooldown(clock):
+    limiter = RateLimiter(8, adaptive=True, min_rate=1)
+    for status in (429, 503, 500):
+        limiter.record_response(status, 0.1)
+    assert limiter.rate == 4
+    clock.now += 0.5
+    limiter.record_response(None, 0.1)
+    assert limiter.rate == 4
+    clock.now += 0.6
+    limiter.record_response(502, 0.1)
+    assert limiter.rate == 2
+    for _ in range(5):
+        clock.now += 1.1
+        limiter.record_response(429, 0.1)
+    assert limiter.rate == 1
+    assert limiter.throttled == 10
+
+
+def test_rate_backs_off_when_latency_rises(clock):
+    limiter = RateLimiter(4, adaptive=True)
+    for _ in range(10):
+        limiter.record_response(200, 0.1)
+    rate = limiter.rate
+    limiter.record_response(200, 2.0)
+    assert limiter.rate == rate * 0.5
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_retry_after_delays_reserve(clock, adaptive):
+    limiter = RateLimiter(10, adaptive=adaptive)
+    limiter.record_response(429, 0.1, retry_after=30)
+    assert limiter.reserve() == 30
+    clock.now += 30
+    assert limiter.reserve() < 1
+
+
+def test_retry_after_ignored_on_other_statuses(clock):
+    limiter = RateLimiter(10)
+    limiter.record_response(200, 0.1, retry_after=30)
+    assert limiter.reserve() == 0
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after('120') == 120.0
+    assert parse_retry_after(' 5 ') == 5.0
+
+
+def test_parse_retry_after_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=60)
+    assert 55 <= parse_retry_after(format_datetime(retry_at, usegmt=True)) <= 60
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+@pytest.mark.parametrize('value', [None, '', 'soon', '-5', '1.5', 'Wed, 99 Foo 2015'])
+def test_parse_retry_after_garbage(value):
+    assert parse_retry_after(value) is None
@@ -0,0 +1,80 @@
+import pytest
+import jobs
+from scraper import ForumScraper
+
+DONE_OUTCOMES = ['complete', 'no_posts', 'not_found', 'forbidden', 'skipped']
+
+
+class StubHeartbeat:
+    def __init__(self, worker):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class StubDatabase:
+    """Hands out one batch of jobs and records how the worker finishes them"""
+
+    def __init__(self, thread_ids):
+        self.batches = [thread_ids]
+        self.done = []
+        self.retried = []
+        self.max_attempts = None
+
+    def claim_jobs(self, worker, limit, lease_seconds, max_attempts):
+        return self.batches.pop() if self.batches else []
+
+    def get_job_counts(self):
+        return {}
+
+    def finish_jobs(self, worker, thread_ids, status='done'):
+        assert status == 'done'
+        self.done.extend(thread_ids)
+
+    def retry_jobs(self, worker, thread_ids, max_attempts):
+        self.retried.extend(thread_ids)
+        self.max_attempts = max_attempts
+
+
+class StubScraper:
+    def __init__(self, db, outcomes):
+        self.db = db
+        self.outcomes = outcomes
+        self.use_negative_cache = None
+
+    def scrape_threads(self, thread_ids, concurrent=None, use_negative_cache=True):
+        self.use_negative_cache = use_negative_cache
+        return {thread_id: self.outcomes[thread_id] for thread_id in thread_ids}
+
+
+@pytest.mark.parametrize('outcome, status', [(outcome, 'done') for outcome in DONE_OUTCOMES] +
+                         [(outcome, 'retry') for outcome in jobs.CrawlWorker.RETRY_OUTCOMES])
+def test_job_outcome(monkeypatch, outcome, status):
+    """Each thread outcome marks its job done or sends it back for another attempt"""
+    monkeypatch.setattr(jobs, 'LeaseHeartbeat', StubHeartbeat)
+    db = StubDatabase([1, 2])
+    scraper = StubScraper(db, {1: outcome, 2: 'complete'})
+    jobs.CrawlWorker(scraper).run()
+    assert scraper.use_negative_cache is False
+    if status == 'done':
+        assert (db.done, db.retried) == ([1, 2], [])
+    else:
+        assert (db.done, db.retried) == ([2], [1])
+        assert db.max_attempts == jobs.config.JOB_MAX_ATTEMPTS
+
+
+def test_retried_http_error_is_not_skipped():
+    """A thread whose page 1 failed is scraped again on retry, and its miss cleared if it works"""
+    class Misses:
+        def get_misses(self, ttl_hours):
+            return {5: True}
+
+    scraper = ForumScraper.__new__(ForumScraper)
+    scraper.db = Misses()
+    assert list(scraper.skip_known_misses([4, 5])) == [4]
+    assert list(scraper.skip_known_misses([4, 5], skip=False)) == [4, 5]
+    assert scraper.known_misses == {5}
@@ -0,0 +1,16 @@
+import pytest
+from benchmark import load_corpus
+from page_parser import make_parser
+from parity import expected_path, parse_page, render
+
+CORPUS = load_corpus()
+
+
+@pytest.mark.parametrize('engine', ['bs4', 'lxml'])
+@pytest.mark.parametrize('name, thread_id, page_num, content', CORPUS, ids=[page[0] for page in CORPUS])
+def test_corpus_page_matches_expected(engine, name, thread_id, page_num, content):
+    """Both engines must reproduce the golden parse result of every corpus page byte for byte"""
+    with open(expected_path(name), 'rb') as f:
+        expected = f.read()
+    actual = render(parse_page(make_parser(engine), thread_id, page_num, 'thread', content))
+    assert actual.encode('utf-8') == expected